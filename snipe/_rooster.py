@@ -130,7 +130,7 @@ class Rooster(util.HTTP_JSONmixin):
 
     async def subscriptions(self):
         await self.ensure_auth()
-        return (await self._get('/v1/subscriptions'))
+        return (await self._get('/v1/subscriptions', _cache=True))
 
     @staticmethod
     def triplet_to_dict(triplet):
@@ -209,7 +209,7 @@ class Rooster(util.HTTP_JSONmixin):
 
         self.log.debug('startid=%s', startid)
 
-        ws = util.JSONWebSocket(self.log)
+        ws = util.JSONWebSocket(self.log, self._JSONmixin_label)
 
         try:
             try:
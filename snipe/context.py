@@ -297,7 +297,8 @@ class SnipeLogHandler(logging.Handler):
             self.buffer.append(s)
             if self.writing:
                 if self.supervisor is not None and self.supervisor.running:
-                    self.task = self.supervisor.start(self.writer())
+                    self.task = self.supervisor.start(
+                        self.writer(), imbroglio.BACKGROUND)
                 else:
                     self.dump()
 
@@ -307,6 +308,8 @@ class SnipeLogHandler(logging.Handler):
 
     def signal_dump(self, *args):
         logging.error('USR1', stack_info=True)
+        logging.getLogger('NetworkStats').error(
+            'network activity:\n%s', util.network_stats().report())
         self.dump()
 
     def dump(self):
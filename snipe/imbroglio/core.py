@@ -33,18 +33,23 @@ This is the core of the imbroglio coroutine supervisor.
 """
 
 __all__ = [
+    'BACKGROUND',
     'Cancelled',
+    'INTERACTIVE',
     'ImbroglioException',
+    'NORMAL',
     'Supervisor',
     'Task',
     'UnfinishedError',
+    'VirtualSupervisor',
     'run',
     ]
 
 
-import bisect
 import collections
+import contextlib
 import functools
+import heapq
 import itertools
 import inspect
 import logging
@@ -59,6 +64,12 @@ import time
 TIME_THRESHOLD = .1  # 100 ms, completely arbitrary
 TIME_QUANTUM = .02   # 20 ms also somewhat arbitrary
 
+# Task priorities.  In each tick only the runnable tasks of the most urgent
+# priority present get to run; the rest wait for a tick without any.
+INTERACTIVE = 0
+NORMAL = 1
+BACKGROUND = 2
+
 
 class ImbroglioException(Exception):
     """Catch-all exceptions for imbroglio"""
@@ -75,13 +86,14 @@ class UnfinishedError(ImbroglioException):
 class Task:
     _next_id = itertools.count().__next__
 
-    def __init__(self, coro, supervisor):
+    def __init__(self, coro, supervisor, priority=NORMAL):
         if not inspect.iscoroutine(coro):
             raise TypeError(
                 'Cannot make a task from non-coroutine %s' % (repr(coro,)))
         self.task_id = self._next_id()
         self.coro = coro
         self.supervisor = supervisor
+        self.priority = priority
         self.pending_exception = None
         self.state = 'GO'
         self.exception = None
@@ -89,6 +101,16 @@ class Task:
 
         self.creation = self._frame(coro.cr_frame)
 
+        # accounting, maintained by the supervisor
+        self.run_time = 0.0
+        self.steps = 0
+        self.longest_step = 0.0
+        self.wait_time = collections.Counter()  # fd, timer, task -> seconds
+        self.calls = collections.Counter()
+
+        # deadline scopes in force, outermost first; see _call_push_deadline
+        self.deadlines = []
+
     def throw(self, exception):
         if self.is_done():
             return False
@@ -130,6 +152,20 @@ class Task:
     def is_done(self):
         return self.state in {'DONE', 'EXCEPTION', 'CANCELLED'}
 
+    def stats(self):
+        """return a dict of what this task has been up to"""
+        return {
+            'task': repr(self),
+            'creation': self.creation,
+            'priority': self.priority,
+            'state': self.state,
+            'run_time': self.run_time,
+            'steps': self.steps,
+            'longest_step': self.longest_step,
+            'wait_time': dict(self.wait_time),
+            'calls': dict(self.calls),
+            }
+
     def __await__(self):
         yield from taskwait(self)  # noqa: F821
 
@@ -182,27 +218,68 @@ class Task:
 
 
 Runnable = collections.namedtuple('Runnable', 'task retval')
+# scope is the deadline scope that cut the wait short, if any
 Waiting = collections.namedtuple(
-    'Waiting', 'target start events fd task other')
+    'Waiting', 'target start events fd task other scope')
+
+
+def _immediate(method):
+    """mark a _call_ method as being handled within the calling task's
+    step, returning its value directly instead of rescheduling the task"""
+    method.immediate = True
+    return method
 
 
 class Supervisor:
     def __init__(self):
         self.runq = []
-        self.waitq = []
+        # task -> Waiting, for everything that isn't runnable
+        self.waitq = {}
+        # heap of (target, sequence, Waiting) for finite timeouts;
+        # entries are removed lazily, see _unwait
+        self.timers = []
+        self.timers_stale = 0
+        self._timer_seq = itertools.count().__next__
+        # task -> {waiting task: Waiting} for the tasks in taskwait on it
+        self.task_waiters = {}
         self.log = logging.getLogger('imbroglio')
         self.running = False
-
-    def start(self, coro):
+        self.selector = None
+        # fd -> {waiting task: Waiting}
+        self.fd_waiters = {}
+
+        # accounting
+        self.ticks = 0
+        self.busy = 0.0  # time spent running tasks
+        self.idle = 0.0  # time spent in select
+        self.started = 0
+        self.finished = 0
+        # creation site -> totals for the tasks from there that have finished
+        self.retired = {}
+
+    def clock(self):
+        """the time according to the supervisor, for timeouts and sleeps"""
+        return time.monotonic()
+
+    def _select(self, duration):
+        """wait up to duration seconds (or forever if None) for
+        registered fds to become ready"""
+        return self.selector.select(duration)
+
+    def start(self, coro, priority=NORMAL):
         """start a task from non-async code"""
-        newtask = Task(coro, self)
+        newtask = Task(coro, self, priority)
+        self.started += 1
         self.runq.append(Runnable(newtask, None))
         return newtask
 
-    def _call_spawn(self, task, coro):
-        """spawns a new coroutine in the event loop"""
+    def _call_spawn(self, task, coro, priority=NORMAL):
+        """spawns a new coroutine in the event loop
+
+        priority is one of INTERACTIVE, NORMAL or BACKGROUND.
+        """
 
-        newtask = self.start(coro)
+        newtask = self.start(coro, priority)
         self._return(task, newtask)
 
     def _call_sleep(self, task, duration=0):
@@ -262,15 +339,139 @@ class Supervisor:
 
     def _wait_internal(self, task, fd, events, duration, other=None):
         """internals of _call_readwait and _call_writewait"""
-        now = time.monotonic()
-        if duration is None:
-            bisect.insort_left(
-                self.waitq,
-                Waiting(float('Inf'), now, events, fd, task, other))
+        now = self.clock()
+        if events and not isinstance(fd, int):
+            fd = fd.fileno()
+        target = float('Inf') if duration is None else now + duration
+        scope = None
+        for deadline_scope in task.deadlines:
+            if deadline_scope.deadline < target:
+                target, scope = deadline_scope.deadline, deadline_scope
+        waiting = Waiting(target, now, events, fd, task, other, scope)
+        if not math.isinf(target):
+            heapq.heappush(self.timers, (target, self._timer_seq(), waiting))
+        self.waitq[task] = waiting
+        if other is not None:
+            self.task_waiters.setdefault(other, {})[task] = waiting
+        if events:
+            self.fd_waiters.setdefault(fd, {})[task] = waiting
+            self._fd_update(fd, rearm=True)
+
+    def _unwait(self, waiting, timer=True):
+        """remove a Waiting from all the indexes
+
+        Timers are left in the heap to be discarded when they reach the
+        top (or when there are enough of them to be worth compacting),
+        unless timer is False, meaning that the caller has already
+        popped it.
+        """
+        del self.waitq[waiting.task]
+        if waiting.events:
+            kind = 'fd'
+        elif waiting.other is not None:
+            kind = 'task'
         else:
-            bisect.insort_left(
-                self.waitq,
-                Waiting(now + duration, now, events, fd, task, other))
+            kind = 'timer'
+        waiting.task.wait_time[kind] += self.clock() - waiting.start
+        self._fd_forget(waiting)
+        if waiting.other is not None:
+            waiters = self.task_waiters.get(waiting.other)
+            if waiters is not None:
+                waiters.pop(waiting.task, None)
+                if not waiters:
+                    del self.task_waiters[waiting.other]
+        if timer and not math.isinf(waiting.target):
+            self.timers_stale += 1
+            if self.timers_stale > max(64, len(self.timers) // 2):
+                self.timers = [
+                    entry for entry in self.timers if self._timer_live(entry)]
+                heapq.heapify(self.timers)
+                self.timers_stale = 0
+
+    def _timer_live(self, entry):
+        return self.waitq.get(entry[2].task) is entry[2]
+
+    def _next_timer(self):
+        """discard dead timers from the top of the heap, return the next
+        live one or None"""
+        while self.timers:
+            if self._timer_live(self.timers[0]):
+                return self.timers[0]
+            heapq.heappop(self.timers)
+            self.timers_stale -= 1
+        return None
+
+    def _fd_update(self, fd, rearm=False):
+        """bring the selector's registration for fd in line with its waiters
+
+        The selector lives for as long as the scheduler loop does, so
+        fds are registered when the first task starts waiting on them,
+        modified as the set of interesting events changes, and dropped
+        when the last waiter goes away.
+
+        An fd can be closed (and its number reused) while something is
+        still waiting on it, though, and then the kernel has forgotten
+        the registration the selector remembers.  So an fd that's
+        already registered is registered afresh when a new waiter turns
+        up (rearm), or if modifying it fails.
+        """
+        waiters = self.fd_waiters.get(fd)
+        eventmask = 0
+        if waiters:
+            eventmask = functools.reduce(
+                lambda a, b: a | b, (w.events for w in waiters.values()))
+        else:
+            self.fd_waiters.pop(fd, None)
+
+        try:
+            key = self.selector.get_key(fd)
+        except KeyError:
+            key = None
+
+        if key is None:
+            if eventmask:
+                self.selector.register(fd, eventmask)
+        elif not eventmask:
+            self.selector.unregister(fd)
+        elif rearm:
+            self.selector.unregister(fd)
+            self.selector.register(fd, eventmask)
+        elif key.events != eventmask:
+            try:
+                self.selector.modify(fd, eventmask)
+            except (OSError, KeyError):
+                self.selector.unregister(fd)
+                with contextlib.suppress(OSError):
+                    # if it's just closed, the waiters will time out or
+                    # be cancelled
+                    self.selector.register(fd, eventmask)
+
+    def _fd_forget(self, waiting):
+        """remove a waiter from the fd index"""
+        if not waiting.events:
+            return
+        waiters = self.fd_waiters.get(waiting.fd)
+        if waiters is not None:
+            waiters.pop(waiting.task, None)
+            self._fd_update(waiting.fd)
+
+    @_immediate
+    def _call_push_deadline(self, task, scope, duration):
+        """put the task under a deadline, duration seconds from now
+
+        Until the scope is popped, anything the task waits on is cut short
+        at the deadline by throwing the exception returned by
+        scope.expire() into it.  (So this only limits time spent blocked
+        in the supervisor.)  Sets and returns scope.deadline.
+        """
+        scope.deadline = self.clock() + duration
+        task.deadlines.append(scope)
+        return scope.deadline
+
+    @_immediate
+    def _call_pop_deadline(self, task, scope):
+        """lift a deadline put in place by push_deadline"""
+        task.deadlines.remove(scope)
 
     def _call_this_task(self, task):
         """return the current task"""
@@ -284,9 +485,44 @@ class Supervisor:
         """return a tuple of lists of the runnable and waiting tasks"""
         self._return(task, (
             [t.task for t in self.runq],
-            [t.task for t in self.waitq],
+            list(self.waitq),
             ))
 
+    def _call_stats(self, task):
+        """return a dict of scheduler and per-task statistics"""
+        self._return(task, self.stats(task))
+
+    def stats(self, current=None):
+        """scheduler and per-task statistics, busiest tasks first
+
+        current is the running task, if any, which is otherwise neither
+        runnable nor waiting and so wouldn't show up.
+        """
+        live = [t.task for t in self.runq] + list(self.waitq)
+        if current is not None:
+            live.insert(0, current)
+        return {
+            'ticks': self.ticks,
+            'busy': self.busy,
+            'idle': self.idle,
+            'started': self.started,
+            'finished': self.finished,
+            'tasks': sorted(
+                (t.stats() for t in live),
+                key=lambda d: d['run_time'], reverse=True),
+            'retired': {k: dict(v) for (k, v) in self.retired.items()},
+            }
+
+    def _retire(self, task):
+        """fold a finished task's accounting into the per-site totals"""
+        self.finished += 1
+        totals = self.retired.setdefault(task.creation, {
+            'count': 0, 'run_time': 0.0, 'steps': 0, 'longest_step': 0.0})
+        totals['count'] += 1
+        totals['run_time'] += task.run_time
+        totals['steps'] += task.steps
+        totals['longest_step'] = max(totals['longest_step'], task.longest_step)
+
     def _call_switch(self, task):
         """yield if our quantum has run out"""
         # partially handled in _step
@@ -296,17 +532,17 @@ class Supervisor:
         self.runq.append(Runnable(task, val))
 
     def _rouse(self, task):
-        for i, qe in enumerate(self.waitq):
-            if qe.task == task:
-                del self.waitq[i]
-                self.runq.append(
-                    Runnable(task, (False, time.monotonic() - qe[1])))
-                break
+        waiting = self.waitq.get(task)
+        if waiting is not None:
+            self._unwait(waiting)
+            self.runq.append(
+                Runnable(task, (False, self.clock() - waiting.start)))
 
     def _run(self, runtask):
         self.log.debug('starting scheduler loop')
 
         def _step(task, retval):
+            start = time.monotonic()
             t0 = time.time()
             t1 = t0
             try:
@@ -322,6 +558,11 @@ class Supervisor:
                         self.log.error(msg)
                         exc = ImbroglioException(msg)
                         val = task.coro.throw(type(exc), exc)
+                    task.calls[val[0]] += 1
+                    call = getattr(self, '_call_' + val[0], None)
+                    if getattr(call, 'immediate', False):
+                        retval = call(task, *val[1:])
+                        continue
                     if val != ('switch',):
                         break
                     t2 = time.time()
@@ -345,6 +586,11 @@ class Supervisor:
                 task.set_result_exception(e)
                 return
             finally:
+                elapsed = time.monotonic() - start
+                task.run_time += elapsed
+                task.steps += 1
+                task.longest_step = max(task.longest_step, elapsed)
+                self.busy += elapsed
                 duration = time.time() - t0
                 if duration > TIME_THRESHOLD:
                     self.log.warning(
@@ -355,82 +601,130 @@ class Supervisor:
             call(task, *val[1:])
 
         self.runq.append(Runnable(runtask, None))
+        self.started += 1
+        self.selector = selectors.DefaultSelector()
 
         try:
             self.running = True
 
             while True:
-                tick = time.monotonic()
-                runq, self.runq = self.runq, []
+                tick = self.clock()
+                self.ticks += 1
 
                 # get the expired waits
-                division = bisect.bisect_right(
-                    self.waitq, (tick, tick, None))
-                wake, self.waitq = self.waitq[:division], self.waitq[division:]
-
-                for wakey in wake:
-                    duration = time.monotonic() - wakey.start
+                while True:
+                    entry = self._next_timer()
+                    if entry is None or entry[0] > tick:
+                        break
+                    heapq.heappop(self.timers)
+                    wakey = entry[2]
+                    self._unwait(wakey, timer=False)
+                    if wakey.scope is not None:
+                        wakey.task.pending_exception = wakey.scope.expire()
+                        self.runq.append(Runnable(wakey.task, None))
+                        continue
+                    duration = self.clock() - wakey.start
                     self.runq.append(Runnable(wakey.task, (True, duration)))
 
+                runq, self.runq = self.runq, []
+                if runq:
+                    priority = min(run.task.priority for run in runq)
+                    if any(run.task.priority != priority for run in runq):
+                        self.runq = [
+                            run for run in runq
+                            if run.task.priority != priority]
+                        runq = [
+                            run for run in runq
+                            if run.task.priority == priority]
+
                 for run in runq:
                     _step(run.task, run.retval)
                     if run.task.is_done():
-                        for i, w in reversed(list(enumerate(self.waitq))):
-                            if w.other is run.task:
-                                duration = time.monotonic() - w.start
-                                self.runq.append(
-                                    Runnable(w.task, (False, duration)))
-                                del self.waitq[i]
+                        self._retire(run.task)
+                        waiters = self.task_waiters.pop(run.task, {})
+                        for w in waiters.values():
+                            self._unwait(w)
+                            duration = self.clock() - w.start
+                            self.runq.append(
+                                Runnable(w.task, (False, duration)))
 
                 if self.waitq:
-                    target = self.waitq[0].target
-                    if not math.isinf(target):
-                        duration = max(0.0, target - time.monotonic())
+                    entry = self._next_timer()
+                    if entry is not None:
+                        duration = max(0.0, entry[0] - self.clock())
                     else:
                         duration = None
                     if self.runq:  # we have runnable tasks, don't wait
                         duration = 0
-                    with selectors.DefaultSelector() as selector:
-                        fd_tasks = {}
-                        for e in self.waitq:
-                            if e.events:
-                                fd_tasks.setdefault(
-                                    e.fd, {}).setdefault(
-                                        e.events, []).append(e)
-                        for k, v in fd_tasks.items():
-                            eventmask = functools.reduce(
-                                lambda a, b: a | b, v.keys())
-                            selector.register(k, eventmask, v)
-                        cleanup = set()
-                        now = time.monotonic()
-                        for key, events in selector.select(duration):
-                            for mask, waiters in key.data.items():
-                                if events & mask:
-                                    for e in waiters:
-                                        cleanup.add(e)
-                                        self.runq.append(
-                                            Runnable(
-                                                e.task,
-                                                (False, now - e.start)))
-                        self.waitq = [
-                            e for e in self.waitq if e not in cleanup]
+                    ready = []
+                    tick_end = time.monotonic()
+                    selected = self._select(duration)
+                    self.idle += time.monotonic() - tick_end
+                    now = self.clock()
+                    for key, events in selected:
+                        ready.extend(
+                            e for e in self.fd_waiters.get(key.fd, {}).values()
+                            if events & e.events)
+                    for e in ready:
+                        self._unwait(e)
+                        self.runq.append(
+                            Runnable(e.task, (False, now - e.start)))
 
                 if not self.runq and not self.waitq:
                     break
         finally:
             self.running = False
+            self.selector.close()
+            self.selector = None
+            self.fd_waiters = {}
+            self.timers = []
+            self.timers_stale = 0
+            self.task_waiters = {}
             if self.runq:  # pragma: nocover
                 print('Runnable tasks at supervisor exit:')
                 for t in self.runq:
                     print(f' {t!r}')
             if self.waitq:  # pragma: nocover
                 print('Waiting tasks at supervisor exit:')
-                for t in self.waitq:
+                for t in self.waitq.values():
                     print(f' {t!r}')
 
         return
 
 
+class VirtualSupervisor(Supervisor):
+    """
+    A Supervisor with a virtual clock, for tests, benchmarks and replays.
+
+    Whenever nothing is runnable and no fd is ready, the clock jumps
+    straight to the next timer instead of waiting for it, so hours of
+    sleeps and timeouts go by as fast as the tasks can run.  fds are still
+    polled for real, and if there's nothing but fds to wait for it waits
+    for them for real.  Time spent waiting for things outside the
+    supervisor (other threads, other processes) doesn't advance the
+    clock, so they'll seem instantaneous or very slow depending.
+    """
+
+    def __init__(self, start=0.0):
+        super().__init__()
+        self.now = start
+
+    def clock(self):
+        return self.now
+
+    def _select(self, duration):
+        ready = self.selector.select(0)
+        if ready or duration == 0:
+            return ready
+        if duration is None:
+            return self.selector.select(None)
+        # jump to the timer itself rather than adding duration, which
+        # could round to just short of it
+        entry = self._next_timer()
+        self.now = max(self.now, entry[0] if entry else self.now + duration)
+        return []
+
+
 def _reify_calls():
     CALL_PREFIX = '_call_'
     mod = sys.modules[__name__]
@@ -463,8 +757,8 @@ _reify_calls()
 del _reify_calls
 
 
-def run(coro, exception=True):
-    supervisor = Supervisor()
-    task = Task(coro, supervisor)
+def run(coro, exception=True, priority=NORMAL, virtual=False):
+    supervisor = VirtualSupervisor() if virtual else Supervisor()
+    task = Task(coro, supervisor, priority)
     supervisor._run(task)
     return task.result(exception=exception)
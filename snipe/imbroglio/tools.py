@@ -33,23 +33,38 @@ Some useful things built on top of the imbroglio primitives
 """
 
 __all__ = [
+    'CapacityLimiter',
     'Event',
+    'ProcessPool',
     'Promise',
+    'Queue',
+    'QueueEmpty',
+    'QueueFull',
+    'Semaphore',
+    'ThreadPool',
     'Timeout',
     'TimeoutError',
     'gather',
     'process_filter',
+    'process_pool',
+    'run_in_process',
     'run_in_thread',
     'test',
+    'thread_pool',
     ]
 
 
+import collections
+import concurrent.futures.process
+import contextlib
 import fcntl
 import functools
 import inspect
+import multiprocessing
 import os
-import socket
+import queue
 import subprocess
+import sys
 import threading
 
 from . import core as imbroglio
@@ -63,28 +78,35 @@ class Timeout:
     """
     Async context manager for timeouts.
     Only works for operations that block in imbroglio.
+
+    The deadline is kept on the task and enforced by the supervisor when
+    the task waits, so this doesn't cost an extra task or extra ticks.
+    Timeouts nest; the one whose deadline passes first fires, and only
+    that one swallows its TimeoutError.
     """
 
     def __init__(self, duration):
         self.duration = duration
+        self.deadline = None
+        self.exception = None
+        self.done = False
 
-    async def _timer(self):
-        await imbroglio.sleep(self.duration)
-        self.watched_task.throw(
-            TimeoutError(f'timed out after {self.duration}s'))
+    def expire(self):
+        """Called by the supervisor when the deadline passes."""
+        self.exception = TimeoutError(f'timed out after {self.duration}s')
+        return self.exception
+
+    def is_done(self):
+        return self.done
 
     async def __aenter__(self):
-        self.watched_task = await imbroglio.this_task()
-        self.timer_task = await imbroglio.spawn(self._timer())
-        return self.timer_task
+        await imbroglio.push_deadline(self, self.duration)
+        return self
 
     async def __aexit__(self, exc_type, exc_val, exc_tb):
-        try:
-            self.timer_task.cancel()
-        except TimeoutError:  # pragma: nocover
-            pass  # this is here to reduce raciness
-        await imbroglio.sleep()  # so the cancel above gets processed
-        return exc_type == TimeoutError
+        await imbroglio.pop_deadline(self)
+        self.done = True
+        return exc_val is not None and exc_val is self.exception
 
 
 async def gather(*coros, return_exceptions=False):
@@ -148,53 +170,306 @@ class Promise:
         return self.result
 
 
-async def run_in_thread(func, *args, **kwargs):
-    result = None
-    exception = None
+class _Job:
+    def __init__(self, func, args, kwargs):
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.result = None
+        self.exception = None
+        self.promise = Promise()
+        self.abandoned = False
 
-    sender, receiver = socket.socketpair()
-    try:
-        def runner():
-            nonlocal result
-            nonlocal exception
+    def run(self):
+        try:
+            self.result = self.func(*self.args, **self.kwargs)
+        except BaseException as e:
+            self.exception = e
 
-            try:
-                result = func(*args, **kwargs)
-            except Exception as e:
-                exception = e
 
-            sender.send(b'X')
+class _Pool:
+    """
+    Plumbing for handing results computed off the supervisor thread back
+    to the tasks waiting for them.
+
+    Finished jobs are put on a completion queue and the pool's single
+    wakeup pipe is poked, so there is one fd for the supervisor to watch
+    no matter how many calls are outstanding.  A reaper task drains the
+    completion queue and hands results back to the waiting tasks; it only
+    exists while something is waiting, so it doesn't keep the supervisor
+    from exiting.
+    """
 
-        thread = threading.Thread(target=runner)
+    def __init__(self, size):
+        self.size = size
+        self.completions = collections.deque()
+        self.lock = threading.Lock()
+        self.signalled = False
+        self.wakeup_r, self.wakeup_w = os.pipe()
+        os.set_blocking(self.wakeup_r, False)
+        os.set_blocking(self.wakeup_w, False)
+        self.waiting = 0
+        self.reaper = None
+
+        self.submitted = 0
+        self.completed = 0
+
+    def _complete(self, job):
+        """Called from whatever thread finished the job."""
+        with self.lock:
+            self.completions.append(job)
+            self.completed += 1
+            poke, self.signalled = not self.signalled, True
+        if poke:
+            os.write(self.wakeup_w, b'X')
+
+    def _reap(self):
+        with contextlib.suppress(BlockingIOError):
+            while os.read(self.wakeup_r, 4096):
+                pass
+        with self.lock:
+            self.signalled = False
+            done, self.completions = self.completions, collections.deque()
+        for job in done:
+            if job.abandoned:
+                continue
+            self.waiting -= 1
+            if job.exception is not None:
+                job.promise.set_result_exception(job.exception)
+            else:
+                job.promise.set_result(job.result)
+
+    async def _reaper(self):
+        me = await imbroglio.this_task()
+        while self.waiting:
+            await imbroglio.readwait(self.wakeup_r)
+            self._reap()
+        if self.reaper is me:
+            self.reaper = None
+
+    def _submit(self, job):  # pragma: nocover
+        raise NotImplementedError
+
+    def _cancel(self, job):
+        pass
+
+    async def run(self, func, *args, **kwargs):
+        job = _Job(func, args, kwargs)
+        self._submit(job)
+        self.waiting += 1
+
+        supervisor = await imbroglio.get_supervisor()
+        # no awaiting between the check and the assignment, lest a
+        # concurrent caller start a second reaper
+        if self.reaper is None or self.reaper.supervisor is not supervisor:
+            self.reaper = supervisor.start(self._reaper())
 
-        async def launcher():
-            # wait a tick, so the parent runs again and starts to sleep
-            await imbroglio.sleep()
-            thread.start()
+        try:
+            return await job.promise
+        finally:
+            if not job.promise.done:
+                # we got cancelled or something; drop the result on the floor
+                job.abandoned = True
+                self._cancel(job)
+                self.waiting -= 1
+                if (not self.waiting and self.reaper is not None
+                        and self.reaper.supervisor is supervisor):
+                    self.reaper.rouse()  # so it notices and exits
+
+
+class ThreadPool(_Pool):
+    """
+    A bounded set of reusable worker threads for calls that would block.
+    """
 
-        await imbroglio.spawn(launcher())
-        await imbroglio.readwait(receiver)
+    def __init__(self, size=8):
+        super().__init__(size)
+        self.work = queue.Queue()
+        self.threads = 0
+        self.idle = 0
+        self.max_queued = 0
+
+    def resize(self, size):
+        """Change the maximum number of worker threads.  Surplus threads
+        exit once they finish what they're doing."""
+        with self.lock:
+            self.size = size
+            surplus = self.threads - size
+        for i in range(max(0, surplus)):
+            self.work.put(None)
+
+    def stats(self):
+        with self.lock:
+            queued = self.work.qsize()
+            return {
+                'size': self.size,
+                'threads': self.threads,
+                'idle': self.idle,
+                'busy': self.threads - self.idle,
+                'queued': queued,
+                'max_queued': self.max_queued,
+                'waiting': self.waiting,
+                'submitted': self.submitted,
+                'completed': self.completed,
+                }
+
+    def _worker(self):
+        while True:
+            with self.lock:
+                self.idle += 1
+            job = self.work.get()
+            with self.lock:
+                self.idle -= 1
+                if job is None:
+                    self.threads -= 1
+                    return
+            job.run()
+            self._complete(job)
+
+    def _submit(self, job):
+        with self.lock:
+            self.submitted += 1
+            self.work.put(job)
+            queued = self.work.qsize()
+            self.max_queued = max(self.max_queued, queued)
+            start = queued > self.idle and self.threads < self.size
+            if start:
+                self.threads += 1
+        if start:
+            threading.Thread(
+                target=self._worker, name='imbroglio-worker',
+                daemon=True).start()
+
+
+class ProcessPool(_Pool):
+    """
+    A persistent set of worker processes for CPU-bound calls, so they can
+    run on other cores while the supervisor thread gets on with things.
+
+    The function, its arguments and its result (or exception) must all be
+    picklable.  Worker processes are started on first use and kept.  A
+    caller that is cancelled while its call is still queued withdraws it;
+    one that is cancelled after the executor has passed the call to a
+    worker just doesn't get the result.
+    """
+
+    def __init__(self, size=None, mp_context=None):
+        super().__init__(size)
+        if mp_context is None:
+            # the supervisor's process usually has threads by the time we
+            # get here, and fork() doesn't mix well with those
+            mp_context = multiprocessing.get_context('forkserver')
+        self.mp_context = mp_context
+        self.executor = None
+        self.futures = set()  # submitted and not done yet
+
+    def stats(self):
+        with self.lock:
+            return {
+                'size': self.size,
+                'waiting': self.waiting,
+                'submitted': self.submitted,
+                'completed': self.completed,
+                }
+
+    def _finished(self, job, future):
+        with self.lock:
+            self.futures.discard(future)
+        if future.cancelled():
+            return  # the caller already went away
+        try:
+            job.result = future.result()
+        except BaseException as e:
+            job.exception = e
+        self._complete(job)
+
+    def _submit(self, job):
+        with self.lock:
+            self.submitted += 1
+        for attempt in range(2):
+            if self.executor is None:
+                if sys.version_info >= (3, 7):
+                    self.executor = concurrent.futures.ProcessPoolExecutor(
+                        self.size, mp_context=self.mp_context)
+                else:  # pragma: nocover
+                    # no choosing how the workers are started
+                    self.executor = concurrent.futures.ProcessPoolExecutor(
+                        self.size)
+            try:
+                job.future = self.executor.submit(
+                    job.func, *job.args, **job.kwargs)
+                with self.lock:
+                    self.futures.add(job.future)
+                break
+            except concurrent.futures.process.BrokenProcessPool:
+                # a worker died out from under us; start over
+                self.executor.shutdown(wait=False)
+                self.executor = None
+                if attempt:
+                    raise
+        job.future.add_done_callback(
+            functools.partial(self._finished, job))
+
+    def _cancel(self, job):
+        job.future.cancel()
+
+    def shutdown(self):
+        if self.executor is not None:
+            # withdraw whatever hasn't started (shutdown's cancel_futures
+            # would, but only from python 3.9)
+            with self.lock:
+                futures, self.futures = self.futures, set()
+            for future in futures:
+                future.cancel()
+            self.executor.shutdown(wait=False)
+            self.executor = None
+
+
+THREAD_POOL_SIZE = 8
+PROCESS_POOL_SIZE = None  # i.e. os.cpu_count()
+_thread_pool = None
+_process_pool = None
+
+
+def thread_pool():
+    """Return the process-wide ThreadPool, creating it if need be."""
+    global _thread_pool
+    if _thread_pool is None:
+        _thread_pool = ThreadPool(THREAD_POOL_SIZE)
+    return _thread_pool
+
+
+def process_pool():
+    """Return the process-wide ProcessPool, creating it if need be."""
+    global _process_pool
+    if _process_pool is None:
+        _process_pool = ProcessPool(PROCESS_POOL_SIZE)
+    return _process_pool
 
-        thread.join()
-        if exception is not None:
-            raise exception
-        return result
-    finally:
-        sender.close()
-        receiver.close()
+
+async def run_in_thread(func, *args, **kwargs):
+    return await thread_pool().run(func, *args, **kwargs)
+
+
+async def run_in_process(func, *args, **kwargs):
+    return await process_pool().run(func, *args, **kwargs)
 
 
 async def process_filter(cmd, inbuf):
     inr, inw = os.pipe()
     outr, outw = os.pipe()
+    inw_open = True
 
     async def sender(inbuf):
+        nonlocal inw_open
         inbuf = inbuf.encode()
         while inbuf:
             await imbroglio.writewait(inw)
             count = os.write(inw, inbuf)
             inbuf = inbuf[count:]
         os.close(inw)
+        # don't close it again below; by then the number may be reused
+        inw_open = False
 
     try:
         for fd in (inw, outr):
@@ -221,10 +496,11 @@ async def process_filter(cmd, inbuf):
             retval = await run_in_thread(p.wait)
             return retval, b''.join(output).decode(errors='replace')
     finally:
-        try:
-            os.close(inw)
-        except OSError:
-            pass
+        if inw_open:
+            try:
+                os.close(inw)
+            except OSError:  # pragma: nocover
+                pass
         try:
             os.close(outr)
         except OSError:  # pragma: nocover
@@ -259,6 +535,156 @@ class Event:
         await p
 
 
+def _wakeup(waiters):
+    """wake the first task still waiting in a deque of Promises"""
+    while waiters:
+        p = waiters.popleft()
+        if not p.done:
+            p.set_result(None)
+            return True
+    return False
+
+
+async def _wait(waiters):
+    """wait in a deque of Promises until _wakeup gets to us"""
+    p = Promise()
+    waiters.append(p)
+    try:
+        await p
+    except BaseException:
+        if p.done:
+            # we were woken but aren't going to act on it, pass it on
+            _wakeup(waiters)
+        else:
+            waiters.remove(p)
+        raise
+
+
+class QueueEmpty(imbroglio.ImbroglioException):
+    pass
+
+
+class QueueFull(imbroglio.ImbroglioException):
+    pass
+
+
+class Queue:
+    """
+    A FIFO for handing things from producer tasks to consumer tasks.
+
+    If maxsize is nonzero, put blocks while the queue is full, so a
+    producer that gets ahead of its consumers is slowed down rather than
+    piling up an unbounded backlog.
+    """
+
+    def __init__(self, maxsize=0):
+        self.maxsize = maxsize
+        self.items = collections.deque()
+        self.getters = collections.deque()  # Promises
+        self.putters = collections.deque()
+
+    def qsize(self):
+        return len(self.items)
+
+    def empty(self):
+        return not self.items
+
+    def full(self):
+        return 0 < self.maxsize <= len(self.items)
+
+    def put_nowait(self, item):
+        if self.full():
+            raise QueueFull(f'queue full at {self.maxsize}')
+        self.items.append(item)
+        _wakeup(self.getters)
+
+    async def put(self, item):
+        while self.full():
+            await _wait(self.putters)
+        self.put_nowait(item)
+
+    def get_nowait(self):
+        if not self.items:
+            raise QueueEmpty('queue empty')
+        item = self.items.popleft()
+        _wakeup(self.putters)
+        return item
+
+    async def get(self):
+        while not self.items:
+            await _wait(self.getters)
+        return self.get_nowait()
+
+    async def get_many(self, limit=None):
+        """Wait for at least one item, then return a list of as many as
+        are available, up to limit."""
+        while not self.items:
+            await _wait(self.getters)
+        if limit is None:
+            limit = len(self.items)
+        return [self.get_nowait() for _ in range(min(limit, len(self.items)))]
+
+
+class Semaphore:
+    """
+    A counter that tasks can take from (waiting if it's zero) and put
+    back, usually with ``async with``.
+    """
+
+    def __init__(self, value=1):
+        self.value = value
+        self.waiters = collections.deque()  # Promises
+
+    def locked(self):
+        return self.value <= 0
+
+    async def acquire(self):
+        while self.value <= 0:
+            await _wait(self.waiters)
+        self.value -= 1
+
+    def release(self):
+        self.value += 1
+        _wakeup(self.waiters)
+
+    async def __aenter__(self):
+        await self.acquire()
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        self.release()
+
+
+class CapacityLimiter(Semaphore):
+    """
+    A Semaphore for capping how many tasks can be doing something at
+    once, where the cap can be changed on the fly.
+    """
+
+    def __init__(self, total_tokens):
+        super().__init__(total_tokens)
+        self._total_tokens = total_tokens
+
+    @property
+    def total_tokens(self):
+        return self._total_tokens
+
+    @total_tokens.setter
+    def total_tokens(self, total_tokens):
+        self.value += total_tokens - self._total_tokens
+        self._total_tokens = total_tokens
+        for i in range(max(0, self.value)):
+            if not _wakeup(self.waiters):
+                break
+
+    @property
+    def borrowed_tokens(self):
+        return self._total_tokens - self.value
+
+    @property
+    def available_tokens(self):
+        return max(0, self.value)
+
+
 def test(f):
     """
     Wrap an async function in a call to the imbroglio supervisor,
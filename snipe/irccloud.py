@@ -73,17 +73,26 @@ class IRCCloud(messages.SnipeBackend, util.HTTP_JSONmixin):
         'only backfill this far at a time (seconds)',
         coerce=int)
 
+    backfill_concurrency = util.Configurable(
+        'irccloud.backfill_concurrency', 8,
+        'how many buffers to backfill at once',
+        coerce=int)
+
+    include_batch = 1000  # merge oob_include messages this many at a time
+
     def __init__(self, *args, **kw):
         super().__init__(*args, **kw)
 
         self.reqid_counter = itertools.count()
 
-        self.messages = []
+        self.messages = messages.MessageList()
         self.connections = {}
         self.buffers = {}
         self.channels = {}
         self.servers = {}
         self.backfillers = []
+        self.backfill_limiter = imbroglio.CapacityLimiter(
+            self.backfill_concurrency)
         self.last_eid = 0
         self.new_task = None
         self.header = {}
@@ -173,7 +182,7 @@ class IRCCloud(messages.SnipeBackend, util.HTTP_JSONmixin):
                 ])
             self.since_id = self.last_eid
 
-        self.websocket = util.JSONWebSocket(self.log)
+        self.websocket = util.JSONWebSocket(self.log, self.name)
         try:
             await self.websocket.connect(
                 url,
@@ -248,6 +257,9 @@ class IRCCloud(messages.SnipeBackend, util.HTTP_JSONmixin):
                 await self.include(m['url'])
             finally:
                 self.message_set = None
+            # now that we know the connections and buffers
+            if self.stored_cursor is None:
+                await self.hydrate()
         elif mtype == 'oob_skipped':
             await imbroglio.switch()
             self.message_set = set(float(m) for m in self.messages)
@@ -293,36 +305,53 @@ class IRCCloud(messages.SnipeBackend, util.HTTP_JSONmixin):
             # should make an error-message
             self.log.error('failed {m}')
             return
-        self.drop_cache()
         if msg is not None:
             self.redisplay(msg, msg)
+            await self.persist([msg])
 
     async def include(self, url):
         self.log.debug('including %s', url)
         self.state_set(messages.BackendState.LOADING)
         try:
-            oob_data = await self._get(url)
-            if 'success' in oob_data and not oob_data['success']:
-                self.log.error(
-                    f'including out of band data {url} failure:' +
-                    f' f{oob_data["message"]}')
-                return
-
             included = []
 
-            await imbroglio.switch()
-            for m in oob_data:
-                await self.process_message(included, m)
-                await imbroglio.switch()
-            included.sort()
+            # merge as we go rather than waiting for the whole download
+            async with self._get_stream(url) as oob_data:
+                async for m in oob_data:
+                    if not oob_data.array:
+                        self.log.error(
+                            f'including out of band data {url} failure:' +
+                            f' f{m.get("message")}')
+                        return
+                    await self.process_message(included, m)
+                    if len(included) >= self.include_batch:
+                        self.merge_included(included)
+                        await self.persist(included)
+                        included = []
+                    await imbroglio.switch()
 
-            if included:
-                self.messages = list(messages.merge([self.messages, included]))
-                self.drop_cache()
-                self.redisplay(included[0], included[-1])
+            self.merge_included(included)
+            await self.persist(included)
         finally:
             self.state_set(messages.BackendState.IDLE)
 
+    def merge_included(self, included):
+        if included:
+            included.sort()
+            self.messages.merge(included)
+            self.redisplay(included[0], included[-1])
+
+    def store_key(self, msg):
+        if not isinstance(msg, IRCCloudMessage):
+            return None
+        eid = msg.data.get('eid', -1)
+        if eid <= 0:
+            return None
+        return f'{msg.data.get("cid")} {msg.data.get("bid")} {eid}'
+
+    async def message_from_store(self, data):
+        return IRCCloudMessage(self, data)
+
     async def send(self, paramstr, body):
         params = paramstr.split()
 
@@ -385,6 +414,9 @@ class IRCCloud(messages.SnipeBackend, util.HTTP_JSONmixin):
 
     def backfill(self, mfilter, target=None):
         self.log.debug('backfill([filter], %s)', util.timestr(target))
+        # (the first batch gets loaded after the initial oob_include)
+        if self.stored_cursor is not None and self.backfill_stored():
+            return
         live = [
             b for b in self.buffers.values()
             if (not b.get('deferred', False)
@@ -407,7 +439,8 @@ class IRCCloud(messages.SnipeBackend, util.HTTP_JSONmixin):
         self.log.debug('%d backfillers active', len(self.backfillers))
         if not self.backfillers:
             for b in live:
-                t = self.supervisor.start(self.backfill_buffer(b, target))
+                t = self.supervisor.start(
+                    self.backfill_buffer(b, target), imbroglio.BACKGROUND)
                 self.backfillers.append((t, t0))
                 self.tasks.append(t)
             if self.backfillers:
@@ -428,19 +461,40 @@ class IRCCloud(messages.SnipeBackend, util.HTTP_JSONmixin):
                         target,
                         buf['have_eid'] - self.backfill_length * 1000000)
 
+                    included = []
+                    failure = None
+
+                    oldest = buf['have_eid']
+                    self.log.debug('t = %f', oldest / 1000000)
+
+                    # Messages are processed as they arrive.  Processing
+                    # moves have_eid back, so a retry picks up where the
+                    # failed download stopped.
                     count = 1
                     while True:
                         try:
                             self.log.debug(
                                 'backfilling %s retrieving backlog, try=%d',
                                 buf['name'], count)
-                            oob_data = await self._get(
-                                '/chat/backlog',
-                                cid=buf['cid'],
-                                bid=buf['bid'],
-                                num=256,
-                                beforeid=buf['have_eid'] - 1,
-                                )
+                            self.backfill_limiter.total_tokens = (
+                                self.backfill_concurrency)
+                            async with self.backfill_limiter, \
+                                    self._get_stream(
+                                        '/chat/backlog',
+                                        cid=buf['cid'],
+                                        bid=buf['bid'],
+                                        num=256,
+                                        beforeid=buf['have_eid'] - 1,
+                                        ) as oob_data:
+                                async for m in oob_data:
+                                    if not oob_data.array:
+                                        failure = m
+                                        break
+                                    if m['bid'] == -1:
+                                        self.log.error('? %s', repr(m))
+                                        continue
+                                    await self.process_message(included, m)
+                                    await imbroglio.switch()
                         except Exception:
                             self.log.exception(
                                 'backfilling %s, try=%d, sleeping',
@@ -452,21 +506,9 @@ class IRCCloud(messages.SnipeBackend, util.HTTP_JSONmixin):
                                 buf['name'], count)
                             continue
                         break
-                    included = []
 
-                    if isinstance(oob_data, dict):
-                        raise Exception(str(oob_data))
-
-                    oldest = buf['have_eid']
-                    self.log.debug('t = %f', oldest / 1000000)
-
-                    await imbroglio.switch()
-                    for m in oob_data:
-                        if m['bid'] == -1:
-                            self.log.error('? %s', repr(m))
-                            continue
-                        await self.process_message(included, m)
-                        await imbroglio.switch()
+                    if failure is not None:
+                        raise Exception(str(failure))
 
                     if len(included) == 0:
                         self.log.debug(
@@ -494,13 +536,13 @@ class IRCCloud(messages.SnipeBackend, util.HTTP_JSONmixin):
                     if included:
                         self.log.debug('merging %d messages', len(included))
                         l = len(self.messages)
-                        self.messages = list(messages.merge(
-                            [self.messages, included]))
+                        # (leaving out any we had, say from the store)
+                        self.messages.merge(included)
                         self.log.debug(
                             'len(self.messages): %d -> %d',
                             l, len(self.messages))
-                        self.drop_cache()
                         self.redisplay(included[0], included[-1])
+                        await self.persist(included)
                 except Exception:
                     self.log.exception('backfilling %s', buf)
                     return
@@ -62,7 +62,9 @@ def main():
         handler.context = context_
         context_.load(options)
 
-        imbroglio.run(main_task(context_, handler, log))
+        # the main task reads the keyboard
+        imbroglio.run(
+            main_task(context_, handler, log), priority=imbroglio.INTERACTIVE)
     except imbroglio.Cancelled:
         pass
     finally:
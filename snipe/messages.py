@@ -35,10 +35,13 @@ Utilities and base classes for dealin with messages.
 
 
 import bisect
+import collections
 import contextlib
 import datetime
 import enum
 import functools
+import heapq
+import itertools
 import logging
 import math
 import time
@@ -48,6 +51,7 @@ from typing import (List, Optional, Sequence, Union)
 from . import chunks
 from . import filters
 from . import imbroglio
+from . import store
 from . import util
 
 
@@ -316,6 +320,12 @@ class SnipeBackend:
         'Indent message bodies with this string (barnowl expats may '
         'wish to set it to eight spaces)')
 
+    # how many stored messages to bring in from disk at a time
+    hydrate_batch = 1024
+    # how many filters walk keeps an index of the matching messages for
+    # (most recently used first; 0 turns them off)
+    filter_indices = 8
+
     def __init__(self, context, name=None, conf={}):
         self.context = context
         logname = self.__class__.__name__
@@ -325,11 +335,20 @@ class SnipeBackend:
         logname += '.%x' % (id(self),)
         self.log = logging.getLogger(logname)
         self.conf = conf
+        self.indexed = None  # the message list the indices are for
+        self.filter_conf = None  # the named filters the caches go with
         self.drop_cache()
         self.tasks = []
         self._destinations = set()
         self._senders = set()
         self._state = BackendState.IDLE
+        # (time, key) of the oldest message brought in from the store
+        self.stored_cursor = None
+        self.stored_exhausted = False
+        self.hydrating = False
+        self.hydrate_task = None
+        # called with this backend when its messages change
+        self.watchers = []
 
     def state(self):
         return self._state
@@ -344,8 +363,77 @@ class SnipeBackend:
         self.supervisor = await imbroglio.get_supervisor()
 
     def drop_cache(self):
+        """Forget what walk knows about which messages filters skip.
+
+        Adding messages doesn't need this (walk notices and only looks
+        at what's new), but changing ones that are there does.
+        """
         self.startcache = {}
         self.adjcache = {}
+        self.indices = collections.OrderedDict()
+
+    def filter_index(self, mfilter):
+        """Return a MessageList of the messages that match mfilter, which
+        is kept up to date as messages are added to self.messages."""
+        if self.messages is not self.indexed:
+            # a different list than last time; start over
+            self.indices.clear()
+            self.indexed = self.messages
+            self.messages.watchers.append(self._index_added)
+        index = self.indices.get(mfilter)
+        if index is None:
+            index = MessageList(m for m in self.messages if mfilter(m))
+            self.indices[mfilter] = index
+            while len(self.indices) > self.filter_indices:
+                self.indices.popitem(last=False)
+        else:
+            self.indices.move_to_end(mfilter)
+        return index
+
+    def _index_added(self, mlist, msgs):
+        if mlist is not self.indexed:
+            return
+        for mfilter, index in self.indices.items():
+            index.update([m for m in msgs if mfilter(m)])
+
+    # The walk caches map (message, direction, filter), or (start,
+    # direction, filter), to links to the next message that matches the
+    # filter, or to the end.  A link is (target, distance, last): target
+    # is the next match (None for the end), distance is how many
+    # messages over it was, and last is the message just before it.  If
+    # last isn't where it was (relative to where we're following the link
+    # from), messages have been added in between and we have to look
+    # again; if only target has moved, we just look at what's been added
+    # after last.
+
+    def _link(self, origin, point, target):
+        distance = abs(point - origin)
+        last = None
+        if distance > 1:
+            last = self.messages[point - (1 if point > origin else -1)]
+        return (target, distance, last)
+
+    def _follow(self, origin, step, link):
+        """Where to carry on looking from after following link."""
+        _, distance, last = link
+        if distance > 1:
+            skipped = origin + step * (distance - 1)
+            if not (0 <= skipped < len(self.messages)
+                    and self.messages[skipped] is last):
+                return origin + step
+        return origin + step * distance
+
+    def _position(self, m, mlist=None):
+        """The index of m (that message, not just one at the same time)
+        in mlist (by default, self.messages), or None."""
+        if mlist is None:
+            mlist = self.messages
+        i = bisect.bisect_left(mlist, m)
+        while i < len(mlist) and mlist[i] == m:
+            if mlist[i] is m:
+                return i
+            i += 1
+        return None
 
     def walk(
             self, start: Union[SnipeMessage, float], forward=True,
@@ -372,12 +460,9 @@ class SnipeBackend:
         redisplay, for date headers and such that want to bypass filters on
         display.
         """
-        # I have some concerns that that this depends on the
-        # self.messages list being stable over the life of the
-        # iterator.  This doesn't seem to be a a problem as of when I
-        # write this comment, but defensive coding should address this
-        # at some point.  (If you are finding this comment because of
-        # weird message list behavior, this might be why...)
+        # Messages can be added to self.messages while we're suspended
+        # (at a yield); we check that the one we yielded is still where
+        # we left it, and find it again if not.
 
         if mfilter is not None:
             mfilter = mfilter.simplify({
@@ -389,64 +474,116 @@ class SnipeBackend:
             if mfilter is True:
                 mfilter = None
 
+        if mfilter is not None:
+            conf = self.context.conf.get('filter', {})
+            if conf != self.filter_conf:
+                # named filters have changed, so what matches might have
+                self.drop_cache()
+                self.filter_conf = dict(conf)
+
+        # without a filter every message is a match, so there's nothing
+        # worth remembering about where the next one is
+        caching = mfilter is not None
         if mfilter is None:
             def mfilter(m):
                 return True
-
-        cachekey = (start, forward, mfilter)
-        point = self.startcache.get(cachekey, None)
+        elif self.filter_indices and isinstance(self.messages, MessageList):
+            yield from self.walk_index(start, forward, mfilter, backfill_to)
+            return
 
         if backfill_to is not None and math.isfinite(backfill_to):
             self.backfill(mfilter, backfill_to)
 
-        needcache = False
-        if point is None:
-            needcache = True
-            left = bisect.bisect_left(self.messages, start)
-            right = bisect.bisect_right(self.messages, start)
-            try:
-                point = self.messages.index(start, left, right)
-            except ValueError:
-                point = None
-
-            if forward:
-                point = point if point is not None else left
-            else:
-                point = point if point is not None else right - 1
+        left = bisect.bisect_left(self.messages, start)
+        right = bisect.bisect_right(self.messages, start)
+        try:
+            point = self.messages.index(start, left, right)
+        except ValueError:
+            point = None
 
         if forward:
-            def getnext(x):
-                return x + 1
+            step = 1
+            point = point if point is not None else left
         else:
-            def getnext(x):
-                return x - 1
+            step = -1
+            point = point if point is not None else right - 1
+
+        # Links are followed from the message (or, for where we start, the
+        # place just before the start) we got to last.
+        origin = point - step
+        link = None
+        if caching:
+            link = self.startcache.get((start, forward, mfilter))
+        if link is not None:
+            point = self._follow(origin, step, link)
+        cache, adjkey = self.startcache, (start, forward, mfilter)
 
         # self.log.debug(
         #     'len(self.messages)=%d, point=%d', len(self.messages), point)
 
-        adjkey = None
-        while self.messages:
+        while 0 <= point < len(self.messages):
             # self.log.debug(', point=%d', point)
-            if not 0 <= point < len(self.messages):
-                break
             m = self.messages[point]
             if mfilter(m):
-                if needcache:
-                    self.startcache[cachekey] = point
-                    needcache = False
+                if caching:
+                    cache[adjkey] = self._link(origin, point, m)
                 yield m
-                if adjkey is not None:
-                    self.adjcache[adjkey] = point
-                adjkey = (m, forward, mfilter)
-            point = self.adjcache.get(adjkey, getnext(point))
-
-        if adjkey is not None:
-            self.adjcache[adjkey] = point
+                if not (0 <= point < len(self.messages)
+                        and self.messages[point] is m):
+                    # the list changed under us
+                    point = self._position(m)
+                    if point is None:
+                        return
+                origin = point
+                if caching:
+                    cache, adjkey = self.adjcache, (m, forward, mfilter)
+                    link = cache.get(adjkey)
+                    if link is not None:
+                        point = self._follow(origin, step, link)
+                        continue
+            point += step
+
+        if caching:
+            cache[adjkey] = self._link(origin, point, None)
 
         # specifically catch the situation where we're trying to go off the top
         if point < 0 and backfill_to is not None:
             self.backfill(mfilter, backfill_to)
 
+    def walk_index(self, start, forward, mfilter, backfill_to):
+        """walk, for a filter, using filter_index to get from one match to
+        the next in O(log n)."""
+        if backfill_to is not None and math.isfinite(backfill_to):
+            self.backfill(mfilter, backfill_to)
+
+        index = self.filter_index(mfilter)
+        i = index.bisect_left(start)
+        if forward:
+            step = 1
+        else:
+            step = -1
+            # start from start itself if it's here and matches, but
+            # otherwise from what's before it, as walk would
+            left = bisect.bisect_left(self.messages, start)
+            if not (i < len(index) and left < len(self.messages)
+                    and self.messages[left] == start
+                    and index[i] is self.messages[left]):
+                i -= 1
+
+        while 0 <= i < len(index):
+            m = index[i]
+            yield m
+            if not (0 <= i < len(index) and index[i] is m):
+                # messages were added while we were out
+                i = self._position(m, index)
+                if i is None:
+                    return
+            i += step
+
+        # specifically catch the situation where we're trying to go off the top
+        if i < 0 and backfill_to is not None:
+            self.backfill(mfilter, backfill_to)
+
     def earliest(self):
         """Probably returns the earliest message in the backend.  Might return
         a magic cookie saying start from the beginning."""
@@ -466,6 +603,106 @@ class SnipeBackend:
     def backfill(self, mfilter, target=None):
         pass
 
+    def store_key(self, msg):
+        """Return what msg is kept under in the message store, or None if
+        it shouldn't be kept.
+
+        Backends that keep their messages override this and
+        message_from_store; store_data(msg) is what gets stored.
+        """
+        return None
+
+    def store_data(self, msg):
+        """Return what to keep of msg in the message store, which has to
+        survive being turned into JSON."""
+        return msg.data
+
+    async def message_from_store(self, data):
+        """Make a message out of data from the message store."""
+        raise NotImplementedError
+
+    async def persist(self, msgs):
+        """Write (or rewrite) msgs to the message store, if it's on."""
+        messagestore = store.message_store()
+        if messagestore.path is None:
+            return
+        rows = []
+        for msg in msgs:
+            key = self.store_key(msg)
+            if key is not None:
+                rows.append((key, msg.time, self.store_data(msg)))
+        if not rows:
+            return
+        try:
+            await imbroglio.run_in_thread(messagestore.save, self.name, rows)
+        except Exception:
+            self.log.exception('storing %d messages', len(rows))
+
+    async def hydrate(self):
+        """Bring in the next batch of stored messages, going backwards from
+        the latest, and merge them into self.messages.
+
+        Returns the messages that were added, which is empty once the
+        store has nothing more (see stored_exhausted).
+        """
+        messagestore = store.message_store()
+        if (messagestore.path is None or self.stored_exhausted
+                or self.hydrating):
+            return []
+        self.hydrating = True
+        try:
+            rows = await imbroglio.run_in_thread(
+                messagestore.load, self.name, self.stored_cursor,
+                self.hydrate_batch)
+            if len(rows) < self.hydrate_batch:
+                self.stored_exhausted = True
+            if not rows:
+                return []
+            key, when, _ = rows[0]
+            self.stored_cursor = (when, key)
+
+            # only messages from about the same time can be the same
+            # (times get nudged a little to keep the list in order)
+            lo = bisect.bisect_left(self.messages, rows[0][1] - 1)
+            hi = bisect.bisect_right(self.messages, rows[-1][1] + 1)
+            have = {str(self.store_key(m)) for m in self.messages[lo:hi]}
+            msgs = []
+            for key, when, data in rows:
+                if key in have:
+                    continue
+                try:
+                    msg = await self.message_from_store(data)
+                except Exception:
+                    self.log.exception('loading stored message %s', key)
+                    continue
+                msg.time = when  # as adjusted to keep the list in order
+                msgs.append(msg)
+            self.log.debug(
+                'loaded %d stored messages (of %d)', len(msgs), len(rows))
+            if msgs:
+                self.messages.update(msgs)
+                self.redisplay(msgs[0], msgs[-1])
+            return msgs
+        except Exception:
+            self.log.exception('loading stored messages')
+            self.stored_exhausted = True
+            return []
+        finally:
+            self.hydrating = False
+
+    def backfill_stored(self):
+        """If there are stored messages that haven't been loaded, start
+        loading the next batch and return True, so that backfill can leave
+        the network alone until we've run out."""
+        if store.message_store().path is None or self.stored_exhausted:
+            return False
+        if self.hydrate_task is None or self.hydrate_task.is_done():
+            self.reap_tasks()
+            self.hydrate_task = self.supervisor.start(
+                self.hydrate(), imbroglio.BACKGROUND)
+            self.tasks.append(self.hydrate_task)
+        return True
+
     async def shutdown(self):
         tasks = list(reversed(self.tasks))
         for t in tasks:
@@ -488,7 +725,14 @@ class SnipeBackend:
         """
         self.tasks = [t for t in self.tasks if not t.is_done()]
 
+    def changed(self):
+        """Let the watchers know that messages have changed (been edited,
+        or moved, as opposed to just added)."""
+        for watcher in self.watchers:
+            watcher(self)
+
     def redisplay(self, m1, m2):
+        self.changed()
         try:
             self.context.ui.redisplay({'messages': (m1, m2)})
         except Exception:
@@ -524,11 +768,10 @@ class SinkBackend(SnipeBackend):
 
     def __init__(self, *args, **kw):
         super().__init__(*args, **kw)
-        self.messages = []
+        self.messages = MessageList()
 
     async def send(self, recipient, body):
         self.messages.append(SnipeMessage(self, body))
-        self.drop_cache()
 
 
 class InfoMessage(SnipeMessage):
@@ -661,28 +904,234 @@ class DateBackend(SnipeBackend):
 
 
 def merge(iterables, key=lambda x: x):
-    # get the first item from all the iterables
-    d = {}
+    """Merge the sorted iterables by key, lazily, leaving out anything
+    equal to what was just yielded.  Ties go to the earlier iterable.
+
+    While one iterable stays ahead of all the others it's read from
+    directly, without going back through the heap.
+    """
+    heap = []
+    for i, it in enumerate(iterables):
+        it = iter(it)
+        for v in it:
+            heap.append((key(v), i, v, it))
+            break
+    heapq.heapify(heap)
 
     last = None
 
-    for it in iterables:
-        it = iter(it)
-        try:
-            d[it] = next(it)
-        except StopIteration:
-            pass
+    while heap:
+        _, i, v, it = heap[0]
+        # the next smallest is one of the top's children
+        runner_up = min(heap[1:3], default=None)
+        while True:
+            if not v == last:
+                last = v
+                yield v
+            try:
+                v = next(it)
+            except StopIteration:
+                heapq.heappop(heap)
+                break
+            k = key(v)
+            if runner_up is not None and (k, i) > runner_up[:2]:
+                heapq.heapreplace(heap, (k, i, v, it))
+                break
 
-    while d:
-        it, v = min(d.items(), key=lambda x: key(x[1]))
-        try:
-            d[it] = next(it)
-        except StopIteration:
-            del d[it]
-        if v == last:
-            continue
-        last = v
-        yield v
+
+class MessageList:
+    """
+    A sorted sequence of messages, kept in blocks so that adding a page of
+    messages at the front (or anywhere else) doesn't copy the whole
+    history.
+
+    It does enough of what a list does for walk (len, indexing, slicing,
+    bisect, index and in), but it stays sorted: append and extend put
+    messages where they belong.  Messages' times can be changed in place
+    as long as that doesn't change the order (otherwise, sort).
+    """
+
+    BLOCK = 512  # blocks are split when they get to twice this
+
+    def __init__(self, iterable=()):
+        self._blocks = []
+        self._maxes = []  # the last message of each block
+        self._offsets = None  # index of the first of each block, as needed
+        self._len = 0
+        # called with (this list, [the messages]) when messages are added
+        self.watchers = []
+        self.update(iterable)
+
+    def __len__(self):
+        return self._len
+
+    def __iter__(self):
+        return itertools.chain.from_iterable(self._blocks)
+
+    def __reversed__(self):
+        return itertools.chain.from_iterable(
+            reversed(block) for block in reversed(self._blocks))
+
+    def __repr__(self):
+        return '%s(%r)' % (self.__class__.__name__, list(self))
+
+    def __eq__(self, other):
+        if isinstance(other, (MessageList, list)):
+            return list(self) == list(other)
+        return NotImplemented
+
+    def _index(self):
+        if self._offsets is None:
+            self._offsets = [0]
+            self._offsets.extend(itertools.accumulate(
+                len(block) for block in self._blocks[:-1]))
+        return self._offsets
+
+    def _locate(self, i):
+        if i < 0:
+            i += self._len
+        if not 0 <= i < self._len:
+            raise IndexError('MessageList index out of range')
+        offsets = self._index()
+        b = bisect.bisect_right(offsets, i) - 1
+        return b, i - offsets[b]
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            start, stop, step = i.indices(self._len)
+            if step != 1:
+                return [self[j] for j in range(start, stop, step)]
+            return list(self._iter_from(start, stop - start))
+        b, j = self._locate(i)
+        return self._blocks[b][j]
+
+    def _iter_from(self, start, count):
+        if count <= 0:
+            return
+        b, j = self._locate(start)
+        for block in itertools.islice(self._blocks, b, None):
+            for m in itertools.islice(block, j, j + count):
+                yield m
+                count -= 1
+            if not count:
+                return
+            j = 0
+
+    def bisect_left(self, x):
+        b = bisect.bisect_left(self._maxes, x)
+        if b == len(self._blocks):
+            return self._len
+        return self._index()[b] + bisect.bisect_left(self._blocks[b], x)
+
+    def bisect_right(self, x):
+        b = bisect.bisect_right(self._maxes, x)
+        if b == len(self._blocks):
+            return self._len
+        return self._index()[b] + bisect.bisect_right(self._blocks[b], x)
+
+    def __contains__(self, x):
+        i = self.bisect_left(x)
+        return i < self._len and self[i] == x
+
+    def index(self, x, start=0, stop=None):
+        if stop is None or stop > self._len:
+            stop = self._len
+        if start < 0:
+            start = max(0, start + self._len)
+        for i, m in enumerate(self._iter_from(start, stop - start), start):
+            if m == x:
+                return i
+        raise ValueError('%r is not in MessageList' % (x,))
+
+    def append(self, msg):
+        """Add msg in its place (after any it compares equal to)."""
+        self._add(msg)
+        self._added([msg])
+
+    def update(self, msgs):
+        """Add msgs in their places."""
+        msgs = sorted(msgs)
+        if msgs:
+            self._update(msgs)
+            self._added(msgs)
+
+    def _added(self, msgs):
+        for watcher in self.watchers:
+            watcher(self, msgs)
+
+    def _add(self, msg):
+        if not self._blocks:
+            self._blocks.append([msg])
+            self._maxes.append(msg)
+            self._offsets = None
+            self._len = 1
+            return
+        b = bisect.bisect_right(self._maxes, msg)
+        if b == len(self._blocks):
+            b -= 1
+            self._blocks[b].append(msg)
+            self._maxes[b] = msg
+        else:
+            bisect.insort_right(self._blocks[b], msg)
+            self._offsets = None
+        self._len += 1
+        if len(self._blocks[b]) >= 2 * self.BLOCK:
+            block = self._blocks[b]
+            self._blocks[b:b + 1] = [block[:self.BLOCK], block[self.BLOCK:]]
+            self._maxes[b:b + 1] = [block[self.BLOCK - 1], block[-1]]
+            self._offsets = None
+
+    def _update(self, msgs):
+        chunks = [
+            msgs[i:i + self.BLOCK] for i in range(0, len(msgs), self.BLOCK)]
+        if not self._blocks or not msgs[0] < self._maxes[-1]:
+            if (self._blocks
+                    and len(self._blocks[-1]) + len(msgs) < 2 * self.BLOCK):
+                self._blocks[-1].extend(msgs)
+                self._maxes[-1] = msgs[-1]
+                self._len += len(msgs)
+                return  # no block has moved
+            self._blocks.extend(chunks)
+            self._maxes.extend(chunk[-1] for chunk in chunks)
+        elif msgs[-1] < self._blocks[0][0]:
+            if len(self._blocks[0]) + len(msgs) < 2 * self.BLOCK:
+                self._blocks[0][0:0] = msgs
+            else:
+                self._blocks[0:0] = chunks
+                self._maxes[0:0] = [chunk[-1] for chunk in chunks]
+        elif len(msgs) > self._len:
+            self._rebuild(sorted(itertools.chain(self, msgs)))
+            return
+        else:
+            for msg in msgs:
+                self._add(msg)
+            return
+        self._len += len(msgs)
+        self._offsets = None
+
+    extend = update
+
+    def merge(self, msgs):
+        """Add msgs, leaving out any that compare equal to a message that's
+        already here (or to each other), as merge() would."""
+        new = []
+        for msg in sorted(msgs):
+            if (new and new[-1] == msg) or msg in self:
+                continue
+            new.append(msg)
+        self.update(new)
+        return new
+
+    def sort(self):
+        """Put things right after messages' times have changed order."""
+        self._rebuild(sorted(self))
+
+    def _rebuild(self, msgs):
+        self._blocks = [
+            msgs[i:i + self.BLOCK] for i in range(0, len(msgs), self.BLOCK)]
+        self._maxes = [block[-1] for block in self._blocks]
+        self._offsets = None
+        self._len = len(msgs)
 
 
 class AggregatorBackend(SnipeBackend):
@@ -696,6 +1145,32 @@ class AggregatorBackend(SnipeBackend):
         self.backends = [TerminusBackend(self.context)]
         for backend in backends:
             self.backends.append(backend)
+        # earliest, latest and eldest, until something changes
+        self.extremes = {}
+        self.watched = 0  # how many of self.backends we're watching
+
+    def forget_extremes(self, *args):
+        self.extremes.clear()
+
+    def extreme(self, name, compute):
+        """Return the cached value of compute(), calling it if need be."""
+        if self.watched != len(self.backends):
+            # backends have been added
+            for backend in self.backends:
+                if self.forget_extremes not in backend.watchers:
+                    backend.watchers.append(self.forget_extremes)
+            self.watched = len(self.backends)
+            self.forget_extremes()
+        if name not in self.extremes:
+            # notice messages being added to any of the backends (even
+            # if they've been given a new list since the last time)
+            for backend in self.backends:
+                mlist = backend.messages
+                if (isinstance(mlist, MessageList)
+                        and self.forget_extremes not in mlist.watchers):
+                    mlist.watchers.append(self.forget_extremes)
+            self.extremes[name] = compute()
+        return self.extremes[name]
 
     async def start(self):
         self.started = True
@@ -730,6 +1205,9 @@ class AggregatorBackend(SnipeBackend):
             key=lambda m: m.time if forward else -m.time)
 
     def earliest(self):
+        return self.extreme('earliest', self._earliest)
+
+    def _earliest(self):
         l = list(filter(
             lambda x: x is not None,
             (backend.earliest() for backend in self.backends)))
@@ -739,6 +1217,9 @@ class AggregatorBackend(SnipeBackend):
             return None
 
     def latest(self):
+        return self.extreme('latest', self._latest)
+
+    def _latest(self):
         l = list(filter(
             lambda x: x is not None,
             (backend.latest() for backend in self.backends)))
@@ -788,6 +1269,9 @@ class AggregatorBackend(SnipeBackend):
             *(backend.senders() for backend in self.backends))
 
     def eldest(self):
+        return self.extreme('eldest', self._eldest)
+
+    def _eldest(self):
         data = [backend.eldest() for backend in self.backends]
         filtered = [t for t in data if t is not None and not math.isinf(t)]
         if filtered:
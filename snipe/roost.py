@@ -104,9 +104,13 @@ class Roost(messages.SnipeBackend):
 
     def __init__(self, *args, **kw):
         super().__init__(*args, **kw)
-        self.messages = []
+        self.messages = messages.MessageList()
         self.r = _rooster.Rooster(self.url, self.service_name)
         self.chunksize = 128
+        # between the websocket reader and decryption, so a slow zcrypt
+        # doesn't keep us from answering pings
+        self.incoming = imbroglio.Queue(1024)
+        self.queued_id = None
         self.loaded = False
         self.backfilling = False
         self.connected = False
@@ -118,8 +122,11 @@ class Roost(messages.SnipeBackend):
         await super().start()
         self.new_task = await imbroglio.spawn(self.new_messages())
         self.tasks.append(self.new_task)
+        self.tasks.append(await imbroglio.spawn(self.process_incoming()))
 
     async def new_messages(self):
+        # pick up where we left off last time
+        await self.hydrate()
         while True:
             for m in reversed(self.messages):
                 start = m.data.get('id')
@@ -127,6 +134,9 @@ class Roost(messages.SnipeBackend):
                     break
             else:
                 start = None
+            if self.queued_id is not None:
+                # messages that are read but still waiting to be processed
+                start = self.queued_id
 
             errmsg = None
             activity = 'getting new messages from %s' % self.url
@@ -135,7 +145,7 @@ class Roost(messages.SnipeBackend):
                 self.log.debug(activity)
                 self.state_set(messages.BackendState.CONNECTING)
                 await self.r.newmessages(
-                    self.new_message, start,
+                    self.queue_message, start,
                     connected_coro=self.state_connected
                     )
             except _rooster.RoosterReconnectException as e:
@@ -261,18 +271,40 @@ class Roost(messages.SnipeBackend):
             result = await self.r.send(message)
             self.log.info('sent to %s: %s', recipient, repr(result))
 
+    async def queue_message(self, m):
+        self.queued_id = m.get('id', self.queued_id)
+        await self.incoming.put(m)
+
+    async def process_incoming(self):
+        while True:
+            msgs = []
+            for m in (await self.incoming.get_many()):
+                try:
+                    msgs.append(await self.new_message(m))
+                except Exception:
+                    self.log.exception('processing %s', repr(m))
+            await self.persist(msgs)
+
     async def new_message(self, m):
         msg = await self.construct_and_maybe_decrypt(m)
         self.add_message(msg)
         await imbroglio.switch()
+        return msg
 
     def add_message(self, msg):
         if self.messages and msg.time <= self.messages[-1].time:
             msg.time = self.messages[-1].time + .00001
         self.messages.append(msg)
-        self.drop_cache()
         self.redisplay(msg, msg)
 
+    def store_key(self, msg):
+        if isinstance(msg, RoostMessage):
+            return msg.data.get('id')
+        return None
+
+    async def message_from_store(self, data):
+        return await self.construct_and_maybe_decrypt(data)
+
     async def construct_and_maybe_decrypt(self, m):
         msg = RoostMessage(self, m)
         try:
@@ -303,8 +335,7 @@ class Roost(messages.SnipeBackend):
             'backfill([filter], target=%s, count=%s, origin=%s)',
             util.timestr(target), count, util.timestr(origin))
 
-        # if we're not gettting new messages, don't try to get old ones
-        if not self.connected or self.loaded or target is None:
+        if target is None:
             return
 
         filledpoint = self.messages[0].time if self.messages else time.time()
@@ -314,6 +345,13 @@ class Roost(messages.SnipeBackend):
                 '%s < %s', util.timestr(filledpoint), util.timestr(target))
             return
 
+        if self.backfill_stored():
+            return
+
+        # if we're not gettting new messages, don't try to get old ones
+        if not self.connected or self.loaded:
+            return
+
         target = max(target, filledpoint - self.backfill_length)
 
         self.log.debug('triggering backfill, target=%s', util.timestr(target))
@@ -328,7 +366,8 @@ class Roost(messages.SnipeBackend):
         self.tasks.append(
             self.supervisor.start(self.error_message(
                 'backfilling',
-                self.do_backfill, msgid, mfilter, target, count, origin)))
+                self.do_backfill, msgid, mfilter, target, count, origin),
+                imbroglio.BACKGROUND))
 
     async def do_backfill(self, start, mfilter, target, count, origin):
         self.log.debug(
@@ -385,8 +424,8 @@ class Roost(messages.SnipeBackend):
                     if nextmsg.time == prevmsg.time:
                         prevmsg.time = nextmsg.time - .00001
                 ms.reverse()
-                self.messages = ms + self.messages
-                self.drop_cache()
+                self.messages.update(ms)
+                await self.persist(ms)
                 self.log.debug(
                     '%d messages, total %d, earliest %s',
                     count,
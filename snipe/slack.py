@@ -111,6 +111,11 @@ class Slack(messages.SnipeBackend, util.HTTP_JSONmixin):
         'log.slack', 'Slack',
         doc='loglevel for slack backend')
 
+    backfill_concurrency = util.Configurable(
+        'slack.backfill_concurrency', 8,
+        'how many channels to backfill at once',
+        coerce=int)
+
     IGNORED_TYPES = (
         'hello', 'user_typing', 'channel_marked', 'pref_change', 'file_public',
         'file_shared', 'file_created', 'accounts_changed', 'im_marked',
@@ -134,12 +139,14 @@ class Slack(messages.SnipeBackend, util.HTTP_JSONmixin):
         self.dests = {}
         self.users = {}
         self.connected = False
-        self.messages = []
+        self.messages = messages.MessageList()
         self.nextid = itertools.count().__next__
         self.used_emoji = []
         self.websocket = None
         self.setup_client_session()
         self.backfiller_count = 0
+        self.backfill_limiter = imbroglio.CapacityLimiter(
+            self.backfill_concurrency)
 
     async def start(self):
         await super().start()
@@ -185,9 +192,13 @@ class Slack(messages.SnipeBackend, util.HTTP_JSONmixin):
                         for t in ['user', 'bot', 'im', 'group', 'channel']
                         ), []))
 
+                    # now that we can make sense of them
+                    if self.stored_cursor is None:
+                        await self.hydrate()
+
                 self.log.debug('websocket url is %s', url)
 
-                self.websocket = util.JSONWebSocket(self.log)
+                self.websocket = util.JSONWebSocket(self.log, self.name)
                 try:
                     await self.websocket.connect(url)
                     backoff = 0
@@ -254,10 +265,13 @@ class Slack(messages.SnipeBackend, util.HTTP_JSONmixin):
             if x.type in ('user', 'bot'))
 
     async def incoming(self, m):
+        count = len(self.messages)
         msg = await self.process_message(self.messages, m)
         if msg is not None:
-            self.drop_cache()
+            if len(self.messages) == count:
+                self.drop_cache()  # it was an edit, or a reaction
             self.redisplay(msg, msg)
+            await self.persist([msg])
 
     def find_message(self, when, m):
         try:
@@ -355,6 +369,21 @@ class Slack(messages.SnipeBackend, util.HTTP_JSONmixin):
         messagelist.append(msg)
         return msg
 
+    def store_key(self, msg):
+        if not isinstance(msg, SlackMessage) or 'ts' not in msg.data:
+            return None
+        # edited messages have the channel in the event that edited them
+        channel = msg.data.get('channel') or msg.data.get('_new', {}).get(
+            'channel')
+        if channel is None:
+            return None
+        return f'{channel} {msg.data["ts"]}'
+
+    async def message_from_store(self, data):
+        if 'channel' not in data:
+            data['channel'] = data.get('_new', {}).get('channel')
+        return SlackMessage(self, data)
+
     async def emoji_update(self):
         self.log.debug('attempting to retrieve emoji')
         self.emoji = await self.method('emoji.list')
@@ -385,8 +414,10 @@ class Slack(messages.SnipeBackend, util.HTTP_JSONmixin):
     def backfill(self, mfilter, target=None):
         if not self.connected:
             return
-        self.tasks.append(
-            self.supervisor.start(self.do_backfill(mfilter, target)))
+        if self.backfill_stored():
+            return
+        self.tasks.append(self.supervisor.start(
+            self.do_backfill(mfilter, target), imbroglio.BACKGROUND))
 
     async def do_backfill(self, mfilter, target):
         self.log.debug('backfill([filter], %s)', repr(target))
@@ -397,7 +428,8 @@ class Slack(messages.SnipeBackend, util.HTTP_JSONmixin):
 
             backfillers = [
                 (await imbroglio.spawn(
-                    self.do_backfill_dest(name, mfilter, target)))
+                    self.do_backfill_dest(name, mfilter, target),
+                    imbroglio.BACKGROUND))
                 for (name, dest) in self.dests.items()
                 if dest.loadable and not dest.loaded]
             self.tasks += backfillers
@@ -435,7 +467,11 @@ class Slack(messages.SnipeBackend, util.HTTP_JSONmixin):
             else:
                 kwargs = {}
 
-            data = await self.method(d.history_method, channel=dest, **kwargs)
+            # there can be hundreds of these, don't do them all at once
+            self.backfill_limiter.total_tokens = self.backfill_concurrency
+            async with self.backfill_limiter:
+                data = await self.method(
+                    d.history_method, channel=dest, **kwargs)
 
             if not self.check_ok(data, 'backfilling %s', dest):
                 return
@@ -451,10 +487,10 @@ class Slack(messages.SnipeBackend, util.HTTP_JSONmixin):
                     self.log.exception('processing message: %s', repr(m))
                     raise
             self.log.debug('%s: got %d messages', dest, len(messagelist))
-            self.messages = list(messages.merge([self.messages, messagelist]))
-            self.drop_cache()
+            self.messages.merge(messagelist)
             if messagelist:
                 self.redisplay(messagelist[0], messagelist[-1])
+            await self.persist(messagelist)
         finally:
             self.backfiller_count -= 1
             if self.backfiller_count == 0:
@@ -505,10 +541,14 @@ class Slack(messages.SnipeBackend, util.HTTP_JSONmixin):
 
         self.check_ok(response, 'sending message to %s', inrecipient)
 
+    # API methods that only read, so concurrent identical calls can share
+    READ_ONLY = ('.history', '.info', '.list', '.replies')
+
     async def method(self, method, **kwargs):
         msg = dict(kwargs)
         msg['token'] = self.token
-        return (await self._post(method, **msg))
+        return (await self._post(
+            method, _coalesce=method.endswith(self.READ_ONLY), **msg))
 
     def check_ok(self, response, context, *args):
         # maybe should be doing this with exceptions
@@ -520,7 +560,6 @@ class Slack(messages.SnipeBackend, util.HTTP_JSONmixin):
                 self,
                 str(error) + '\n' + repr(response),
                 ))
-            self.drop_cache()
             return False
         return True
 
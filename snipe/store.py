@@ -0,0 +1,160 @@
+# -*- encoding: utf-8 -*-
+# Copyright © 2026 the Snipe contributors
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+#
+# 1. Redistributions of source code must retain the above copyright
+# notice, this list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above
+# copyright notice, this list of conditions and the following
+# disclaimer in the documentation and/or other materials provided
+# with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND
+# CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES,
+# INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS
+# BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+# EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED
+# TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+# DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON
+# ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR
+# TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF
+# THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF
+# SUCH DAMAGE.
+
+
+'''
+snipe.store
+-----------
+
+Keeps the raw data of backends' messages on disk, so that snipe can
+start with what it had last time and only ask servers for what's new.
+'''
+
+
+import json
+import logging
+import os
+import sqlite3
+import threading
+
+from . import util
+
+
+class MessageStore:
+    """
+    Messages, as (key, time, data) for each backend, in an SQLite
+    database.  key is whatever identifies a message to the backend
+    (storing a message with the same key again replaces it), time is
+    when the message sorts, and data is anything json can encode.
+
+    The methods block, so call them with imbroglio.run_in_thread.
+    """
+
+    SCHEMA = '''
+        CREATE TABLE IF NOT EXISTS messages (
+            backend TEXT NOT NULL,
+            key TEXT NOT NULL,
+            time REAL NOT NULL,
+            data TEXT NOT NULL,
+            PRIMARY KEY (backend, key));
+        CREATE INDEX IF NOT EXISTS messages_time
+            ON messages (backend, time, key);
+        '''
+
+    def __init__(self, path=None):
+        self.log = logging.getLogger('MessageStore')
+        self.lock = threading.Lock()
+        self._db = None
+        self._path = path
+
+    @property
+    def path(self):
+        """Where the database is, or None if we aren't storing messages."""
+        return self._path
+
+    @path.setter
+    def path(self, path):
+        if path != self._path:
+            self.close()
+            self._path = path
+
+    @property
+    def db(self):
+        if self._db is None:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, mode=0o700, exist_ok=True)
+            # make sure nobody else can read it before sqlite creates it
+            os.close(os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600))
+            self._db = sqlite3.connect(self.path, check_same_thread=False)
+            self._db.execute('PRAGMA journal_mode=WAL')
+            self._db.executescript(self.SCHEMA)
+            self.log.debug('opened %s', self.path)
+        return self._db
+
+    def save(self, backend, rows):
+        """Store (key, time, data) rows for backend."""
+        with self.lock, self.db as db:
+            db.executemany(
+                'INSERT OR REPLACE INTO messages VALUES (?, ?, ?, ?)',
+                ((backend, str(key), when, json.dumps(data))
+                 for (key, when, data) in rows))
+
+    def load(self, backend, before=None, limit=1024):
+        """
+        Return up to limit of backend's (key, time, data) rows, oldest
+        first, that come just before before (a (time, key) from a
+        previous row) or are the latest if before is None.
+        """
+        query = 'SELECT key, time, data FROM messages WHERE backend = ?'
+        args = [backend]
+        if before is not None:
+            query += ' AND (time, key) < (?, ?)'
+            args += before
+        query += ' ORDER BY time DESC, key DESC LIMIT ?'
+        args.append(limit)
+        with self.lock:
+            rows = self.db.execute(query, args).fetchall()
+        return [(key, when, json.loads(data)) for (key, when, data) in (
+            reversed(rows))]
+
+    def count(self, backend):
+        with self.lock:
+            (n,), = self.db.execute(
+                'SELECT count(*) FROM messages WHERE backend = ?', (backend,))
+        return n
+
+    def close(self):
+        with self.lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
+
+
+_message_store = None
+
+
+def message_store():
+    """Return the process-wide MessageStore, creating it if need be."""
+    global _message_store
+    if _message_store is None:
+        _message_store = MessageStore()
+    return _message_store
+
+
+util.Configurable(
+    'message.store', True,
+    'keep messages (in messages.sqlite in the snipe directory) so that'
+    ' starting up only has to fetch what\'s new',
+    coerce=util.coerce_bool,
+    action=lambda context, value: setattr(
+        message_store(), 'path',
+        os.path.join(context.directory, 'messages.sqlite') if value
+        else None))
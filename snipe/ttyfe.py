@@ -587,7 +587,7 @@ class TTYFrontend:
         return TTYRenderer(self, *args, **kw)
 
     def sigwinch(self, signum, frame):
-        self.supervisor.start(self.perform_resize())
+        self.supervisor.start(self.perform_resize(), imbroglio.INTERACTIVE)
 
     def sigint(self, signum, frame):
         from . import window
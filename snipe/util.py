@@ -35,15 +35,24 @@ Assorted utility functions.
 '''
 
 
+import bisect
+import codecs
+import collections
 import contextlib
+import copy
 import ctypes
 import datetime
+import email.utils
+import errno
+import hashlib
 import importlib
+import itertools
 import json
 import functools
 import logging
 import math
 import os
+import re
 import socket
 import ssl
 import sys
@@ -327,6 +336,470 @@ class JSONDecodeError(SnipeException):
         return str(self.data)
 
 
+class JSONArrayDecoder:
+    """
+    Incrementally decode a JSON document that is usually a top-level
+    array, handing back each element as soon as all of it has arrived.
+
+    Anything else is buffered and decoded whole at the end; array tells
+    you which happened.
+    """
+
+    WHITESPACE = re.compile(r'[ \t\n\r]*')
+
+    def __init__(self):
+        self.decoder = codecs.getincrementaldecoder('utf-8')()
+        self.json = json.JSONDecoder()
+        self.buf = ''
+        self.state = 'start'  # start, first, value, separator, done, other
+
+    @property
+    def array(self):
+        return self.state not in ('start', 'other')
+
+    def feed(self, data, final=False):
+        """Take some more bytes, return a list of the elements finished."""
+        buf = self.buf = self.buf + self.decoder.decode(data, final)
+        items = []
+        pos = 0
+        while self.state != 'other':
+            pos = self.WHITESPACE.match(buf, pos).end()
+            if pos == len(buf):
+                break
+            if self.state == 'start':
+                if buf[pos] != '[':
+                    self.state = 'other'
+                    break
+                self.state = 'first'
+                pos += 1
+            elif self.state == 'first' and buf[pos] == ']':
+                self.state = 'done'
+                pos += 1
+            elif self.state in ('first', 'value'):
+                try:
+                    item, end = self.json.raw_decode(buf, pos)
+                except ValueError:
+                    if final:
+                        raise
+                    break  # presumably we don't have all of it yet
+                if end == len(buf) and buf[-1] not in '"]}' and not final:
+                    break  # a number might not be finished
+                items.append(item)
+                self.state = 'separator'
+                pos = end
+            elif self.state == 'separator' and buf[pos] in ',]':
+                self.state = 'value' if buf[pos] == ',' else 'done'
+                pos += 1
+            else:
+                raise ValueError(
+                    f'unexpected {buf[pos]!r} at {pos} in JSON array')
+        self.buf = buf[pos:]
+        if final:
+            if self.state == 'other':
+                items.append(json.loads(self.buf))
+            elif self.state != 'done':
+                raise ValueError('JSON array cut short')
+        return items
+
+
+class JSONStream:
+    """
+    Async iterator over the elements of a JSON array in an HTTP response,
+    as they arrive.  (If the response isn't an array, the one thing it
+    is comes out instead, and .array is False.)  Should be closed, as an
+    async context manager or with close().
+    """
+
+    def __init__(self, request, log):
+        self.request = request  # a coroutine that returns an HTTP
+        self.log = log
+        self.response = None
+        self.decoder = JSONArrayDecoder()
+        self.pending = collections.deque()
+        self.eof = False
+
+    @property
+    def array(self):
+        return self.decoder.array
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.close()
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        while not self.pending:
+            if self.eof:
+                raise StopAsyncIteration
+            if self.response is None:
+                self.response = await self.request
+            b = await self.response.readsome()
+            self.eof = b is None
+            try:
+                self.pending.extend(
+                    self.decoder.feed(b or b'', final=self.eof))
+            except (UnicodeError, ValueError) as e:
+                self.eof = True
+                data = self.decoder.buf
+                self.log.error(
+                    'json %s from %s on %s',
+                    e.__class__.__name__, self.response.url, repr(data))
+                raise JSONDecodeError(repr(data)) from e
+        return self.pending.popleft()
+
+    async def close(self):
+        self.eof = True
+        if self.response is not None:
+            await self.response.close()
+        else:
+            self.request.close()
+
+
+class _Abandoned(Exception):
+    """The call a SingleFlight caller was waiting on was cancelled."""
+
+
+class SingleFlight:
+    """
+    Let only one of any given call be in progress at a time: callers that
+    turn up while it's running wait for it and get (a copy of) its result
+    or exception instead of doing the work again.
+    """
+
+    def __init__(self):
+        self.flights = {}  # key -> [Promise] of the callers waiting
+
+        self.calls = 0
+        self.shared = 0
+
+    async def run(self, key, func, *args, **kwargs):
+        while key in self.flights:
+            p = imbroglio.Promise()
+            waiting = self.flights[key]
+            waiting.append(p)
+            try:
+                result = await p
+            except _Abandoned:
+                continue  # go again, possibly ourselves
+            finally:
+                # if we were cancelled or timed out, the result mustn't
+                # wake us out of whatever we're doing next
+                with contextlib.suppress(ValueError):
+                    waiting.remove(p)
+            self.shared += 1
+            return copy.deepcopy(result)
+
+        self.calls += 1
+        waiting = self.flights[key] = []
+        try:
+            result = await func(*args, **kwargs)
+        except Exception as e:
+            for p in waiting:
+                p.set_result_exception(e)
+            raise
+        except BaseException:
+            for p in waiting:
+                p.set_result_exception(_Abandoned())
+            raise
+        else:
+            for p in waiting:
+                p.set_result(result)
+        finally:
+            del self.flights[key]
+        return result
+
+    def stats(self):
+        return {
+            'calls': self.calls,
+            'shared': self.shared,
+            'in flight': len(self.flights),
+            }
+
+
+_single_flight = None
+
+
+def single_flight():
+    """Return the process-wide SingleFlight, creating it if need be."""
+    global _single_flight
+    if _single_flight is None:
+        _single_flight = SingleFlight()
+    return _single_flight
+
+
+class TokenBucket:
+    """
+    Let requests through at no more than rate per second, allowing bursts
+    of up to burst.  A rate of None means no limit.  The server can also
+    tell us to hold off entirely for a while (see hold).
+    """
+
+    def __init__(self, rate=None, burst=1):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.last = time.monotonic()
+        self.held_until = 0.0
+
+        self.waited = 0.0
+        self.holds = 0
+
+    def refill(self, now):
+        if self.rate is not None:
+            self.tokens = min(
+                self.burst, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+
+    def delay(self):
+        """How long until a request may go, or 0 (having taken a token)."""
+        now = time.monotonic()
+        if self.held_until > now:
+            return self.held_until - now
+        if self.rate is None:
+            return 0
+        self.refill(now)
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    async def acquire(self):
+        while True:
+            delay = self.delay()
+            if not delay:
+                return
+            self.waited += delay
+            await imbroglio.sleep(delay)
+
+    def hold(self, seconds):
+        """Don't let anything through for seconds."""
+        now = time.monotonic()
+        self.held_until = max(self.held_until, now + seconds)
+        self.refill(now)
+        self.tokens = 0
+        self.holds += 1
+
+
+class RateLimiter:
+    """
+    TokenBucket per backend and (host, path prefix), with the rates from
+    the http.rate_limits setting.  Requests anywhere else get a bucket
+    per host and path (APIs like Slack's limit each method separately),
+    which doesn't limit anything until a server says otherwise (429 with
+    Retry-After, or running out of X-RateLimit-Remaining).
+    """
+
+    def __init__(self, limits=None):
+        self.limits = {} if limits is None else limits
+        self.buckets = {}
+
+    def bucket(self, label, url):
+        parsed = urllib.parse.urlsplit(url)
+        where = parsed.hostname + (parsed.path or '/')
+        prefix = max(
+            (k for k in self.limits if where.startswith(k)),
+            key=len, default=where)
+        key = (label, prefix)
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            bucket = self.buckets[key] = TokenBucket(
+                *self.limits.get(prefix, (None, 1)))
+        return bucket
+
+    @staticmethod
+    def parse_retry_after(value, now=None):
+        """Seconds to wait, from a Retry-After (seconds or an HTTP date)."""
+        try:
+            return max(0.0, float(value))
+        except ValueError:
+            pass
+        try:
+            when = email.utils.parsedate_to_datetime(value).timestamp()
+        except (TypeError, ValueError):
+            return None
+        return max(0.0, when - (time.time() if now is None else now))
+
+    def observe(self, bucket, status, headers):
+        """Update the bucket from a response.  Returns whether the request
+        was refused for being over the limit (and so should be retried)."""
+        headers = {k.decode().lower(): v.decode() for (k, v) in headers}
+        retry_after = headers.get('retry-after')
+        if retry_after is not None and status in (429, 503):
+            seconds = self.parse_retry_after(retry_after)
+            bucket.hold(1.0 if seconds is None else seconds)
+        elif status == 429:
+            bucket.hold(1.0)
+        elif headers.get('x-ratelimit-remaining', '').strip() == '0':
+            with contextlib.suppress(ValueError):
+                reset = float(headers.get('x-ratelimit-reset', ''))
+                # an epoch time or a number of seconds
+                bucket.hold(reset - time.time() if reset > 1e9 else reset)
+        return status == 429
+
+    def stats(self):
+        return {
+            f'{label} {prefix}': {
+                'waited': bucket.waited,
+                'holds': bucket.holds,
+                }
+            for ((label, prefix), bucket) in self.buckets.items()}
+
+
+def coerce_rate_limits(value):
+    """Parse "host/path=rate[:burst] ..." (rate per second) into a dict"""
+    if hasattr(value, 'items'):
+        return dict(value)
+    limits = {}
+    for item in value.replace(',', ' ').split():
+        prefix, spec = item.split('=')
+        rate, _, burst = spec.partition(':')
+        limits[prefix] = (float(rate), float(burst) if burst else 1.0)
+    return limits
+
+
+_rate_limiter = None
+
+
+def rate_limiter():
+    """Return the process-wide RateLimiter, creating it if need be."""
+    global _rate_limiter
+    if _rate_limiter is None:
+        _rate_limiter = RateLimiter()
+    return _rate_limiter
+
+
+Configurable(
+    'http.rate_limits',
+    # Slack's tier 3, which is what the history methods the slack
+    # backend uses are in (each method has its own limit)
+    'slack.com/api/channels.history=0.8:8'
+    ' slack.com/api/groups.history=0.8:8'
+    ' slack.com/api/im.history=0.8:8',
+    'request rates, as host/path-prefix=requests-per-second[:burst],'
+    ' space separated',
+    coerce=coerce_rate_limits,
+    action=lambda context, value: setattr(
+        rate_limiter(), 'limits', coerce_rate_limits(value)))
+
+HTTP_RATE_RETRIES = 5  # times to retry a request refused for rate
+
+
+class ResponseCache:
+    """
+    On-disk cache of response bodies that came with an ETag or
+    Last-Modified, so that the next identical request can be made
+    conditional and a 304 answered from disk.
+
+    Entries are keyed on a hash of the whole request, headers included,
+    so different accounts never see each other's responses.  The cache
+    is off until it has a directory, and only requests made with
+    _cache=True use it.
+    """
+
+    def __init__(self, directory=None, log=None):
+        self.directory = directory
+        self.log = log if log is not None else logging.getLogger(
+            'ResponseCache')
+
+        self.hits = 0
+        self.misses = 0
+        self.stored = 0
+
+    @staticmethod
+    def key(*args, **kwargs):
+        return hashlib.sha256(
+            repr((args, sorted(kwargs.items()))).encode()).hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.directory, key)
+
+    def validators(self, key):
+        """Return the conditional request headers for a cached response,
+        if there is one."""
+        if self.directory is None:
+            return []
+        try:
+            with open(self.path(key), 'rb') as fp:
+                meta = json.loads(fp.readline())
+        except (OSError, ValueError):
+            return []
+        headers = []
+        if meta.get('etag'):
+            headers.append(('If-None-Match', meta['etag']))
+        if meta.get('last-modified'):
+            headers.append(('If-Modified-Since', meta['last-modified']))
+        return headers
+
+    def load(self, key):
+        """Return the cached body, or None if it's gone missing."""
+        try:
+            with open(self.path(key), 'rb') as fp:
+                fp.readline()
+                body = fp.read()
+        except OSError:
+            self.log.exception('reading cached response %s', key)
+            self.misses += 1
+            return None
+        self.hits += 1
+        return body
+
+    def store(self, key, url, headers, body):
+        """Remember a response if it has validators."""
+        if self.directory is None:
+            return
+        headers = {
+            k.decode().lower(): v.decode() for (k, v) in headers}
+        meta = {
+            k: headers[k] for k in ('etag', 'last-modified') if k in headers}
+        if not meta:
+            return
+        meta['url'] = url
+        self.misses += 1
+        try:
+            os.makedirs(self.directory, mode=0o700, exist_ok=True)
+            tmp = self.path(',' + key)
+            fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with open(fd, 'wb') as fp:
+                fp.write(json.dumps(meta).encode() + b'\n')
+                fp.write(body)
+            os.rename(tmp, self.path(key))
+            self.stored += 1
+        except OSError:
+            self.log.exception('caching response from %s', url)
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'stored': self.stored,
+            }
+
+
+_response_cache = None
+
+
+def response_cache():
+    """Return the process-wide ResponseCache, creating it if need be."""
+    global _response_cache
+    if _response_cache is None:
+        _response_cache = ResponseCache()
+    return _response_cache
+
+
+Configurable(
+    'http.cache', True,
+    'keep responses that can be revalidated (in http-cache in the snipe'
+    ' directory), to save downloading them again when they haven\'t changed',
+    coerce=coerce_bool,
+    action=lambda context, value: setattr(
+        response_cache(), 'directory',
+        os.path.join(context.directory, 'http-cache') if value else None))
+
+
 class HTTP_JSONmixin:
     # object must have a .log attribute
 
@@ -340,10 +813,53 @@ class HTTP_JSONmixin:
     async def reset_client_session_headers(self, headers=None):
         self.setup_client_session(headers)
 
-    async def _request(self, *args, **kwargs):
+    @property
+    def _JSONmixin_label(self):
+        """What to file our requests under in network_stats()"""
+        return getattr(self, 'name', None) or self.__class__.__name__
+
+    async def _request(
+            self, *args, _coalesce=None, _cache=False, **kwargs):
+        """Make a request and return the decoded JSON response.
+
+        If _coalesce is true (the default for GETs), an identical request
+        (same method, URL, headers and body) already in flight is waited
+        for rather than made again.
+
+        If _cache is true, responses with an ETag or Last-Modified are kept
+        in the ResponseCache and the request is made conditional next time.
+        It's off unless asked for, since nothing ever leaves the cache;
+        it's for the few endpoints that return the same big thing each
+        time, not ones whose parameters change from call to call.
+        """
+        method = args[1] if len(args) > 1 else kwargs.get('method', 'GET')
+        if _coalesce is None:
+            _coalesce = method == 'GET'
+        if not _coalesce:
+            return await self._request_once(*args, _cache=_cache, **kwargs)
+        key = ResponseCache.key(*args, **kwargs)
+        return await single_flight().run(
+            key, self._request_once, *args, _cache=_cache, **kwargs)
+
+    async def _request_once(
+            self, *args, _cache=False, _retries=HTTP_RATE_RETRIES, **kwargs):
         response = None
+        bucket = rate_limiter().bucket(self._JSONmixin_label, args[0])
+        await bucket.acquire()
+        cache = response_cache() if _cache else None
+        conditional = []
+        if cache is not None and cache.directory is not None:
+            key = ResponseCache.key(*args, **kwargs)
+            conditional = await imbroglio.run_in_thread(
+                cache.validators, key)
+        else:
+            cache = None
         try:
-            response = await HTTP.request(*args, **kwargs)
+            response = await HTTP.request(
+                *args, pool=connection_pool(), label=self._JSONmixin_label,
+                **dict(
+                    kwargs,
+                    headers=list(kwargs.get('headers', [])) + conditional))
             datas = []
             while True:
                 b = await response.readsome()
@@ -351,6 +867,34 @@ class HTTP_JSONmixin:
                     break
                 datas.append(b)
             bs = b''.join(datas)
+            if getattr(response, 'response', None) is not None:
+                refused = rate_limiter().observe(
+                    bucket, response.response.status_code,
+                    response.response.headers)
+                if refused and _retries:
+                    self.log.warning(
+                        'rate limited by %s, retrying', response.url)
+                    # don't hang on to the connection while we wait
+                    await response.close()
+                    response = None
+                    return await self._request_once(
+                        *args, _cache=_cache, _retries=_retries - 1,
+                        **kwargs)
+            if cache is not None and getattr(
+                    response, 'response', None) is not None:
+                status = response.response.status_code
+                if status == 304 and conditional:
+                    bs = await imbroglio.run_in_thread(cache.load, key)
+                    if bs is None:
+                        # it went away just now; ask again, unconditionally
+                        await response.close()
+                        response = None
+                        return await self._request_once(
+                            *args, _retries=_retries, **kwargs)
+                elif status == 200:
+                    await imbroglio.run_in_thread(
+                        cache.store, key, response.url,
+                        response.response.headers, bs)
             try:
                 u = bs.decode('UTF-8')
                 result = json.loads(u)
@@ -365,7 +909,17 @@ class HTTP_JSONmixin:
                 await response.close()
         return result
 
-    async def _post(self, path, _data=None, **kw):
+    def _request_stream(self, *args, **kwargs):
+        """Like _request, but returns a JSONStream of the response."""
+        return JSONStream(self._open_stream(*args, **kwargs), self.log)
+
+    async def _open_stream(self, *args, **kwargs):
+        await rate_limiter().bucket(self._JSONmixin_label, args[0]).acquire()
+        return await HTTP.request(
+            *args, pool=connection_pool(), label=self._JSONmixin_label,
+            **kwargs)
+
+    async def _post(self, path, _data=None, _coalesce=False, **kw):
         self.log.debug(
             '_post(%s%s, %s, **%s)', repr(self.url), repr(path),
             self._JSONmixin_headers, repr(kw))
@@ -374,6 +928,7 @@ class HTTP_JSONmixin:
             method='POST',
             data=kw if _data is None else _data,
             headers=self._JSONmixin_headers,
+            _coalesce=_coalesce,
             )
 
     async def _post_json(self, path, **kw):
@@ -398,26 +953,37 @@ class HTTP_JSONmixin:
             headers=self._JSONmixin_headers,
             )
 
-    async def _get(self, path, **kw):
+    async def _get(self, path, _cache=False, **kw):
         self.log.debug(
             f'_get({path!r}, **{kw!r});'
             f' url={self.url!r}, headers={self._JSONmixin_headers!r}')
 
-        us = urllib.parse.urlsplit(urllib.parse.urljoin(self.url, path))
         return await self._request(
-            urllib.parse.urlunsplit(
-                us[:3] + (urllib.parse.urlencode(kw), '')),
-            headers=self._JSONmixin_headers,
-            )
+            self._get_url(path, kw), headers=self._JSONmixin_headers,
+            _cache=_cache)
+
+    def _get_stream(self, path, **kw):
+        self.log.debug(
+            f'_get_stream({path!r}, **{kw!r});'
+            f' url={self.url!r}, headers={self._JSONmixin_headers!r}')
+
+        return self._request_stream(
+            self._get_url(path, kw), headers=self._JSONmixin_headers)
+
+    def _get_url(self, path, kw):
+        us = urllib.parse.urlsplit(urllib.parse.urljoin(self.url, path))
+        return urllib.parse.urlunsplit(
+            us[:3] + (urllib.parse.urlencode(kw), ''))
 
     async def shutdown(self):
         await super().shutdown()
 
 
 class JSONWebSocket:
-    def __init__(self, log):
+    def __init__(self, log, label=None):
         self.conn = None
         self.log = log
+        self.label = label
 
     async def close(self):
         if self.conn is not None:
@@ -426,7 +992,8 @@ class JSONWebSocket:
 
     async def connect(self, url, headers=[]):
         self.log.debug('connecting to %s %s', url, headers)
-        self.conn = await HTTP_WS.request(url, headers=headers, log=self.log)
+        self.conn = await HTTP_WS.request(
+            url, headers=headers, log=self.log, label=self.label)
 
     async def write(self, data):
         data = json.dumps(data)
@@ -560,7 +1127,254 @@ def getobj(qualname):
     return getattr(module, name)
 
 
+class NetworkStats:
+    """
+    Tallies of network activity, per (backend, endpoint).
+
+    Endpoints are things like "GET https://host/path" or "ws wss://host/path";
+    NetworkStream also counts raw bytes on the wire (TLS and all) per
+    host, under the backend "*".
+    """
+
+    # upper bounds, in seconds, of the latency histogram buckets
+    BUCKETS = (.01, .03, .1, .3, 1, 3, 10, 30, math.inf)
+
+    def __init__(self):
+        self.counts = {}  # (backend, endpoint) -> collections.Counter
+        self.latencies = {}  # (backend, endpoint) -> [count per bucket]
+
+    def count(self, backend, endpoint, **counts):
+        key = (backend, endpoint)
+        c = self.counts.get(key)
+        if c is None:
+            c = self.counts[key] = collections.Counter()
+        c.update(counts)
+
+    def latency(self, backend, endpoint, seconds):
+        key = (backend, endpoint)
+        histogram = self.latencies.get(key)
+        if histogram is None:
+            histogram = self.latencies[key] = [0] * len(self.BUCKETS)
+        histogram[bisect.bisect_left(self.BUCKETS, seconds)] += 1
+        self.count(backend, endpoint, latency=seconds)
+
+    def clear(self):
+        self.counts.clear()
+        self.latencies.clear()
+
+    def report(self):
+        """Return the tallies as text, busiest backend first."""
+        backends = collections.defaultdict(list)
+        for (backend, endpoint), c in self.counts.items():
+            backends[backend].append((endpoint, c))
+
+        def traffic(counts):
+            return counts['bytes_in'] + counts['bytes_out']
+
+        out = []
+        for backend, endpoints in sorted(
+                backends.items(),
+                key=lambda x: -sum(traffic(c) for (_, c) in x[1])):
+            total = sum((c for (_, c) in endpoints), collections.Counter())
+            out.append(
+                f'{backend}: {total["bytes_in"]} bytes in,'
+                f' {total["bytes_out"]} bytes out')
+            for endpoint, c in sorted(endpoints, key=lambda x: -traffic(x[1])):
+                out.append(f'  {endpoint}')
+                line = [f'{c["bytes_in"]} in', f'{c["bytes_out"]} out']
+                if c['bytes_decoded']:
+                    line.append(f'{c["bytes_decoded"]} decompressed')
+                if c['requests']:
+                    line.append(f'{c["requests"]} requests')
+                if c['frames_in'] or c['frames_out']:
+                    line.append(
+                        f'{c["frames_in"]} frames in,'
+                        f' {c["frames_out"]} out')
+                out.append('    ' + ', '.join(line))
+                if c['connections']:
+                    line = [
+                        f'{c["connections"]} connections'
+                        f' ({c["reused"]} reused)'
+                        if c['reused'] else f'{c["connections"]} connections']
+                    if c['connections'] > 1 and endpoint.startswith('ws '):
+                        line.append(f'{c["connections"] - 1} reconnects')
+                    handshakes = c['connections'] - c['reused']
+                    if handshakes:
+                        line.append(
+                            f'{c["handshake_time"] / handshakes:.3f}s'
+                            ' average setup')
+                    out.append('    ' + ', '.join(line))
+                histogram = self.latencies.get((backend, endpoint))
+                if histogram is not None:
+                    out.append('    latency: ' + ' '.join(
+                        f'<{bound}s:{n}' if math.isfinite(bound) else f'+:{n}'
+                        for (bound, n) in zip(self.BUCKETS, histogram)
+                        if n))
+        return '\n'.join(out)
+
+
+_network_stats = None
+
+
+def network_stats():
+    """Return the process-wide NetworkStats, creating it if need be."""
+    global _network_stats
+    if _network_stats is None:
+        _network_stats = NetworkStats()
+    return _network_stats
+
+
+class Resolver:
+    """
+    Cache of hostname lookups, so that connecting to the same few API
+    hosts over and over doesn't go to the resolver every time.
+
+    getaddrinfo doesn't tell us the record's TTL, so entries are kept for
+    a fixed ttl (the dns.ttl setting); an entry is also dropped if none of
+    its addresses can be connected to.
+    """
+
+    def __init__(self, ttl=300.0, log=None):
+        self.ttl = ttl
+        self.log = log if log is not None else logging.getLogger('Resolver')
+        self.cache = {}  # (hostname, port) -> (expires, [addrinfo])
+
+        self.hits = 0
+        self.misses = 0
+
+    async def resolve(self, hostname, port):
+        """Return getaddrinfo results for a TCP connection to the place,
+        with the address families interleaved (RFC 8305 section 4)."""
+        key = (hostname, port)
+        entry = self.cache.get(key)
+        if entry is not None and entry[0] > time.monotonic():
+            self.hits += 1
+            return entry[1]
+        self.misses += 1
+        infos = await imbroglio.run_in_thread(
+            socket.getaddrinfo, hostname, port, 0, socket.SOCK_STREAM)
+        infos = self.interleave(infos)
+        self.log.debug('%s -> %s', key, [info[4] for info in infos])
+        self.cache[key] = (time.monotonic() + self.ttl, infos)
+        return infos
+
+    @staticmethod
+    def interleave(infos):
+        families = {}
+        for info in infos:
+            families.setdefault(info[0], []).append(info)
+        result = []
+        for row in itertools.zip_longest(*families.values()):
+            result.extend(info for info in row if info is not None)
+        return result
+
+    def forget(self, hostname, port):
+        self.cache.pop((hostname, port), None)
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'cached': len(self.cache),
+            }
+
+
+_resolver = None
+
+
+def resolver():
+    """Return the process-wide Resolver, creating it if need be."""
+    global _resolver
+    if _resolver is None:
+        _resolver = Resolver()
+    return _resolver
+
+
+Configurable(
+    'dns.ttl', 300.0,
+    'seconds to remember a hostname lookup for',
+    coerce=float,
+    action=lambda context, value: setattr(resolver(), 'ttl', value))
+
+
+HAPPY_EYEBALLS_DELAY = .25  # seconds, RFC 8305 recommends 250ms
+
+
+async def connect_socket(infos, timeout=5, delay=None):
+    """Connect to the first address in infos that answers.
+
+    Attempts are started delay seconds apart (Happy Eyeballs, RFC 8305)
+    or as soon as the previous one fails, so that a dead address doesn't
+    hold things up for the whole timeout.  Returns a non-blocking socket;
+    raises OSError if nothing could be connected to in time.
+    """
+    if delay is None:
+        delay = HAPPY_EYEBALLS_DELAY
+    me = await imbroglio.this_task()
+
+    async def attempt(info):
+        family, type_, proto, _, address = info
+        sock = socket.socket(family, type_, proto)
+        try:
+            sock.setblocking(False)
+            err = sock.connect_ex(address)
+            if err == errno.EINPROGRESS:
+                await imbroglio.writewait(sock.fileno())
+                err = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+            if err:
+                raise OSError(err, f'{os.strerror(err)}: {address}')
+            return sock
+        except BaseException:
+            sock.close()
+            raise
+        finally:
+            if racing:
+                me.rouse()
+
+    racing = True
+    pending = list(infos)
+    attempts = []
+    error = OSError(errno.EHOSTUNREACH, 'no addresses to connect to')
+    deadline = time.monotonic() + timeout
+    try:
+        while True:
+            for t in [t for t in attempts if t.is_done()]:
+                attempts.remove(t)
+                result = t.result(exception=False)
+                if not isinstance(result, BaseException):
+                    return result
+                error = result
+            if pending:
+                attempts.append(await imbroglio.spawn(
+                    attempt(pending.pop(0))))
+                wait = delay
+            elif not attempts:
+                raise error
+            else:
+                wait = None
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise socket.timeout(f'timed out connecting to {infos[0][4]}')
+            await imbroglio.sleep(
+                remaining if wait is None else min(wait, remaining))
+    finally:
+        # don't let the stragglers rouse us once we've moved on
+        racing = False
+        for t in attempts:
+            if t.is_done():
+                result = t.result(exception=False)
+                if isinstance(result, socket.socket):
+                    result.close()
+            else:
+                t.cancel()
+
+
 class NetworkStream:
+    # readsome reads into a reusable buffer that grows (up to READ_MAX)
+    # while reads keep filling it and shrinks back when they don't
+    READ_MIN = 4096
+    READ_MAX = 1 << 20
+
     def __init__(self, sock, hostname='', port=0, log=None):
         if log is None:
             self.log = logging.getLogger(
@@ -571,6 +1385,9 @@ class NetworkStream:
         self.socket = sock
         self.socket.setblocking(False)
         self.reof = False
+        self.buffer = bytearray(self.READ_MIN)
+        self.endpoint = f'tcp {hostname}:{port}'
+        self.connect_time = 0.0
 
         self.log.debug('%s', f'connected to {self.socket!r}')
 
@@ -579,23 +1396,48 @@ class NetworkStream:
 
     @classmethod
     async def connect(klass, hostname, port, log=None):
-        sock = await imbroglio.run_in_thread(
-            socket.create_connection, (hostname, port), 5)
-        return klass(sock, hostname, port, log)
+        t0 = time.monotonic()
+        infos = await resolver().resolve(hostname, port)
+        try:
+            sock = await connect_socket(infos, 5)
+        except OSError:
+            resolver().forget(hostname, port)
+            raise
+        stream = klass(sock, hostname, port, log)
+        stream.connect_time = time.monotonic() - t0
+        network_stats().count(
+            '*', stream.endpoint,
+            connections=1, handshake_time=stream.connect_time)
+        return stream
 
     async def readsome(self):
         if self.reof:
             return None
         await imbroglio.readwait(self.socket.fileno())
-        try:
-            buf = self.socket.recv(4096)
-        except BlockingIOError:  # pragma: nocover
-            # shouldn't actually happen
-            return ''
-        if buf == b'':
-            self.log.debug('readsome: got eof')
-            self.reof = True
-            return None
+        # take everything that's already arrived, up to a buffer's worth,
+        # rather than going back through the scheduler for each bit
+        got = 0
+        with memoryview(self.buffer) as view:
+            while got < len(view):
+                try:
+                    count = self.socket.recv_into(view[got:])
+                except BlockingIOError:
+                    break
+                if count == 0:
+                    self.log.debug('readsome: got eof')
+                    self.reof = True
+                    break
+                got += count
+            buf = bytes(view[:got])
+        network_stats().count('*', self.endpoint, bytes_in=got)
+        if got == len(self.buffer) and got < self.READ_MAX:
+            self.buffer = bytearray(2 * got)
+        elif got < len(self.buffer) // 4 and len(self.buffer) > self.READ_MIN:
+            self.buffer = bytearray(len(self.buffer) // 2)
+        if not buf:
+            if self.reof:
+                return None
+            return buf  # pragma: nocover, shouldn't actually happen
         self.log.debug('readsome: %d bytes, reof %s', len(buf), self.reof)
         return buf
 
@@ -609,10 +1451,15 @@ class NetworkStream:
 
     async def write(self, data):
         self.log.debug('sending %d bytes', len(data))
-        while data:
-            await imbroglio.writewait(self.socket.fileno())
-            sent = self.socket.send(data)
-            data = data[sent:]
+        network_stats().count('*', self.endpoint, bytes_out=len(data))
+        with memoryview(data) as view:
+            while view:
+                try:
+                    sent = self.socket.send(view)
+                except BlockingIOError:
+                    await imbroglio.writewait(self.socket.fileno())
+                    continue
+                view = view[sent:]
 
     async def close(self):
         self.log.debug('%s', f'NetworkStream {self} closing')
@@ -621,10 +1468,74 @@ class NetworkStream:
         self.socket.close()
 
 
+class TLSSessionCache:
+    """
+    One client SSL context, and the last TLS session negotiated with each
+    (host, port), so that later connections can resume it instead of doing
+    a full handshake.
+    """
+
+    def __init__(self, context=None):
+        self._context = context
+        self.sessions = {}  # (hostname, port) -> ssl.SSLSession
+
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def context(self):
+        if self._context is None:
+            self._context = ssl.create_default_context()
+        return self._context
+
+    def wrap_bio(self, incoming, outgoing, hostname, port):
+        kw = {}
+        session = self.sessions.get((hostname, port))
+        if session is not None:
+            kw['session'] = session
+        return self.context.wrap_bio(
+            incoming, outgoing, server_side=False, server_hostname=hostname,
+            **kw)
+
+    def handshake_done(self, obj, hostname, port):
+        if getattr(obj, 'session_reused', False):
+            self.hits += 1
+        else:
+            self.misses += 1
+        self.remember(obj, hostname, port)
+
+    def remember(self, obj, hostname, port):
+        # with TLS 1.3 the session ticket may only show up after the
+        # handshake, so this gets called again when the connection closes
+        session = getattr(obj, 'session', None)
+        if session is not None:
+            self.sessions[(hostname, port)] = session
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'sessions': len(self.sessions),
+            }
+
+
+_tls_sessions = None
+
+
+def tls_sessions():
+    """Return the process-wide TLSSessionCache, creating it if need be."""
+    global _tls_sessions
+    if _tls_sessions is None:
+        _tls_sessions = TLSSessionCache()
+    return _tls_sessions
+
+
 class SSLStream:
     # XXX needs refactored
 
-    def __init__(self, netstream, hostname, log=None):
+    READ_SIZE = 1 << 16  # more than a TLS record
+
+    def __init__(self, netstream, hostname, log=None, port=443, sessions=None):
         if log is None:
             self.log = logging.getLogger('SSLStream.%s' % (hostname,))
         else:
@@ -632,12 +1543,14 @@ class SSLStream:
         self.reof = False
 
         self.netstream = netstream
+        self.hostname = hostname
+        self.port = port
+        self.sessions = sessions if sessions is not None else tls_sessions()
         self.incoming = ssl.MemoryBIO()
         self.outgoing = ssl.MemoryBIO()
-        self.ctx = ssl.create_default_context()
-        self.obj = self.ctx.wrap_bio(
-            self.incoming, self.outgoing, server_side=False,
-            server_hostname=hostname)
+        self.ctx = self.sessions.context
+        self.obj = self.sessions.wrap_bio(
+            self.incoming, self.outgoing, hostname, port)
         self.handshake_done = False
         self.log.debug('%s', f'wrapped {self.netstream!r}')
 
@@ -669,6 +1582,7 @@ class SSLStream:
         if self.outgoing.pending:
             await self.netstream.write(self.outgoing.read())
         self.handshake_done = True
+        self.sessions.handshake_done(self.obj, self.hostname, self.port)
 
     async def write(self, data):
         await self.do_handshake()
@@ -706,7 +1620,7 @@ class SSLStream:
 
         while True:
             try:
-                data = self.obj.read()
+                data = self.obj.read(self.READ_SIZE)
                 if data == b'':
                     self.reof = True
                     return None
@@ -726,6 +1640,19 @@ class SSLStream:
                 return None
             break
 
+        # decrypt whatever else is already off the wire in one go
+        chunks = [data]
+        while self.incoming.pending:
+            try:
+                more = self.obj.read(self.READ_SIZE)
+            except ssl.SSLError:
+                break
+            if not more:
+                break
+            chunks.append(more)
+        if len(chunks) > 1:
+            data = b''.join(chunks)
+
         self.log.debug('got %d bytes from SSL', len(data))
         return data
 
@@ -758,15 +1685,130 @@ class SSLStream:
 
     async def close(self):
         self.log.debug('%s', f'closing {self.netstream}')
+        if self.handshake_done:
+            self.sessions.remember(self.obj, self.hostname, self.port)
         await self.netstream.close()
 
 
+class ConnectionPool:
+    """
+    Idle HTTP/1.1 connections, kept per (scheme, host, port) so that
+    the next request to the same place can skip connection setup.
+
+    Connections are checked before being handed out again: ones that have
+    been idle longer than idle_timeout, or that the server has closed or
+    sent something unsolicited on, are thrown away.
+    """
+
+    def __init__(self, max_idle=4, idle_timeout=30.0, log=None):
+        self.max_idle = max_idle
+        self.idle_timeout = idle_timeout
+        self.log = log if log is not None else logging.getLogger(
+            'ConnectionPool')
+        self.idle = {}  # (scheme, hostname, port) -> [(stream, since)]
+
+        self.hits = 0
+        self.misses = 0
+        self.discarded = 0
+
+    @staticmethod
+    async def open(scheme, hostname, port, log=None):
+        stream = await NetworkStream.connect(hostname, port, log=log)
+        if scheme in ('https', 'wss'):
+            stream = SSLStream(stream, hostname, log=log, port=port)
+        return stream
+
+    @staticmethod
+    async def stale(stream):
+        """Whether an idle connection has had anything happen to it."""
+        if await stream.readable():
+            return True  # an idle connection shouldn't have anything to say
+        return stream.reof or getattr(stream, 'netstream', stream).reof
+
+    async def get(self, scheme, hostname, port, log=None):
+        """Return an idle connection to the place if there's a good one,
+        otherwise a new one.  The second value is whether it's reused."""
+        key = (scheme, hostname, port)
+        idle = self.idle.get(key, [])
+        while idle:
+            stream, since = idle.pop()
+            if (time.monotonic() - since < self.idle_timeout
+                    and not await self.stale(stream)):
+                self.hits += 1
+                self.log.debug('reusing %s for %s', stream, key)
+                return stream, True
+            self.discarded += 1
+            await self.discard(stream)
+        self.misses += 1
+        return (await self.open(scheme, hostname, port, log)), False
+
+    async def put(self, scheme, hostname, port, stream):
+        """Offer a connection that has finished its request for reuse."""
+        key = (scheme, hostname, port)
+        idle = self.idle.setdefault(key, [])
+        now = time.monotonic()
+        expired = [s for (s, since) in idle if now - since > self.idle_timeout]
+        idle[:] = [(s, since) for (s, since) in idle if s not in expired]
+        idle.append((stream, now))
+        while len(idle) > self.max_idle:
+            expired.append(idle.pop(0)[0])
+        for s in expired:
+            self.discarded += 1
+            await self.discard(s)
+
+    async def discard(self, stream):
+        with contextlib.suppress(Exception):
+            await stream.close()
+
+    async def clear(self):
+        idle, self.idle = self.idle, {}
+        for streams in idle.values():
+            for (stream, since) in streams:
+                await self.discard(stream)
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'discarded': self.discarded,
+            'idle': sum(len(x) for x in self.idle.values()),
+            }
+
+
+_connection_pool = None
+
+
+def connection_pool():
+    """Return the process-wide ConnectionPool, creating it if need be."""
+    global _connection_pool
+    if _connection_pool is None:
+        _connection_pool = ConnectionPool()
+    return _connection_pool
+
+
+Configurable(
+    'http.max_idle_per_host', 4,
+    'idle HTTP connections to keep per host for reuse',
+    coerce=int,
+    action=lambda context, value: setattr(
+        connection_pool(), 'max_idle', value))
+Configurable(
+    'http.idle_timeout', 30.0,
+    'seconds to keep an idle HTTP connection around for reuse',
+    coerce=float,
+    action=lambda context, value: setattr(
+        connection_pool(), 'idle_timeout', value))
+
+
 class HTTP:
-    def __init__(self, url, method='GET', log=None):
+    def __init__(self, url, method='GET', log=None, pool=None, label=None):
         if log is not None:
             self.log = log
         else:
             self.log = logging.getLogger('HTTP')
+        self.pool = pool
+        self.label = label if label is not None else 'HTTP'
+        self.reused = False
         self.url = url
         self.method = method
         parsed = urllib.parse.urlsplit(url)
@@ -776,6 +1818,8 @@ class HTTP:
         self.port = int(parsed.port or {'http': 80, 'https': 443}[self.scheme])
         self.qs = (parsed.path or '/') + (
             ('?' + parsed.query) if parsed.query else '')
+        self.endpoint = (
+            f'{method} {self.scheme}://{parsed.netloc}{parsed.path or "/"}')
         self.conn = h11.Connection(our_role=h11.CLIENT)
         self.connected = False
         self.response = None
@@ -784,21 +1828,28 @@ class HTTP:
     @classmethod
     async def request(
             klass, url, method='GET', data=None, json=None, headers=[],
-            log=None):
-        obj = klass(url, method, log)
+            log=None, pool=None, label=None):
+        """Make a request.  If a ConnectionPool is supplied, the connection
+        is taken from and returned to it, otherwise it's closed after.
+        label is what to file it under in network_stats()."""
+        obj = klass(url, method, log, pool, label)
         await obj.connect(data=data, _json=json, headers=headers)
         return obj
 
     async def connect(self, data=None, _json=None, headers=[]):
-        self.stream = await NetworkStream.connect(self.hostname, self.port)
-        if self.scheme == 'https':
-            self.stream = SSLStream(self.stream, self.hostname)
-
-        outheaders = [
-            ('Host', self.hostname),
-            ('Connection', 'close'),
-            ('Accept-Encoding', 'gzip'),
-            ]
+        self.started = time.monotonic()
+        if self.pool is None:
+            self.stream = await ConnectionPool.open(
+                self.scheme, self.hostname, self.port)
+        else:
+            self.stream, self.reused = await self.pool.get(
+                self.scheme, self.hostname, self.port)
+        self.request_args = (data, _json, headers)
+
+        outheaders = [('Host', self.hostname)]
+        if self.pool is None:
+            outheaders.append(('Connection', 'close'))
+        outheaders.append(('Accept-Encoding', 'gzip'))
         if _json is not None:
             # overrides data
             data = json.dumps(_json)
@@ -819,6 +1870,14 @@ class HTTP:
         if data is not None:
             await self.send(h11.Data(data=data))
         await self.send(h11.EndOfMessage())
+        if self.reused:
+            network_stats().count(
+                self.label, self.endpoint, requests=1, connections=1, reused=1)
+        else:
+            # (the TLS handshake happens on the first write)
+            network_stats().count(
+                self.label, self.endpoint, requests=1, connections=1,
+                handshake_time=time.monotonic() - self.started)
         self.connected = True
         self.log.debug('%s', f'{self.url}: connected to {self.stream!r}')
 
@@ -829,6 +1888,7 @@ class HTTP:
         data = self.conn.send(event)
         if not data:
             return
+        network_stats().count(self.label, self.endpoint, bytes_out=len(data))
         await self.stream.write(data)
 
     async def next_event(self):
@@ -849,9 +1909,26 @@ class HTTP:
         assert self.connected
 
         while True:
-            event = await self.next_event()
+            try:
+                event = await self.next_event()
+            except (OSError, h11.RemoteProtocolError):
+                if not self.retryable():
+                    raise
+                event = h11.ConnectionClosed()
+            if type(event) is h11.ConnectionClosed and self.retryable():
+                # the server gave up on the idle connection just as we
+                # picked it up; try again on a fresh one
+                self.log.debug('%s: reused connection was closed', self.url)
+                await self.pool.discard(self.stream)
+                self.pool = None  # so as not to loop
+                self.conn = h11.Connection(our_role=h11.CLIENT)
+                data, _json, headers = self.request_args
+                await self.connect(data, _json, headers)
+                continue
             if type(event) is h11.Response:
                 self.response = event
+                network_stats().latency(
+                    self.label, self.endpoint, time.monotonic() - self.started)
                 ce = dict(event.headers).get(b'content-encoding')
                 if ce is not None:
                     ce = set(ce.replace(b' ', b'').split(b','))
@@ -865,22 +1942,42 @@ class HTTP:
 
             elif type(event) is h11.Data:
                 data = bytes(event.data)
+                raw = len(data)
                 if self.decompressor is not None:
                     data = self.decompressor.decompress(data)
+                network_stats().count(
+                    self.label, self.endpoint,
+                    bytes_in=raw, bytes_decoded=len(data))
                 return data
             elif type(event) in (h11.EndOfMessage, h11.ConnectionClosed):
                 return None
 
+    # methods that it's safe to send again if the server hung up without
+    # answering (it may well have acted on the request regardless)
+    RETRYABLE = ('GET', 'HEAD')
+
+    def retryable(self):
+        return (
+            self.pool is not None and self.reused and self.response is None
+            and self.method.upper() in self.RETRYABLE)
+
     async def close(self):
-        self.log.debug('%s', 'closing {self.stream}')
+        if (self.pool is not None
+                and self.conn.our_state is h11.DONE
+                and self.conn.their_state is h11.DONE):
+            await self.pool.put(
+                self.scheme, self.hostname, self.port, self.stream)
+            return
+        self.log.debug('%s', f'closing {self.stream}')
         await self.stream.close()
 
 
 class HTTP_WS:
-    def __init__(self, url, log=None, stream=None):
+    def __init__(self, url, log=None, stream=None, label=None):
         if log is None:
             log = logging.getLogger('HTTP_WS')
         self.log = log
+        self.label = label if label is not None else 'HTTP_WS'
 
         self.stream = stream
         self.url = url
@@ -893,6 +1990,7 @@ class HTTP_WS:
         self.port = int(parsed.port or {'ws': 80, 'wss': 443}[self.scheme])
         self.resource = (parsed.path or '/') + (
             ('?' + parsed.query) if parsed.query else '')
+        self.endpoint = f'ws {self.scheme}://{parsed.netloc}{parsed.path}'
 
         self.ws = wsproto.WSConnection(wsproto.ConnectionType.CLIENT)
 
@@ -901,16 +1999,16 @@ class HTTP_WS:
         self.response = None
         self.inbuf = []
         self.reading = False
+        self.outbuf = []  # frames waiting to go out together, see _write
+        self.outwaiters = []  # Promises of the writers of those frames
+        self.flushing = False
 
     async def connect(self, headers=[]):
         self.log.debug('opening connection to %s %s', self.hostname, self.port)
+        t0 = time.monotonic()
         if self.stream is None:
-            self.stream = await NetworkStream.connect(
-                self.hostname, self.port, log=self.log)
-            if self.scheme == 'wss':
-                self.log.debug('starting SSL layer')
-                self.stream = SSLStream(
-                    self.stream, self.hostname, log=self.log)
+            self.stream = await ConnectionPool.open(
+                self.scheme, self.hostname, self.port, log=self.log)
 
         await self._send(wsproto.events.Request(
             host=self.hostname,
@@ -931,6 +2029,9 @@ class HTTP_WS:
 
         self.log.debug('%s', f'{self.url}: connected to {self.stream!r}')
         self.log.debug('%s', f'connected: {event}')
+        network_stats().count(
+            self.label, self.endpoint,
+            connections=1, handshake_time=time.monotonic() - t0)
 
         self.connected = True
 
@@ -940,8 +2041,9 @@ class HTTP_WS:
             url,
             headers: List[Tuple[str, str]]=[],
             log=None,
-            stream=None):
-        obj = klass(url, log=log, stream=stream)
+            stream=None,
+            label=None):
+        obj = klass(url, log=log, stream=stream, label=label)
         await obj.connect(headers)
         return obj
 
@@ -974,6 +2076,8 @@ class HTTP_WS:
                     if event.message_finished:
                         retval = ''.join(self.inbuf)
                         self.inbuf = []
+                        network_stats().count(
+                            self.label, self.endpoint, frames_in=1)
                         return retval
                     else:  # pragma: nocover
                         # this seems to be a difficult situation to generate
@@ -984,6 +2088,8 @@ class HTTP_WS:
                 elif isinstance(event, wsproto.events.BytesMessage):
                     self.log.debug(
                         '%s', f'{ident}binary message {event.data!r}?')
+                    network_stats().count(
+                        self.label, self.endpoint, frames_in=1)
                     return event.data
             self.log.debug(f'{ident}about to communicate')
             await self._communicate()
@@ -994,10 +2100,11 @@ class HTTP_WS:
             return
         self.log.debug('writing %d bytes', len(buf))
         d = self.ws.send(wsproto.events.Message(data=buf))
+        network_stats().count(
+            self.label, self.endpoint, frames_out=1, bytes_out=len(d))
         if d:
             self.log.debug('just writing... %d bytes', len(d))
-            await self.stream.write(d)
-            self.log.debug('just sent %d bytes', len(d))
+            await self._write(d)
 
     async def close(self):
         self.log.debug('HTTP_WS closing')
@@ -1005,6 +2112,7 @@ class HTTP_WS:
         self.connected = False
         try:
             await self._send(wsproto.events.CloseConnection(code=0))
+            await self.flush()
         except wsproto.utilities.LocalProtocolError:  # pragma: nocover
             self.log.debug(
                 '%s',
@@ -1029,12 +2137,77 @@ class HTTP_WS:
         # XXX if not d: EOF
         if d is not None:
             self.log.debug('received %d bytes', len(d))
+            network_stats().count(self.label, self.endpoint, bytes_in=len(d))
         self.ws.receive_data(d)  # turns out wsproto signals EOF with None too
 
     async def _send(self, event):
         bytes_to_send = self.ws.send(event)
         if bytes_to_send:
-            await self.stream.write(bytes_to_send)
+            network_stats().count(
+                self.label, self.endpoint, bytes_out=len(bytes_to_send))
+            await self._write(bytes_to_send)
+
+    async def _write(self, data):
+        """Queue data for the stream.  Whoever finds the queue idle waits
+        out the rest of the tick and then sends everything queued by then
+        in one write (so one TLS record and system call, more or less);
+        everyone else waits for that, and gets its exception if it
+        fails."""
+        self.outbuf.append(data)
+        if self.flushing:
+            await self._flushed()
+            return
+        self.flushing = True
+        waiters = []
+        try:
+            await imbroglio.sleep()
+            while self.outbuf:
+                data, self.outbuf = b''.join(self.outbuf), []
+                waiters, self.outwaiters = self.outwaiters, []
+                await self.stream.write(data)
+                self.log.debug('just sent %d bytes', len(data))
+                for p in waiters:
+                    if not p.done:
+                        p.set_result(None)
+                waiters = []
+            # (flush()es that turned up after the last batch was taken)
+            for p in self.outwaiters:
+                if not p.done:
+                    p.set_result(None)
+            self.outwaiters = []
+        except BaseException as e:
+            # what was queued behind this isn't going anywhere either
+            self.outbuf = []
+            waiters += self.outwaiters
+            self.outwaiters = []
+            if not isinstance(e, Exception):
+                e = SnipeException('websocket write interrupted')
+            for p in waiters:
+                if not p.done:
+                    p.set_result_exception(e)
+            raise
+        finally:
+            self.flushing = False
+
+    async def _flushed(self):
+        """Wait for the write in progress to finish with what's queued."""
+        p = imbroglio.Promise()
+        self.outwaiters.append(p)
+        try:
+            await p
+        finally:
+            # if we were cancelled, don't get woken up later
+            p.done = True
+            with contextlib.suppress(ValueError):
+                self.outwaiters.remove(p)
+
+    async def flush(self):
+        """Wait until everything queued has been handed to the stream."""
+        if self.flushing:
+            await self._flushed()
+        elif self.outbuf:
+            data, self.outbuf = b''.join(self.outbuf), []
+            await self.stream.write(data)
 
     def __repr__(self):
         return f'<{self.__class__.__name__} {self.url} {self.stream!r}>'
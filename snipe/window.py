@@ -227,8 +227,8 @@ class Window:
                     self.last_key = k
 
                 if inspect.iscoroutine(ret):
-                    self.tasks.append(
-                        self.fe.supervisor.start(self.catch_and_log(ret)))
+                    self.tasks.append(self.fe.supervisor.start(
+                        self.catch_and_log(ret), imbroglio.INTERACTIVE))
 
         except Exception as e:
             self.context.message(str(e))
@@ -472,6 +472,51 @@ class Window:
 
         self.fe.switch_window(1)
 
+    @keymap.bind('Control-X t')
+    async def show_task_stats(self):
+        """Show where the event loop has been spending its time, busiest
+        tasks first."""
+
+        stats = await imbroglio.stats()
+        total = stats['busy'] + stats['idle']
+        out = [
+            f'{stats["ticks"]} ticks, {stats["busy"]:.3f}s busy,'
+            f' {stats["idle"]:.3f}s idle'
+            f' ({100 * stats["busy"] / total if total else 0:.1f}% busy)',
+            f'{stats["started"]} tasks started, {stats["finished"]} finished',
+            '',
+            ]
+        for task in stats['tasks']:
+            waits = ', '.join(
+                f'{k} {v:.3f}s'
+                for (k, v) in sorted(task['wait_time'].items()))
+            calls = ', '.join(
+                f'{k} {v}' for (k, v) in sorted(
+                    task['calls'].items(), key=lambda x: -x[1]))
+            out += [
+                task['task'],
+                f'  {task["run_time"]:.6f}s in {task["steps"]} steps,'
+                f' longest {task["longest_step"]:.6f}s',
+                f'  waited: {waits}',
+                f'  calls: {calls}',
+                ]
+        if stats['retired']:
+            out += ['', 'finished tasks, by where they were started:']
+            for (creation, totals) in sorted(
+                    stats['retired'].items(), key=lambda x: -x[1]['run_time']):
+                out.append(
+                    f'{creation}: {totals["count"]} tasks,'
+                    f' {totals["run_time"]:.6f}s in {totals["steps"]} steps,'
+                    f' longest {totals["longest_step"]:.6f}s')
+        self.show('\n'.join(out), '*Tasks*')
+
+    @keymap.bind('Control-X n')
+    def show_network_stats(self):
+        """Show how much network traffic each backend has generated, and
+        to where."""
+
+        self.show(util.network_stats().report(), '*Network*')
+
     @keymap.bind('Control-X e')  # XXX
     def split_to_editor(self):
         """Split to a new editor window."""
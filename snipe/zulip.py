@@ -104,7 +104,7 @@ class Zulip(messages.SnipeBackend, util.HTTP_JSONmixin):
     def __init__(self, context, url='https://chat.zulip.org', **kw):
         super().__init__(context, **kw)
         self.url = url.rstrip('/') + '/api/v1/'
-        self.messages = []
+        self.messages = messages.MessageList()
         self.messages_by_id = {}
         self.backfilling = False
         self.loaded = False
@@ -124,12 +124,15 @@ class Zulip(messages.SnipeBackend, util.HTTP_JSONmixin):
     async def start(self):
         await super().start()
         self.tasks.append(await imbroglio.spawn(self.connect()))
-        self.tasks.append(await imbroglio.spawn(self.presence_beacon()))
+        self.tasks.append(await imbroglio.spawn(
+            self.presence_beacon(), imbroglio.BACKGROUND))
 
     @util.coro_cleanup
     async def connect(self):
         self.state_set(messages.BackendState.CONNECTING)
         try:
+            if self.stored_cursor is None:
+                await self.hydrate()
             self.params = None
             last_event_id = None
             attempt = 0
@@ -172,6 +175,11 @@ class Zulip(messages.SnipeBackend, util.HTTP_JSONmixin):
                     await self.connected.set()
                     self.state_set(messages.BackendState.IDLE)
 
+                    try:
+                        await self.catch_up()
+                    except Exception:
+                        self.log.exception('catching up')
+
                 self.log.debug(
                     'getting events, queue_id=%s, last_event_id=%s',
                     queue_id, last_event_id)
@@ -203,32 +211,64 @@ class Zulip(messages.SnipeBackend, util.HTTP_JSONmixin):
                     await imbroglio.switch()
 
                 if msgs:
-                    self.messages.extend(msgs)
-                    self.drop_cache()
-                    await imbroglio.switch()
                     # make sure that the message list remains
                     # monotonically increasing by comparing the new
                     # messages (and the last old message) pairwise.
-                    self.readjust(self.messages[-len(msgs) - 1:])
+                    self.readjust(self.messages[-1:] + msgs)
+                    self.messages.extend(msgs)
                     await imbroglio.switch()
                     self.redisplay(msgs[0], msgs[-1])
+                    await self.persist(msgs)
         finally:
             self.connected.clear()
             self.state_set(messages.BackendState.DISCONNECTED)
 
         self.log.debug('connect ends')
 
+    async def catch_up(self):
+        """Get whatever arrived after the newest message we have (say, from
+        the message store) while we weren't listening."""
+        while self.messages:
+            result = await self._get(
+                'messages', num_before=0, num_after=1024,
+                anchor=self.messages[-1].data['id'], apply_markdown='false')
+            await imbroglio.switch()
+            if result.get('result') != 'success':
+                self.log.error('catching up: %s', repr(result))
+                return
+            msgs = [
+                ZulipMessage(self, m) for m in result['messages']
+                if m['id'] not in self.messages_by_id]
+            self.log.debug('caught up %d messages', len(msgs))
+            if not msgs:
+                return
+            await self.prerender(msgs)
+            self.readjust(self.messages[-1:] + msgs)
+            self.messages.extend(msgs)
+            self.redisplay(msgs[0], msgs[-1])
+            await self.persist(msgs)
+            if result.get('found_newest'):
+                return
+
     async def process_event(self, event, last_event_id):
         type_ = event.get('type')
         msg = None
         if type_ == 'message':
-            msg = ZulipMessage(self, event['message'])
+            if event['message']['id'] not in self.messages_by_id:
+                # (or we already got it catching up); it's rendered when
+                # it's displayed, since it's just the one
+                msg = ZulipMessage(self, event['message'])
         elif type_ == 'update_message':
             self.log.debug('update_message event: %s', repr(event))
+            updated = []
             for mid in event.get('message_ids', [event['message_id']]):
                 if mid in self.messages_by_id:
                     m = self.messages_by_id[mid]
                     m.update(event)
+                    updated.append(m)
+            if updated:
+                self.drop_cache()
+            await self.persist(updated)
         elif type_ in ('heartbeat', 'presence'):
             pass
         else:
@@ -253,20 +293,47 @@ class Zulip(messages.SnipeBackend, util.HTTP_JSONmixin):
                 pass  # just ignore it
             await imbroglio.sleep(60)
 
+    async def prerender(self, msgs):
+        """Render the markdown of messages in a worker process, so that
+        displaying them doesn't have to do it on the main thread."""
+        datas = [m.data for m in msgs if '_html' not in m.data]
+        if not datas:
+            return
+        try:
+            rendered = await imbroglio.run_in_process(
+                markdown_to_xhtml, [markdown_source(d) for d in datas])
+        except Exception:
+            self.log.exception('prerendering, will render on display')
+            return
+        for data, html in zip(datas, rendered):
+            # if the message was edited meanwhile, this is the old data
+            data.setdefault('_html', html)
+
     @staticmethod
     def readjust(msgs):
         for a, b in zip(msgs[:-1], msgs[1:]):
             if b.time <= a.time:
                 b.time = a.time + .0001
 
+    @staticmethod
+    def readjust_before(msgs, following):
+        """Like readjust, but for msgs that go before following, so
+        it's msgs that get moved (backwards)."""
+        msgs = msgs + following
+        for a, b in reversed(list(zip(msgs[:-1], msgs[1:]))):
+            if a.time >= b.time:
+                a.time = b.time - .0001
+
     def backfill(self, mfilter, target=None):
         self.log.debug(
             'backfill(mfilter=%s, target=%s)',
             repr(mfilter), util.timestr(target))
         self.reap_tasks()
+        if self.backfill_stored():
+            return
         if not self.backfilling and not self.loaded:
-            self.tasks.append(
-                self.supervisor.start(self.do_backfill(mfilter, target)))
+            self.tasks.append(self.supervisor.start(
+                self.do_backfill(mfilter, target), imbroglio.BACKGROUND))
 
     async def do_backfill(self, mfilter, target):
         if self.backfilling:
@@ -286,6 +353,7 @@ class Zulip(messages.SnipeBackend, util.HTTP_JSONmixin):
                 self.log.error('backfilling: %s', repr(result))
                 return
             msgs = [ZulipMessage(self, m) for m in result['messages']]
+            await self.prerender(msgs)
             self.log.debug('got %d: %s', len(msgs),  repr(msgs[-1]))
             if msgs and self.messages:
                 self.log.debug('had %s', repr(self.messages[0]))
@@ -294,15 +362,32 @@ class Zulip(messages.SnipeBackend, util.HTTP_JSONmixin):
                 if not msgs:
                     self.log.debug('loaded')
                     self.loaded = True
-            self.messages = msgs + self.messages
-            self.readjust(self.messages)
-            self.drop_cache()
+            self.readjust_before(msgs, self.messages[:1])
+            self.messages.update(msgs)
+            await self.persist(msgs)
         except Exception:
             self.log.exception('backfilling')
         finally:
             self.state_set(messages.BackendState.IDLE)
             self.backfilling = False
 
+    def store_key(self, msg):
+        if isinstance(msg, ZulipMessage):
+            return msg.data['id']
+        return None
+
+    def store_data(self, msg):
+        # leave out the rendered chunks, here and in the edit history
+        def clean(data):
+            data = {k: v for (k, v) in data.items() if k != '_rendered'}
+            if isinstance(data.get('_old'), dict):
+                data['_old'] = clean(data['_old'])
+            return data
+        return clean(msg.data)
+
+    async def message_from_store(self, data):
+        return ZulipMessage(self, data)
+
     async def send(self, dest, body):
         comps = dest.split(';', 1)
         to = comps[0].strip()
@@ -470,9 +555,8 @@ class ZulipMessage(messages.SnipeMessage):
         @classmethod
         def format(self, msg, tags=set()):
             if '_html' not in msg.data:
-                body = msg.data.get('content', '')
-                body = body.replace('\r\n', '\n')  # conform to local custom
-                msg.data['_html'] = text.markdown_to_xhtml(body)
+                msg.data['_html'] = text.markdown_to_xhtml(
+                    markdown_source(msg.data))
             if '_rendered' not in msg.data:
                 msg.data['_rendered'] = text.xhtml_to_chunk(msg.data['_html'])
             # XXX what if there is color in the rendered data
@@ -480,6 +564,16 @@ class ZulipMessage(messages.SnipeMessage):
                 (tags | set(x), y) for (x, y) in msg.data['_rendered'])
 
 
+def markdown_source(data):
+    body = data.get('content', '')
+    return body.replace('\r\n', '\n')  # conform to local custom
+
+
+def markdown_to_xhtml(bodies):
+    """Render a batch of message bodies; runs in a worker process."""
+    return [text.markdown_to_xhtml(body) for body in bodies]
+
+
 class ZulipAddress(messages.SnipeAddress):
 
     def __init__(self, backend, text):
@@ -32,8 +32,10 @@
 Unit tests for the imbroglio core
 '''
 
+import selectors
 import signal
 import socket
+import threading
 import time
 import unittest
 
@@ -174,6 +176,79 @@ class TestImbroglioCore(unittest.TestCase):
             a.close()
             b.close()
 
+    def test_selector_registration(self):
+        a, b = socket.socketpair()
+
+        try:
+            async def reader():
+                await imbroglio.readwait(a)
+                self.assertEqual(b'X', a.recv(1))
+
+            async def driver():
+                supervisor = await imbroglio.get_supervisor()
+                selector = supervisor.selector
+
+                task = await imbroglio.spawn(reader())
+                await imbroglio.sleep()  # let the reader start waiting
+                self.assertEqual(
+                    [a.fileno()], list(supervisor.fd_waiters.keys()))
+                self.assertEqual(1, len(selector.get_map()))
+
+                # a second waiter on the same fd widens the registration
+                timedout, duration = \
+                    await imbroglio.writewait(a.fileno(), 10)
+                self.assertFalse(timedout)
+                self.assertEqual(1, len(selector.get_map()))
+                self.assertEqual(
+                    selectors.EVENT_READ,
+                    selector.get_key(a.fileno()).events)
+
+                b.send(b'X')
+                await task
+                self.assertEqual({}, supervisor.fd_waiters)
+                self.assertEqual(0, len(selector.get_map()))
+
+                # timing out also drops the registration
+                timedout, duration = await imbroglio.readwait(a, .1)
+                self.assertTrue(timedout)
+                self.assertEqual({}, supervisor.fd_waiters)
+                self.assertEqual(0, len(selector.get_map()))
+                self.assertIs(selector, supervisor.selector)
+
+            imbroglio.run(driver())
+        finally:
+            a.close()
+            b.close()
+
+    def test_fd_reused(self):
+        a, b = socket.socketpair()
+        fd = a.fileno()
+
+        async def stale():
+            timedout, duration = await imbroglio.readwait(fd, .5)
+            self.assertTrue(timedout)
+
+        async def driver():
+            nonlocal a, b
+            task = await imbroglio.spawn(stale())
+            await imbroglio.sleep()  # let it start waiting
+            # close the fd out from under it and get the number again
+            a.close()
+            b.close()
+            a, b = socket.socketpair()
+            if a.fileno() != fd:  # pragma: nocover
+                self.skipTest('fd number not reused')
+            b.send(b'X')
+            timedout, duration = await imbroglio.readwait(a, 10)
+            self.assertFalse(timedout)
+            await task
+
+        try:
+            imbroglio.run(driver())
+        finally:
+            a.close()
+            b.close()
+
     def test_exception(self):
         async def keyerror():
             {}[None]
@@ -382,6 +457,133 @@ class TestImbroglioCore(unittest.TestCase):
 
         imbroglio.run(driver())
 
+    def test_stats(self):
+        async def spinner():
+            await imbroglio.sleep(.01)
+            t0 = time.monotonic()
+            while time.monotonic() - t0 < .05:
+                pass
+            await imbroglio.switch()
+
+        async def driver():
+            a, b = socket.socketpair()
+            with a, b:
+                t = await imbroglio.spawn(spinner())
+                b.send(b'x')
+                await imbroglio.readwait(a)
+                await t
+                return await imbroglio.stats()
+
+        stats = imbroglio.run(driver())
+        self.assertEqual(2, stats['started'])
+        self.assertEqual(1, stats['finished'])
+        self.assertGreater(stats['ticks'], 0)
+        self.assertGreater(stats['busy'], .05)
+        [me] = stats['tasks']
+        self.assertIn('driver', me['task'])
+        self.assertEqual(
+            {'spawn': 1, 'readwait': 1, 'taskwait': 1, 'stats': 1},
+            me['calls'])
+        self.assertEqual({'fd', 'task'}, set(me['wait_time']))
+        self.assertGreater(me['wait_time']['task'], .05)
+        [(creation, spun)] = stats['retired'].items()
+        self.assertEqual(1, spun['count'])
+        self.assertGreater(spun['run_time'], .05)
+        self.assertGreater(spun['longest_step'], .05)
+
+    def test_priority(self):
+        order = []
+
+        async def worker(name, n=3):
+            for i in range(n):
+                order.append(name)
+                await imbroglio.sleep()
+
+        async def driver():
+            supervisor = await imbroglio.get_supervisor()
+            b = supervisor.start(worker('b'), imbroglio.BACKGROUND)
+            n = supervisor.start(worker('n'))
+            i = supervisor.start(worker('i'), imbroglio.INTERACTIVE)
+            self.assertEqual(imbroglio.BACKGROUND, b.priority)
+            self.assertEqual(imbroglio.NORMAL, n.priority)
+            self.assertEqual(imbroglio.INTERACTIVE, i.priority)
+            await i
+            await n
+            await b
+
+        imbroglio.run(driver(), priority=imbroglio.BACKGROUND)
+        # each only gets a turn once the more urgent ones are waiting
+        self.assertEqual(['i'] * 3 + ['n'] * 3 + ['b'] * 3, order)
+
+    def test_virtual_clock(self):
+        t0 = time.monotonic()
+
+        async def sleeper(n):
+            for i in range(n):
+                await imbroglio.sleep(60)
+            return await imbroglio.get_supervisor()
+
+        async def driver():
+            a, b = socket.socketpair()
+            with a, b:
+                supervisor = await imbroglio.get_supervisor()
+                self.assertIsInstance(supervisor, imbroglio.VirtualSupervisor)
+                self.assertEqual(0.0, supervisor.clock())
+                t = await imbroglio.spawn(sleeper(60))
+
+                # fds are still real, and don't advance the clock
+                b.send(b'x')
+                timedout, duration = await imbroglio.readwait(a, 3600)
+                self.assertFalse(timedout)
+                self.assertEqual(0.0, duration)
+                a.recv(1)
+
+                async with imbroglio.Timeout(90):
+                    await imbroglio.readwait(a, 7200)
+                self.assertEqual(90.0, supervisor.clock())
+
+                timedout, duration = await imbroglio.taskwait(t)
+                self.assertEqual(3600.0 - 90.0, duration)
+                self.assertEqual(3600.0, supervisor.clock())
+
+        imbroglio.run(driver(), virtual=True)
+        self.assertLess(time.monotonic() - t0, 1)
+
+    def test_wait_indexes(self):
+        async def sleepy():
+            await imbroglio.sleep(30)
+
+        async def waiter(task):
+            timedout, duration = await imbroglio.taskwait(task, 30)
+            self.assertFalse(timedout)
+
+        async def driver():
+            supervisor = await imbroglio.get_supervisor()
+
+            sleepers = [
+                (await imbroglio.spawn(sleepy())) for i in range(200)]
+            waiters = [
+                (await imbroglio.spawn(waiter(sleepers[0])))
+                for i in range(10)]
+            await imbroglio.sleep()
+            self.assertEqual(210, len(supervisor.waitq))
+            self.assertEqual(
+                10, len(supervisor.task_waiters[sleepers[0]]))
+
+            for t in sleepers:
+                t.cancel()
+            for t in waiters:
+                await t
+            for t in sleepers:
+                await t
+
+            self.assertEqual({}, supervisor.waitq)
+            self.assertEqual({}, supervisor.task_waiters)
+            # the cancelled timers got compacted out of the heap
+            self.assertLess(len(supervisor.timers), 210)
+
+        imbroglio.run(driver())
+
     def test_taskwait_done(self):
         async def quick():
             pass
@@ -475,6 +677,43 @@ class TestImbroglioTools(unittest.TestCase):
         imbroglio.run(driver())
         self.assertTrue(flag)
 
+    def test_timeout_nested(self):
+        async def driver():
+            # the inner one fires and the outer one doesn't notice
+            async with imbroglio.Timeout(1) as outer:
+                async with imbroglio.Timeout(.05) as inner:
+                    await imbroglio.sleep(1)
+                self.assertIsInstance(inner.exception, imbroglio.TimeoutError)
+            self.assertIsNone(outer.exception)
+
+            # the outer one fires through the inner one
+            reached = False
+            async with imbroglio.Timeout(.05) as outer:
+                async with imbroglio.Timeout(1) as inner:
+                    await imbroglio.sleep(1)
+                reached = True
+            self.assertFalse(reached)
+            self.assertIsNone(inner.exception)
+            self.assertIsInstance(outer.exception, imbroglio.TimeoutError)
+
+            self.assertEqual([], (await imbroglio.this_task()).deadlines)
+
+            # a deadline that has already passed fires at the next wait
+            async with imbroglio.Timeout(0) as t:
+                time.sleep(.01)
+                await imbroglio.sleep(1)
+            self.assertIsNotNone(t.exception)
+
+            # it costs no tasks and no ticks
+            supervisor = await imbroglio.get_supervisor()
+            started, ticks = supervisor.started, supervisor.ticks
+            async with imbroglio.Timeout(1):
+                pass
+            self.assertEqual(started, supervisor.started)
+            self.assertEqual(ticks, supervisor.ticks)
+
+        imbroglio.run(driver())
+
     def test_gather(self):
         a = False
         b = False
@@ -587,6 +826,85 @@ class TestImbroglioTools(unittest.TestCase):
 
         imbroglio.run(check_raise())
 
+    def test_thread_pool(self):
+        pool = imbroglio.ThreadPool(2)
+        running = 0
+        most = 0
+        lock = threading.Lock()
+
+        def work(n):
+            nonlocal running, most
+            with lock:
+                running += 1
+                most = max(most, running)
+            time.sleep(.1)
+            with lock:
+                running -= 1
+            return n * 2
+
+        async def driver():
+            results = await imbroglio.gather(
+                *[pool.run(work, i) for i in range(6)])
+            self.assertEqual([i * 2 for i in range(6)], results)
+
+        imbroglio.run(driver())
+
+        self.assertEqual(2, most)
+        stats = pool.stats()
+        self.assertEqual(2, stats['threads'])
+        self.assertEqual(6, stats['submitted'])
+        self.assertEqual(6, stats['completed'])
+        self.assertEqual(0, stats['waiting'])
+        self.assertGreater(stats['max_queued'], 0)
+
+        # a cancelled caller doesn't keep the supervisor around
+        async def abandon():
+            task = await imbroglio.spawn(pool.run(time.sleep, .5))
+            await imbroglio.sleep(.1)
+            task.cancel()
+
+        t0 = time.time()
+        imbroglio.run(abandon())
+        self.assertLess(time.time() - t0, .5)
+        self.assertEqual(0, pool.stats()['waiting'])
+
+        pool.resize(1)
+        imbroglio.run(pool.run(time.sleep, .5))  # let the surplus exit
+        self.assertEqual(1, pool.stats()['threads'])
+
+    def test_process_pool(self):
+        pool = imbroglio.ProcessPool(1)
+
+        async def driver():
+            self.assertEqual(
+                [(3, 1), (2, 0)],
+                (await imbroglio.gather(
+                    pool.run(divmod, 7, 2), pool.run(divmod, 4, 2))))
+            with self.assertRaises(ValueError):
+                await pool.run(int, 'x')
+
+            # the one worker is busy, so the second call is still queued
+            # when it gets cancelled and is withdrawn, unless the executor
+            # had already passed it along to the worker
+            busy = await imbroglio.spawn(pool.run(time.sleep, .2))
+            queued = await imbroglio.spawn(pool.run(abs, -1))
+            await imbroglio.sleep(.05)
+            queued.cancel()
+            await busy
+            with self.assertRaises(imbroglio.Cancelled):
+                queued.result()
+
+        try:
+            imbroglio.run(driver())
+        finally:
+            pool.shutdown()
+        self.assertIsNone(pool.executor)
+        self.assertEqual(set(), pool.futures)
+        stats = pool.stats()
+        self.assertEqual(5, stats['submitted'])
+        self.assertIn(stats['completed'], (4, 5))
+        self.assertEqual(0, stats['waiting'])
+
     def test_process_filter(self):
         async def test():
             self.assertEqual(
@@ -601,6 +919,92 @@ class TestImbroglioTools(unittest.TestCase):
 
         imbroglio.run(test())
 
+    @imbroglio.test
+    async def test_queue(self):
+        q = imbroglio.Queue(2)
+        self.assertTrue(q.empty())
+        with self.assertRaises(imbroglio.QueueEmpty):
+            q.get_nowait()
+
+        puts = []
+
+        async def producer():
+            for i in range(5):
+                await q.put(i)
+                puts.append(i)
+
+        task = await imbroglio.spawn(producer())
+        await imbroglio.sleep()
+        # blocked with the queue full
+        self.assertEqual([0, 1], puts)
+        self.assertTrue(q.full())
+        with self.assertRaises(imbroglio.QueueFull):
+            q.put_nowait('x')
+
+        self.assertEqual(0, (await q.get()))
+        self.assertEqual([1], (await q.get_many()))
+        await imbroglio.sleep()
+        self.assertEqual([2, 3], (await q.get_many(5)))
+        await task
+        self.assertEqual([4], (await q.get_many(1)))
+
+        # a cancelled getter doesn't eat a wakeup
+        async def getter():
+            return await q.get()
+        a = await imbroglio.spawn(getter())
+        b = await imbroglio.spawn(getter())
+        await imbroglio.sleep()
+        q.put_nowait('y')
+        a.cancel()
+        await imbroglio.sleep()
+        await b
+        self.assertEqual('y', b.result())
+
+    @imbroglio.test
+    async def test_semaphore(self):
+        sem = imbroglio.Semaphore(2)
+        running = 0
+        most = 0
+
+        async def worker():
+            nonlocal running, most
+            async with sem:
+                running += 1
+                most = max(most, running)
+                await imbroglio.sleep(.01)
+                running -= 1
+
+        await imbroglio.gather(*[worker() for i in range(5)])
+        self.assertEqual(2, most)
+        self.assertFalse(sem.locked())
+
+    @imbroglio.test
+    async def test_capacity_limiter(self):
+        limiter = imbroglio.CapacityLimiter(1)
+        await limiter.acquire()
+        self.assertEqual(1, limiter.borrowed_tokens)
+        self.assertEqual(0, limiter.available_tokens)
+
+        async def waiter():
+            async with limiter:
+                return limiter.borrowed_tokens
+
+        t = await imbroglio.spawn(waiter())
+        await imbroglio.sleep()
+        self.assertFalse(t.is_done())
+
+        # making room lets the waiter in without a release
+        limiter.total_tokens = 2
+        await t
+        self.assertEqual(2, t.result())
+
+        # shrinking below what's borrowed waits for the surplus to drain
+        limiter.total_tokens = 0
+        self.assertTrue(limiter.locked())
+        limiter.release()
+        self.assertEqual(0, limiter.borrowed_tokens)
+        self.assertEqual(0, limiter.available_tokens)
+
     @imbroglio.test
     async def test_event(self):
         e = imbroglio.Event()
@@ -32,19 +32,25 @@
 Unit tests for stuff in messages.py
 '''
 
+import bisect
 import collections
 import datetime
 import itertools
 import os
+import random
+import tempfile
 import time
 import unittest
 
+from unittest.mock import patch
+
 import mocks
 
 import snipe.chunks as chunks
 import snipe.filters as filters
 import snipe.imbroglio as imbroglio
 import snipe.messages as messages
+import snipe.store as store
 import snipe.util as util
 
 
@@ -281,6 +287,55 @@ class TestBackend(unittest.TestCase):
             s.redisplay(None, None)
 
 
+class TestStoredBackend(unittest.TestCase):
+    @imbroglio.test
+    async def test(self):
+        with tempfile.TemporaryDirectory() as tmp, \
+                patch('snipe.store._message_store', None):
+            context = mocks.Context()
+            context.ui = mocks.FE()
+            s = StoredBackend(context)
+            await s.start()
+            self.assertEqual([], await s.hydrate())  # the store is off
+            self.assertFalse(s.backfill_stored())
+
+            store.message_store().path = os.path.join(tmp, 'messages.sqlite')
+            s.messages.extend(
+                StoredMessage(s, {'id': i, 'body': str(i)})
+                for i in range(10))
+            s.messages.append(messages.SnipeMessage(s, 'not stored', 10))
+            await s.persist(s.messages)
+            self.assertEqual(10, store.message_store().count(s.name))
+
+            s = StoredBackend(context)
+            s.hydrate_batch = 4
+            await s.start()
+            await s.hydrate()
+            self.assertEqual(
+                ['6', '7', '8', '9'], [m.body for m in s.messages])
+            self.assertEqual([6, 7, 8, 9], [float(m) for m in s.messages])
+
+            # a message we got some other way isn't brought in twice
+            s.messages.append(StoredMessage(s, {'id': 5, 'body': 'new'}))
+            self.assertEqual(
+                ['2', '3', '4'], [m.body for m in await s.hydrate()])
+
+            self.assertTrue(s.backfill_stored())
+            await s.hydrate_task
+            self.assertEqual(
+                ['0', '1', '2', '3', '4', 'new', '6', '7', '8', '9'],
+                [m.body for m in s.messages])
+            self.assertTrue(s.stored_exhausted)
+            self.assertFalse(s.backfill_stored())
+
+            # one that can't be loaded is skipped
+            await s.persist([StoredMessage(s, {'id': 10, 'body': None})])
+            s = StoredBackend(context)
+            with self.assertLogs(s.log.name, 'ERROR'):
+                await s.hydrate()
+            self.assertEqual(10, len(s.messages))
+
+
 class TestInfoMessage(unittest.TestCase):
     def test(self):
         m = messages.InfoMessage(None, 'foo')
@@ -320,6 +375,352 @@ class TestMerge(unittest.TestCase):
                 []])),
             [1, 2, 3, 4, 5, 6, 8])
 
+    def test_key(self):
+        self.assertEqual(
+            list(messages.merge(
+                [[5, 3, 1], [8, 6, 4, 3, 2]], key=lambda x: -x)),
+            [8, 6, 5, 4, 3, 2, 1])
+        # ties go to the earlier iterable
+        self.assertEqual(
+            list(messages.merge(
+                [[(1, 'a'), (2, 'a')], [(1, 'b'), (2, 'b')]],
+                key=lambda x: x[0])),
+            [(1, 'a'), (1, 'b'), (2, 'a'), (2, 'b')])
+
+    def test_random(self):
+        r = random.Random(0)
+        for _ in range(100):
+            iterables = [
+                sorted(r.randrange(100) for _ in range(r.randrange(50)))
+                for _ in range(r.randrange(1, 8))]
+            expected = []
+            for x in sorted(itertools.chain(*iterables)):
+                if not expected or expected[-1] != x:
+                    expected.append(x)
+            self.assertEqual(expected, list(messages.merge(iterables)))
+
+    def test_lazy(self):
+        taken = []
+
+        def numbers(start):
+            for i in itertools.count(start, 2):
+                taken.append(i)
+                yield i
+
+        merged = messages.merge([numbers(0), numbers(1), []])
+        self.assertEqual(
+            list(itertools.islice(merged, 5)), [0, 1, 2, 3, 4])
+        self.assertEqual(sorted(taken), [0, 1, 2, 3, 4, 5])
+
+
+class TestMessageList(unittest.TestCase):
+    def test(self):
+        class List(messages.MessageList):
+            BLOCK = 4
+
+        def msg(t):
+            return messages.SnipeMessage(None, str(t), t)
+
+        rand = random.Random(4)
+        times = list(range(100))
+        rand.shuffle(times)
+        ml = List()
+        self.assertFalse(ml)
+        self.assertRaises(IndexError, lambda: ml[0])
+        for t in times:
+            ml.append(msg(t))
+        self.assertEqual(list(range(100)), [m.time for m in ml])
+        self.assertEqual(100, len(ml))
+        self.assertGreater(len(ml._blocks), 10)
+        self.assertTrue(all(len(b) < 2 * List.BLOCK for b in ml._blocks))
+
+        self.assertEqual(37, ml[37].time)
+        self.assertEqual(99, ml[-1].time)
+        self.assertRaises(IndexError, lambda: ml[100])
+        self.assertEqual([5, 6, 7], [m.time for m in ml[5:8]])
+        self.assertEqual([97, 98, 99], [m.time for m in ml[-3:]])
+        self.assertEqual([0, 50], [m.time for m in ml[::50]])
+        self.assertEqual([], ml[60:50])
+        self.assertEqual(
+            list(range(99, -1, -1)), [m.time for m in reversed(ml)])
+
+        self.assertEqual(42, ml.bisect_left(42))
+        self.assertEqual(43, ml.bisect_right(42))
+        self.assertEqual(43, ml.bisect_left(42.5))
+        self.assertEqual(100, ml.bisect_left(1000))
+        self.assertEqual(42, bisect.bisect_left(ml, 42))
+        self.assertEqual(42, ml.index(42, 40, 50))
+        self.assertRaises(ValueError, lambda: ml.index(42, 43))
+        self.assertIn(42, ml)
+        self.assertNotIn(42.5, ml)
+
+        # equal ones go after
+        extra = msg(42)
+        ml.append(extra)
+        self.assertIs(extra, ml[43])
+
+        # a page in front, one at the back, and one in the middle
+        ml.update(msg(t) for t in range(-10, 0))
+        ml.update([msg(t) for t in range(200, 190, -1)])
+        ml.update(msg(t + .5) for t in range(10, 20))
+        self.assertEqual(
+            sorted(
+                list(range(-10, 100)) + [42] + list(range(191, 201))
+                + [t + .5 for t in range(10, 20)]),
+            [m.time for m in ml])
+        self.assertEqual(ml, list(ml))
+
+        # a big page goes in as blocks of its own
+        blocks = len(ml._blocks)
+        ml.extend(msg(t) for t in range(-100, -10))
+        self.assertEqual(blocks + 23, len(ml._blocks))
+        self.assertEqual(-100, ml[0].time)
+        self.assertEqual(-11, ml[89].time)
+
+        # and a page bigger than the list is merged in all at once
+        ml = List(msg(t) for t in range(0, 100, 2))
+        ml.update(msg(t) for t in range(-51, 151, 2))
+        self.assertEqual(
+            sorted(list(range(0, 100, 2)) + list(range(-51, 151, 2))),
+            [m.time for m in ml])
+
+        ml = List(msg(t) for t in range(10))
+        self.assertEqual(
+            [10, 11], [m.time for m in ml.merge(
+                [msg(3), msg(11), msg(10), msg(11)])])
+        self.assertEqual(list(range(12)), [m.time for m in ml])
+
+        ml[0].time = 20
+        ml.sort()
+        self.assertEqual(list(range(1, 12)) + [20], [m.time for m in ml])
+
+    @imbroglio.test
+    async def test_walk(self):
+        s = SyntheticBackend(mocks.Context(), conf={'count': 10})
+        await s.start()
+        s.messages = messages.MessageList(s.messages)
+        self.assertEqual(
+            [m.time for m in s.messages],
+            [m.time for m in s.walk(s.earliest())])
+        self.assertEqual(
+            [m.time for m in reversed(s.messages)][5:],
+            [m.time for m in s.walk(s.messages[4], False)])
+
+
+class TestWalkCache(unittest.TestCase):
+    class Filter:
+        """Matches messages whose bodies start with x, and counts."""
+        def __init__(self):
+            self.calls = 0
+
+        def simplify(self, env):
+            return self
+
+        def __call__(self, m):
+            self.calls += 1
+            return m.body.startswith('x')
+
+    def backend(self, bodies):
+        s = StoredBackend(mocks.Context())
+        s.filter_indices = 0  # exercise the link caches
+        s.messages.extend(
+            messages.SnipeMessage(s, body, t)
+            for (t, body) in bodies)
+        return s
+
+    def walk(self, s, mfilter, start=None, forward=True):
+        if start is None:
+            start = float('-inf') if forward else float('inf')
+        mfilter.calls = 0
+        return [m.body for m in s.walk(start, forward, mfilter=mfilter)]
+
+    def test(self):
+        mfilter = self.Filter()
+        s = self.backend(
+            [(t, 'x%d' % t if t % 10 == 0 else str(t)) for t in range(100)])
+        xs = ['x%d' % t for t in range(0, 100, 10)]
+
+        self.assertEqual(xs, self.walk(s, mfilter))
+        self.assertEqual(100, mfilter.calls)
+        self.assertEqual(xs, self.walk(s, mfilter))
+        self.assertEqual(10, mfilter.calls)  # just the matches
+        self.assertEqual(xs[::-1], self.walk(s, mfilter, forward=False))
+        self.assertEqual(100, mfilter.calls)
+        self.assertEqual(xs[::-1], self.walk(s, mfilter, forward=False))
+        self.assertEqual(10, mfilter.calls)
+
+        # new messages at the end are looked at (once), and not the rest
+        s.messages.extend([
+            messages.SnipeMessage(s, '100', 100),
+            messages.SnipeMessage(s, 'x101', 101),
+            messages.SnipeMessage(s, '102', 102),
+            ])
+        self.assertEqual(xs + ['x101'], self.walk(s, mfilter))
+        self.assertEqual(13, mfilter.calls)
+        self.assertEqual(xs + ['x101'], self.walk(s, mfilter))
+        self.assertEqual(11, mfilter.calls)
+
+        # likewise a page at the front, going backwards
+        s.messages.update(
+            messages.SnipeMessage(s, 'x%d' % t if t == -5 else str(t), t)
+            for t in range(-10, 0))
+        xs = ['x-5'] + xs + ['x101']
+        self.assertEqual(xs[::-1], self.walk(s, mfilter, forward=False))
+        # (going backwards from the end, we also have to look through what
+        # was appended as far as the first match, 90)
+        self.assertEqual(13 + 9 + 10, mfilter.calls)
+        self.assertEqual(xs[::-1], self.walk(s, mfilter, forward=False))
+        self.assertEqual(12, mfilter.calls)
+        self.assertEqual(xs, self.walk(s, mfilter))
+        self.assertEqual(21, mfilter.calls)  # -10 .. 0, then the links
+        self.assertEqual(xs, self.walk(s, mfilter))
+        self.assertEqual(12, mfilter.calls)
+
+        # something in the middle means looking at that stretch again
+        s.messages.append(messages.SnipeMessage(s, 'x55', 55.5))
+        xs.insert(7, 'x55')
+        self.assertEqual(xs, self.walk(s, mfilter))
+        self.assertEqual(22, mfilter.calls)
+        self.assertEqual(xs, self.walk(s, mfilter))
+        self.assertEqual(13, mfilter.calls)
+
+        # from somewhere in particular
+        self.assertEqual(
+            ['x30', 'x20', 'x10', 'x0', 'x-5'],
+            self.walk(s, mfilter, 35, False))
+        self.assertEqual(
+            ['x30', 'x20', 'x10', 'x0', 'x-5'],
+            self.walk(s, mfilter, 35, False))
+        self.assertEqual(5, mfilter.calls)
+
+        # edits still need the cache dropped
+        s.messages[5].body = 'x-5a'
+        s.drop_cache()
+        self.assertIn('x-5a', self.walk(s, mfilter))
+
+    def test_unfiltered(self):
+        s = self.backend([(t, str(t)) for t in range(10)])
+        for i in range(5):
+            self.assertEqual(10, len(list(s.walk(float('-inf')))))
+            self.assertEqual(10, len(list(s.walk(float('inf'), False))))
+        self.assertEqual({}, s.startcache)
+        self.assertEqual({}, s.adjcache)
+
+    def test_changing_underfoot(self):
+        mfilter = self.Filter()
+        s = self.backend([(t, 'x%d' % t) for t in range(10)])
+        seen = []
+        for m in s.walk(float('-inf'), mfilter=mfilter):
+            seen.append(m.body)
+            if m.time == 5:
+                s.messages.update(
+                    messages.SnipeMessage(s, 'x%d' % t, t)
+                    for t in range(-5, 0))
+        self.assertEqual(['x%d' % t for t in range(10)], seen)
+
+
+class TestFilterIndex(unittest.TestCase):
+    Filter = TestWalkCache.Filter
+
+    def backend(self, times):
+        s = StoredBackend(mocks.Context())
+        s.messages.extend(self.messages(s, times))
+        return s
+
+    def messages(self, s, times):
+        return [
+            messages.SnipeMessage(s, ('x%d' if t % 10 == 0 else '%d') % t, t)
+            for t in times]
+
+    def walk(self, s, mfilter, start=None, forward=True):
+        if start is None:
+            start = float('-inf') if forward else float('inf')
+        return [m.time for m in s.walk(start, forward, mfilter=mfilter)]
+
+    def test(self):
+        mfilter = self.Filter()
+        s = self.backend(range(100))
+        xs = list(range(0, 100, 10))
+
+        self.assertEqual(xs, self.walk(s, mfilter))
+        self.assertEqual(100, mfilter.calls)
+        self.assertEqual(xs[::-1], self.walk(s, mfilter, forward=False))
+        self.assertEqual(100, mfilter.calls)  # no more looking
+
+        self.assertEqual([50, 60, 70, 80, 90], self.walk(s, mfilter, 50))
+        self.assertEqual([60, 70, 80, 90], self.walk(s, mfilter, 55))
+        self.assertEqual([50, 40, 30, 20, 10, 0], self.walk(
+            s, mfilter, 50, False))
+        self.assertEqual([50, 40, 30, 20, 10, 0], self.walk(
+            s, mfilter, 55, False))
+        self.assertEqual([50, 60, 70, 80, 90], self.walk(
+            s, mfilter, s.messages[50]))
+        self.assertEqual([40, 30, 20, 10, 0], self.walk(
+            s, mfilter, s.messages[49], False))
+        self.assertEqual(100, mfilter.calls)
+
+        # new messages are looked at once, wherever they land
+        s.messages.extend(self.messages(s, range(100, 120)))
+        s.messages.extend(self.messages(s, range(-20, 0)))
+        s.messages.append(messages.SnipeMessage(s, 'x', 45))
+        self.assertEqual(141, mfilter.calls)
+        self.assertEqual(
+            [-20, -10] + xs[:5] + [45] + xs[5:] + [100, 110],
+            self.walk(s, mfilter))
+        self.assertEqual(141, mfilter.calls)
+
+        s.drop_cache()
+        self.assertEqual(
+            [-20, -10] + xs[:5] + [45] + xs[5:] + [100, 110],
+            self.walk(s, mfilter))
+        self.assertEqual(282, mfilter.calls)
+
+    def test_lru(self):
+        s = self.backend(range(10))
+        s.filter_indices = 2
+        a, b, c = self.Filter(), self.Filter(), self.Filter()
+        for mfilter in (a, b, a, c):
+            self.assertEqual([0], self.walk(s, mfilter))
+        self.assertEqual([a, c], list(s.indices))
+        self.assertEqual((10, 10, 10), (a.calls, b.calls, c.calls))
+        self.walk(s, b)
+        self.assertEqual((10, 20, 10), (a.calls, b.calls, c.calls))
+        self.assertEqual([c, b], list(s.indices))
+
+    def test_filter_conf(self):
+        s = self.backend(range(10))
+        mfilter = self.Filter()
+        self.walk(s, mfilter)
+        self.walk(s, mfilter)
+        self.assertEqual(10, mfilter.calls)
+        s.context.conf.setdefault('filter', {})['foo'] = 'yes'
+        self.walk(s, mfilter)
+        self.assertEqual(20, mfilter.calls)
+
+    def test_changing_underfoot(self):
+        mfilter = self.Filter()
+        s = self.backend(range(0, 100, 10))
+        seen = []
+        for m in s.walk(float('-inf'), mfilter=mfilter):
+            seen.append(m.time)
+            if m.time == 50:
+                s.messages.update(self.messages(s, range(-50, 0, 10)))
+        self.assertEqual(list(range(0, 100, 10)), seen)
+
+        seen = []
+        for m in s.walk(float('inf'), False, mfilter=mfilter):
+            seen.append(m.time)
+            if m.time == 50:
+                s.messages.update(self.messages(s, range(100, 150, 10)))
+        self.assertEqual(list(range(90, -60, -10)), seen)
+
+    def test_plain_list(self):
+        s = StoredBackend(mocks.Context())
+        s.messages = self.messages(s, range(20))
+        mfilter = self.Filter()
+        self.assertEqual([0, 10], self.walk(s, mfilter))
+        self.assertFalse(s.indices)
+
 
 class TestAggregator(unittest.TestCase):
     @imbroglio.test
@@ -420,6 +821,51 @@ class TestAggregator(unittest.TestCase):
 
         self.assertEqual(a.statusline(), '[synthetic BACKFILLING]')
 
+    def test_extremes(self):
+        context = mocks.Context()
+        sink = messages.SinkBackend(context)
+        stored = StoredBackend(context)
+        stored.messages = [messages.SnipeMessage(stored, 'x', 10.0)]
+        a = messages.AggregatorBackend(context, [sink, stored])
+
+        calls = 0
+
+        def counting(method):
+            def wrapper():
+                nonlocal calls
+                calls += 1
+                return method()
+            return wrapper
+
+        for backend in a:
+            backend.earliest = counting(backend.earliest)
+        self.assertEqual(10.0, a.earliest().time)
+        self.assertEqual(10.0, a.eldest())
+        self.assertEqual(float('inf'), a.latest().time)
+        calls = 0
+        for i in range(3):
+            self.assertEqual(10.0, a.earliest().time)
+            self.assertEqual(10.0, a.eldest())
+        self.assertEqual(0, calls)
+
+        # adding to a MessageList
+        sink.messages.append(messages.SnipeMessage(sink, 'y', 5.0))
+        self.assertEqual(5.0, a.earliest().time)
+        self.assertEqual(5.0, a.eldest())
+        self.assertEqual(3, calls)
+
+        # a change the backend announces
+        stored.messages[0].time = 1.0
+        self.assertEqual(5.0, a.eldest())
+        stored.redisplay(stored.messages[0], stored.messages[0])
+        self.assertEqual(1.0, a.eldest())
+
+        # a new backend
+        sink2 = messages.SinkBackend(context)
+        sink2.messages.append(messages.SnipeMessage(sink2, 'z', 0.5))
+        a.backends.append(sink2)
+        self.assertEqual(0.5, a.eldest())
+
 
 class SyntheticBackend(messages.SnipeBackend):
     name = 'synthetic'
@@ -449,5 +895,29 @@ class SyntheticBackend(messages.SnipeBackend):
             for i in range(count)]
 
 
+class StoredMessage(messages.SnipeMessage):
+    def __init__(self, backend, data):
+        super().__init__(backend, data['body'], float(data['id']))
+        self.data = data
+
+
+class StoredBackend(messages.SnipeBackend):
+    name = 'stored'
+
+    def __init__(self, *args, **kw):
+        super().__init__(*args, **kw)
+        self.messages = messages.MessageList()
+
+    def store_key(self, msg):
+        if isinstance(msg, StoredMessage):
+            return msg.data['id']
+        return None
+
+    async def message_from_store(self, data):
+        if data['body'] is None:
+            raise ValueError('no body')
+        return StoredMessage(self, data)
+
+
 if __name__ == '__main__':
     unittest.main()
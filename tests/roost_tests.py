@@ -141,6 +141,27 @@ class TestRoost(unittest.TestCase):
         r.construct_and_maybe_decrypt.assert_called_with({})
         r.add_message.assert_called_with(o)
 
+    @imbroglio.test
+    async def test_process_incoming(self):
+        r = roost.Roost(mocks.Context())
+        r.incoming = imbroglio.Queue(1)
+        seen = []
+
+        async def new_message(m):
+            seen.append(m)
+            if m['id'] == 2:
+                raise Exception('should be logged and ignored')
+        r.new_message = new_message
+
+        consumer = await imbroglio.spawn(r.process_incoming())
+        for i in range(4):
+            await r.queue_message({'id': i})
+        await imbroglio.sleep()
+        consumer.cancel()
+
+        self.assertEqual([{'id': i} for i in range(4)], seen)
+        self.assertEqual(3, r.queued_id)
+
     def test_add_message(self):
         r = roost.Roost(mocks.Context())
 
@@ -150,7 +171,7 @@ class TestRoost(unittest.TestCase):
         m = messages.SnipeMessage(r, 'foo', 1.0)
         r.add_message(m)
 
-        r.drop_cache.assert_called()
+        r.drop_cache.assert_not_called()  # walk copes with additions
         r.redisplay.assert_called_with(m, m)
 
         m = messages.SnipeMessage(r, 'bar', 1.0)
@@ -338,6 +338,29 @@ class TestSlack(unittest.TestCase):
         s.dump_meta(window)
         window.show.assert_called_with('{}')
 
+    @imbroglio.test
+    async def test_backfill_concurrency(self):
+        s = slack.Slack(None, name='test')
+        s.dests = {
+            f'C{i}': slack.SlackDest(s, 'group', {'name': f'g{i}'})
+            for i in range(5)}
+        running = 0
+        most = 0
+
+        async def method(*args, **kw):
+            nonlocal running, most
+            running += 1
+            most = max(most, running)
+            await imbroglio.sleep(.01)
+            running -= 1
+            return {'ok': True, 'messages': []}
+        s.method = method
+
+        with patch.object(slack.Slack, 'backfill_concurrency', 2):
+            await s.do_backfill(None, None)
+        self.assertEqual(2, most)
+        self.assertTrue(all(d.loaded for d in s.dests.values()))
+
     @imbroglio.test
     async def test_method(self):
         s = slack.Slack(None, name='test')
@@ -348,7 +371,13 @@ class TestSlack(unittest.TestCase):
             'foo',
             (await s.method('method')))
 
-        s._post.assert_called_with('method', token='TOKEN')
+        s._post.assert_called_with('method', _coalesce=False, token='TOKEN')
+
+        s._post = Mock(return_value=mocks.promise('foo'))
+        await s.method('conversations.history', channel='C')
+        s._post.assert_called_with(
+            'conversations.history', _coalesce=True, channel='C',
+            token='TOKEN')
 
     def test_check(self):
         s = slack.Slack(None, name='test')
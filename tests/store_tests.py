@@ -0,0 +1,98 @@
+# -*- encoding: utf-8 -*-
+# Copyright © 2026 the Snipe contributors
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+#
+# 1. Redistributions of source code must retain the above copyright
+# notice, this list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above
+# copyright notice, this list of conditions and the following
+# disclaimer in the documentation and/or other materials provided
+# with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND
+# CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES,
+# INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS
+# BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+# EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED
+# TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+# DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON
+# ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR
+# TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF
+# THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF
+# SUCH DAMAGE.
+
+'''
+Unit tests for the message store
+'''
+
+import os
+import stat
+import tempfile
+import unittest
+
+from unittest.mock import patch
+
+import snipe.store as store
+
+
+class TestMessageStore(unittest.TestCase):
+    def test(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'snipe', 'messages.sqlite')
+            s = store.MessageStore(path)
+            self.assertEqual([], s.load('a'))
+
+            s.save('a', [(i, float(i), {'n': i}) for i in range(10)])
+            s.save('b', [('x', 5.0, ['other'])])
+            self.assertEqual(0o600, stat.S_IMODE(os.stat(path).st_mode))
+            self.assertEqual(
+                0o700, stat.S_IMODE(os.stat(os.path.dirname(path)).st_mode))
+
+            self.assertEqual(10, s.count('a'))
+            self.assertEqual([('x', 5.0, ['other'])], s.load('b'))
+
+            rows = s.load('a', limit=4)
+            self.assertEqual(
+                [('6', 6.0, {'n': 6}), ('7', 7.0, {'n': 7}),
+                 ('8', 8.0, {'n': 8}), ('9', 9.0, {'n': 9})],
+                rows)
+            self.assertEqual(
+                ['2', '3', '4', '5'],
+                [k for (k, _, _) in s.load('a', (6.0, '6'), 4)])
+            self.assertEqual(
+                ['0', '1'], [k for (k, _, _) in s.load('a', (2.0, '2'), 4)])
+
+            # ties in time are broken by key, so nothing falls in a crack
+            s.save('a', [('1a', 1.0, None), ('1b', 1.0, None)])
+            self.assertEqual(
+                ['0', '1'], [k for (k, _, _) in s.load('a', (1.0, '1a'))])
+
+            # storing it again replaces it
+            s.save('a', [(9, 9.5, {'n': 9, 'edited': True})])
+            self.assertEqual(
+                [('9', 9.5, {'n': 9, 'edited': True})], s.load('a', limit=1))
+            self.assertEqual(12, s.count('a'))
+
+            s.close()
+            s = store.MessageStore(path)
+            self.assertEqual(12, s.count('a'))
+
+            s.path = None
+            self.assertIsNone(s._db)
+
+    def test_singleton(self):
+        with patch('snipe.store._message_store', None):
+            s = store.message_store()
+            self.assertIs(s, store.message_store())
+            self.assertIsNone(s.path)
+
+
+if __name__ == '__main__':
+    unittest.main()
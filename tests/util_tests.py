@@ -34,6 +34,7 @@ Unit tests for stuff in util.py
 
 
 import email.parser
+import errno
 import inspect
 import json
 import logging
@@ -42,12 +43,14 @@ import random
 import socket
 import ssl
 import tempfile
+import time
 import unittest
 import zlib
 
 from typing import (Dict)
-from unittest.mock import (patch)
+from unittest.mock import (Mock, patch)
 
+import h11
 import wsproto
 
 from wsproto import (events)
@@ -329,7 +332,9 @@ class MockHTTP:
             json=None,
             data={},
             headers=(),
-            log=None):
+            log=None,
+            pool=None,
+            label=None):
         self.url = url
         self._method = method
         self._json = json
@@ -387,18 +392,396 @@ class TestHTTP_JSONmixin(unittest.TestCase):
             self.assertEqual('foo', imbroglio.run(hjm._get('/foo')))
             self.assertEqual(_HTTP._method, 'GET')
 
+            # GETs, and other requests if asked, go through single_flight
+            with patch('snipe.util._single_flight', None):
+                async def requests():
+                    return [
+                        await hjm._get('/foo'),
+                        await hjm._post('/foo'),
+                        await hjm._post('/foo', _coalesce=True),
+                        ]
+
+                self.assertEqual(['foo'] * 3, imbroglio.run(requests()))
+                self.assertEqual(
+                    {'calls': 2, 'shared': 0, 'in flight': 0},
+                    snipe.util.single_flight().stats())
+
             self.assertEqual('foo', imbroglio.run(hjm._patch('/foo')))
             self.assertEqual(_HTTP._method, 'PATCH')
 
+            _HTTP.blobs = [b'[1, "tw', b'o", {"th', b'ree": 3}', b']']
+
+            async def collect():
+                result = []
+                async with hjm._get_stream('/foo', a='b') as stream:
+                    async for item in stream:
+                        result.append((item, _HTTP.blobindex))
+                return result, stream.array
+
+            self.assertEqual(
+                ([(1, 1), ('two', 2), ({'three': 3}, 3)], True),
+                imbroglio.run(collect()))
+            self.assertEqual('http://example.com/foo?a=b', _HTTP.url)
+
+            _HTTP.blobs = [b'{"success": ', b'false}']
+            self.assertEqual(
+                ([({'success': False}, 2)], False), imbroglio.run(collect()))
+
+            _HTTP.blobs = [b'[1, 2', b'zog']
+            with self.assertRaises(snipe.util.JSONDecodeError) as ar:
+                imbroglio.run(collect())
+            self.assertIn('zog', str(ar.exception))
+
             imbroglio.run(hjm.shutdown())
             self.assertTrue(hjm._is_shutdown)
 
 
+class TestSingleFlight(unittest.TestCase):
+    @snipe.imbroglio.test
+    async def test(self):
+        sf = snipe.util.SingleFlight()
+        calls = []
+
+        async def fetch(x):
+            calls.append(x)
+            await imbroglio.sleep(.01)
+            if x == 'bad':
+                raise ValueError(x)
+            return {'x': [x]}
+
+        results = await imbroglio.gather(
+            sf.run('a', fetch, 'a'),
+            sf.run('a', fetch, 'a'),
+            sf.run('b', fetch, 'b'),
+            )
+        self.assertEqual([{'x': ['a']}, {'x': ['a']}, {'x': ['b']}], results)
+        self.assertIsNot(results[0]['x'], results[1]['x'])  # copies
+        self.assertEqual(['a', 'b'], calls)
+        self.assertEqual(
+            {'calls': 2, 'shared': 1, 'in flight': 0}, sf.stats())
+
+        # not in flight any more, so it's done again
+        self.assertEqual({'x': ['a']}, await sf.run('a', fetch, 'a'))
+        self.assertEqual(['a', 'b', 'a'], calls)
+
+        results = await imbroglio.gather(
+            sf.run('bad', fetch, 'bad'),
+            sf.run('bad', fetch, 'bad'),
+            return_exceptions=True)
+        self.assertEqual(2, len([r for r in results if isinstance(
+            r, ValueError)]))
+        self.assertEqual(1, calls.count('bad'))
+
+        # if the one doing the work is cancelled, a waiter takes over
+        leader = await imbroglio.spawn(sf.run('c', fetch, 'c'))
+        await imbroglio.sleep()
+        follower = await imbroglio.spawn(sf.run('c', fetch, 'c'))
+        await imbroglio.sleep()
+        leader.cancel()
+        await follower
+        self.assertEqual({'x': ['c']}, follower.result())
+        self.assertEqual(2, calls.count('c'))
+
+        # a waiter that gives up stops waiting
+        leader = await imbroglio.spawn(sf.run('d', fetch, 'd'))
+        await imbroglio.sleep()
+        async with imbroglio.Timeout(.001) as t:
+            await sf.run('d', fetch, 'd')
+        self.assertIsNotNone(t.exception)
+        self.assertEqual([], sf.flights['d'])
+        await leader
+        self.assertEqual({}, sf.flights)
+
+
+class ConditionalHTTP:
+    """Pretends to be a server that sends an ETag."""
+
+    def __init__(self, body, etag):
+        self.body = body
+        self.etag = etag
+        self.requests = []
+
+    async def request(self, url, method='GET', *, headers=(), **kw):
+        self.requests.append(dict(headers))
+        response = ConditionalHTTP(self.body, self.etag)
+        response.url = url
+        if dict(headers).get('If-None-Match') == self.etag:
+            response.response = h11.Response(status_code=304, headers=[])
+            response.blobs = []
+        else:
+            response.response = h11.Response(
+                status_code=200, headers=[('ETag', self.etag)])
+            response.blobs = [self.body]
+        return response
+
+    async def readsome(self):
+        return self.blobs.pop(0) if self.blobs else None
+
+    async def close(self):
+        pass
+
+
+class TestResponseCache(unittest.TestCase):
+    @snipe.imbroglio.test
+    async def test(self):
+        hjm = JSONMixinTester()
+        hjm.log = logging.getLogger('test_response_cache')
+        hjm.url = 'http://example.com'
+        hjm.setup_client_session()
+
+        async def get():
+            return await hjm._get('/foo', _cache=True)
+
+        with tempfile.TemporaryDirectory() as tmp, \
+                patch('snipe.util._response_cache', None), \
+                patch('snipe.util._single_flight', None), \
+                patch('snipe.util.HTTP', ConditionalHTTP(
+                    b'{"big": "payload"}', '"v1"')) as server:
+            cache = snipe.util.response_cache()
+            self.assertIsNone(cache.directory)  # off until configured
+            self.assertEqual({'big': 'payload'}, await get())
+            self.assertEqual(
+                {'hits': 0, 'misses': 0, 'stored': 0}, cache.stats())
+
+            cache.directory = os.path.join(tmp, 'http-cache')
+            self.assertEqual({'big': 'payload'}, await get())
+            self.assertNotIn('If-None-Match', server.requests[-1])
+            self.assertEqual(
+                {'hits': 0, 'misses': 1, 'stored': 1}, cache.stats())
+            [entry] = os.listdir(cache.directory)
+            self.assertEqual(
+                0o600, os.stat(os.path.join(cache.directory, entry)).st_mode
+                & 0o777)
+
+            self.assertEqual({'big': 'payload'}, await get())
+            self.assertEqual('"v1"', server.requests[-1]['If-None-Match'])
+            self.assertEqual(
+                {'hits': 1, 'misses': 1, 'stored': 1}, cache.stats())
+
+            # POSTs, or different headers, aren't the same request
+            await hjm._post('/foo')
+            self.assertNotIn('If-None-Match', server.requests[-1])
+            await hjm._request(
+                'http://example.com/foo', headers=[('Cookie', 'other')],
+                _cache=True)
+            self.assertNotIn('If-None-Match', server.requests[-1])
+
+            # changed on the server
+            server.body, server.etag = b'"new"', '"v2"'
+            self.assertEqual('new', await get())
+            self.assertEqual('"v1"', server.requests[-1]['If-None-Match'])
+            self.assertEqual('new', await get())
+            self.assertEqual('"v2"', server.requests[-1]['If-None-Match'])
+
+            # the server says 304 but the file is gone
+            os.unlink(os.path.join(cache.directory, entry))
+            with patch.object(cache, 'validators', return_value=[
+                    ('If-None-Match', '"v2"')]):
+                with self.assertLogs('ResponseCache'):
+                    self.assertEqual('new', await get())
+            self.assertNotIn('If-None-Match', server.requests[-1])
+
+            # no response line (as from a mock) isn't a crash
+            with patch.object(server, 'request') as request:
+                response = ConditionalHTTP(b'{}', None)
+                response.url, response.response = 'http://example.com', None
+                response.blobs = [b'{}']
+                request.return_value = response
+                self.assertEqual({}, await get())
+
+            # only when asked
+            before = cache.stats()
+            await hjm._get('/foo')
+            self.assertNotIn('If-None-Match', server.requests[-1])
+            self.assertEqual(before, cache.stats())
+
+            # no validators, nothing kept
+            cache.store('nothing', 'http://example.com/bar', [], b'')
+            self.assertFalse(os.path.exists(cache.path('nothing')))
+
+    def test_configurable(self):
+        context = mocks.Context()
+        context.directory = '/tmp/snipe'
+        with patch('snipe.util._response_cache', None):
+            snipe.util.Configurable.registry['http.cache'].action(
+                context, True)
+            self.assertEqual(
+                '/tmp/snipe/http-cache', snipe.util.response_cache().directory)
+            snipe.util.Configurable.registry['http.cache'].action(
+                context, False)
+            self.assertIsNone(snipe.util.response_cache().directory)
+
+
+class TestRateLimiting(unittest.TestCase):
+    def test_token_bucket(self):
+        now = [1000.0]
+        with patch('time.monotonic', lambda: now[0]):
+            b = snipe.util.TokenBucket(rate=2, burst=2)
+            self.assertEqual(0, b.delay())
+            self.assertEqual(0, b.delay())
+            self.assertEqual(.5, b.delay())
+            now[0] += .25
+            self.assertEqual(.25, b.delay())
+            now[0] += .25
+            self.assertEqual(0, b.delay())
+            now[0] += 10
+            b.hold(3)
+            self.assertEqual(3, b.delay())
+            now[0] += 3
+            self.assertEqual(0, b.delay())
+
+            b = snipe.util.TokenBucket()
+            for i in range(100):
+                self.assertEqual(0, b.delay())
+            b.hold(1)
+            self.assertEqual(1, b.delay())
+
+    @snipe.imbroglio.test
+    async def test_acquire(self):
+        b = snipe.util.TokenBucket(rate=100, burst=1)
+        t0 = time.monotonic()
+        for i in range(3):
+            await b.acquire()
+        self.assertGreaterEqual(time.monotonic() - t0, .015)
+        self.assertGreater(b.waited, 0)
+
+    def test_limiter(self):
+        limiter = snipe.util.RateLimiter(snipe.util.coerce_rate_limits(
+            'slack.com/api/conversations.history=0.8:8, slack.com/api=5'))
+        self.assertEqual({
+            'slack.com/api/conversations.history': (.8, 8.0),
+            'slack.com/api': (5.0, 1.0),
+            }, limiter.limits)
+        history = limiter.bucket(
+            'a', 'https://slack.com/api/conversations.history?x=y')
+        self.assertEqual((.8, 8), (history.rate, history.burst))
+        self.assertIs(history, limiter.bucket(
+            'a', 'https://slack.com/api/conversations.history'))
+        self.assertIsNot(history, limiter.bucket(
+            'b', 'https://slack.com/api/conversations.history'))
+        self.assertEqual(
+            5, limiter.bucket('a', 'https://slack.com/api/emoji.list').rate)
+        other = limiter.bucket('a', 'https://example.com/foo')
+        self.assertIsNone(other.rate)
+        self.assertIs(other, limiter.bucket('a', 'https://example.com/foo?x'))
+        # a server's limits on one path don't hold up the others
+        self.assertIsNot(
+            other, limiter.bucket('a', 'https://example.com/bar'))
+
+        self.assertEqual(
+            2, snipe.util.RateLimiter.parse_retry_after('2'))
+        self.assertEqual(
+            30, snipe.util.RateLimiter.parse_retry_after(
+                'Wed, 21 Oct 2015 07:28:30 GMT', now=1445412480))
+        self.assertIsNone(snipe.util.RateLimiter.parse_retry_after('soon'))
+
+        self.assertTrue(limiter.observe(
+            other, 429, [(b'Retry-After', b'7')]))
+        self.assertAlmostEqual(7, other.delay(), places=1)
+        self.assertFalse(limiter.observe(
+            other, 200,
+            [(b'X-RateLimit-Remaining', b'0'), (b'X-RateLimit-Reset', b'9')]))
+        self.assertAlmostEqual(9, other.delay(), places=1)
+        self.assertEqual(
+            {'waited': 0.0, 'holds': 2}, limiter.stats()['a example.com/foo'])
+
+    def test_configurable(self):
+        context = mocks.Context()
+        configurable = snipe.util.Configurable.registry['http.rate_limits']
+        with patch('snipe.util._rate_limiter', None), \
+                patch.object(snipe.util.Configurable, 'registry', {
+                    'http.rate_limits': configurable}):
+            snipe.util.Configurable.immanentize(context)
+            limiter = snipe.util.rate_limiter()
+            for method in ('channels', 'groups', 'im'):
+                bucket = limiter.bucket(
+                    'slack',
+                    f'https://slack.com/api/{method}.history?channel=C')
+                self.assertEqual((.8, 8), (bucket.rate, bucket.burst))
+            self.assertIsNone(limiter.bucket(
+                'slack', 'https://slack.com/api/chat.postMessage').rate)
+
+    @snipe.imbroglio.test
+    async def test_retry(self):
+        class Server(ConditionalHTTP):
+            refusals = 1
+            responses = []
+
+            async def request(self, url, method='GET', **kw):
+                # everything before should have been closed by now
+                self.test.assertEqual(
+                    [], [r for r in self.responses if not r.closed])
+                response = await super().request(url, method, **kw)
+                response.closed = False
+
+                async def close():
+                    response.closed = True
+                response.close = close
+                self.responses.append(response)
+                if len(self.requests) <= self.refusals:
+                    response.response = h11.Response(
+                        status_code=429, headers=[('Retry-After', '0.01')])
+                    response.blobs = [b'{"ok": false}']
+                return response
+
+        hjm = JSONMixinTester()
+        hjm.log = logging.getLogger('test_rate_limit')
+        hjm.url = 'http://example.com'
+        hjm.setup_client_session()
+        with patch('snipe.util._rate_limiter', None), \
+                patch('snipe.util.HTTP', Server(b'{"ok": true}', '"v1"')) \
+                as server:
+            server.test = self
+            with self.assertLogs('test_rate_limit', 'WARNING'):
+                self.assertEqual({'ok': True}, await hjm._post('/foo'))
+            self.assertEqual(2, len(server.requests))
+            [bucket] = snipe.util.rate_limiter().buckets.values()
+            self.assertEqual(1, bucket.holds)
+
+            # give up eventually
+            server.requests = []
+            server.refusals = 100
+            with self.assertLogs('test_rate_limit', 'WARNING'):
+                self.assertEqual({'ok': False}, await hjm._post('/bar'))
+            self.assertEqual(
+                1 + snipe.util.HTTP_RATE_RETRIES, len(server.requests))
+
+
+class TestJSONArrayDecoder(unittest.TestCase):
+    def test(self):
+        d = snipe.util.JSONArrayDecoder()
+        self.assertFalse(d.array)
+        self.assertEqual([], d.feed(b' \n['))
+        self.assertTrue(d.array)
+        self.assertEqual([], d.feed(b'12'))  # might be 123
+        self.assertEqual([123], d.feed(b'3 ,"\xc3'))  # split UTF-8 too
+        self.assertEqual(['\xe9'], d.feed(b'\xa9", tr'))
+        self.assertEqual([True, [], {}], d.feed(b'ue, [], {}]'))
+        self.assertEqual([], d.feed(b' ', final=True))
+
+        d = snipe.util.JSONArrayDecoder()
+        self.assertEqual([], d.feed(b'[]', final=True))
+
+        d = snipe.util.JSONArrayDecoder()
+        self.assertEqual([], d.feed(b'[1'))
+        self.assertRaises(ValueError, d.feed, b'', final=True)
+
+        d = snipe.util.JSONArrayDecoder()
+        self.assertEqual([], d.feed(b'"foo'))
+        self.assertFalse(d.array)
+        self.assertEqual(['foo'], d.feed(b'"', final=True))
+
+        for bad in (b'[1 2]', b'[1,]', b'[1] 2', b'[,1]'):
+            d = snipe.util.JSONArrayDecoder()
+            with self.assertRaises(ValueError):
+                d.feed(bad, final=True)
+
+
 class MockHTTP_WS:
     def __init__(self):
         self._open = False
 
-    async def request(self, url, headers={}, log=None):
+    async def request(self, url, headers={}, log=None, label=None):
         self._url = url
         self._headers = headers
         self._open = True
@@ -444,14 +827,30 @@ class TestJSONWebSocket(unittest.TestCase):
             self.assertFalse(_HTTP_WS._open)
 
 
-class MockCreateConnection:
+class Listener:
     def __init__(self):
-        self.left, self.right = socket.socketpair()
+        self.socket = socket.socket()
+        self.socket.bind(('127.0.0.1', 0))
+        self.socket.listen(1)
+        self.port = self.socket.getsockname()[1]
+
+    def info(self):
+        return (
+            socket.AF_INET, socket.SOCK_STREAM, 0, '',
+            ('127.0.0.1', self.port))
 
-    def __call__(self, *args, **kw):
-        self.args = args
-        self.kw = kw
-        return self.right
+    def accept(self):
+        conn, _ = self.socket.accept()
+        self.socket.close()
+        return conn
+
+
+def refused_info():
+    s = socket.socket()
+    s.bind(('127.0.0.1', 0))
+    port = s.getsockname()[1]
+    s.close()
+    return (socket.AF_INET, socket.SOCK_STREAM, 0, '', ('127.0.0.1', port))
 
 
 class TestNetworkStream(unittest.TestCase):
@@ -459,21 +858,20 @@ class TestNetworkStream(unittest.TestCase):
         imbroglio.run(self._test())
 
     async def _test(self):
-        with patch(
-                'socket.create_connection', MockCreateConnection()) as mc:
-            mc.left.setblocking(False)
-            self.assertIsInstance(
-                socket.create_connection, MockCreateConnection)
-            ns = await snipe.util.NetworkStream.connect('foo', 80)
+        listener = Listener()
+        with patch('snipe.util._resolver', None):
+            ns = await snipe.util.NetworkStream.connect(
+                '127.0.0.1', listener.port)
+            left = listener.accept()
             await ns.write(b'foo')
-            self.assertEquals(b'foo', mc.left.recv(4096))
+            self.assertEquals(b'foo', left.recv(4096))
 
-            mc.left.send(b'bar')
+            left.send(b'bar')
             self.assertTrue(await ns.readable())
             self.assertEquals(b'bar', (await ns.readsome()))
 
-            mc.left.shutdown(socket.SHUT_RDWR)
-            mc.left.close()
+            left.shutdown(socket.SHUT_RDWR)
+            left.close()
             self.assertEquals(None, (await ns.readsome()))
             self.assertFalse(await ns.readable())
             self.assertEquals(None, (await ns.readsome()))
@@ -482,6 +880,60 @@ class TestNetworkStream(unittest.TestCase):
             with self.assertRaises(OSError):
                 ns.socket.send(b'foo')
 
+            self.assertEqual(
+                {'hits': 0, 'misses': 1, 'cached': 1},
+                snipe.util.resolver().stats())
+
+            # nothing listening anymore, so the lookup gets forgotten
+            with self.assertRaises(OSError):
+                await snipe.util.NetworkStream.connect(
+                    '127.0.0.1', listener.port)
+            self.assertEqual(
+                {'hits': 1, 'misses': 1, 'cached': 0},
+                snipe.util.resolver().stats())
+
+        left, right = socket.socketpair()
+        ns = snipe.util.NetworkStream(right)
+        self.assertEqual(ns.READ_MIN, len(ns.buffer))
+        left.setblocking(False)
+        payload = bytes(range(256)) * 1024
+        received = []
+
+        async def reader():
+            while True:
+                data = await ns.readsome()
+                if data is None:
+                    break
+                received.append(data)
+
+        async def writer():
+            with memoryview(payload) as view:
+                while view:
+                    await imbroglio.writewait(left.fileno())
+                    view = view[left.send(view):]
+            left.close()
+
+        await imbroglio.gather(reader(), writer())
+        self.assertEqual(payload, b''.join(received))
+        self.assertGreater(len(ns.buffer), ns.READ_MIN)
+        self.assertLess(len(received), len(payload) // ns.READ_MIN)
+
+        left, right = socket.socketpair()
+        right.setblocking(False)
+        ns = snipe.util.NetworkStream(left)
+
+        async def drain():
+            got = []
+            while sum(len(x) for x in got) < len(payload):
+                await imbroglio.readwait(right.fileno())
+                got.append(right.recv(1 << 16))
+            return b''.join(got)
+
+        _, got = await imbroglio.gather(ns.write(payload), drain())
+        self.assertEqual(payload, got)
+        await ns.close()
+        right.close()
+
         log = logging.getLogger('test')
         s = socket.socket()
         ns = snipe.util.NetworkStream(s, log=log)
@@ -490,6 +942,111 @@ class TestNetworkStream(unittest.TestCase):
         s.close()
 
 
+class TestNetworkStats(unittest.TestCase):
+    def test(self):
+        stats = snipe.util.NetworkStats()
+        self.assertEqual('', stats.report())
+
+        stats.count('quiet', 'GET https://a/', bytes_in=10, bytes_out=5)
+        stats.count(
+            'busy', 'ws wss://b/socket', connections=1, handshake_time=.5,
+            bytes_in=1000, bytes_out=100, frames_in=10, frames_out=2)
+        stats.count(
+            'busy', 'ws wss://b/socket', connections=1, handshake_time=.25)
+        stats.latency('quiet', 'GET https://a/', .05)
+        stats.latency('quiet', 'GET https://a/', 100)
+
+        self.assertEqual(
+            'busy: 1000 bytes in, 100 bytes out\n'
+            '  ws wss://b/socket\n'
+            '    1000 in, 100 out, 10 frames in, 2 out\n'
+            '    2 connections, 1 reconnects, 0.375s average setup\n'
+            'quiet: 10 bytes in, 5 bytes out\n'
+            '  GET https://a/\n'
+            '    10 in, 5 out\n'
+            '    latency: <0.1s:1 +:1',
+            stats.report())
+
+        stats.clear()
+        self.assertEqual('', stats.report())
+
+
+class TestResolver(unittest.TestCase):
+    @snipe.imbroglio.test
+    async def test(self):
+        v4 = [(socket.AF_INET, socket.SOCK_STREAM, 0, '', (f'10.0.0.{i}', 80))
+              for i in range(3)]
+        v6 = [(socket.AF_INET6, socket.SOCK_STREAM, 0, '', (f'::{i}', 80))
+              for i in range(2)]
+        lookup = Mock(return_value=v6 + v4)
+        r = snipe.util.Resolver(ttl=60)
+        with patch('socket.getaddrinfo', lookup):
+            infos = await r.resolve('foo', 80)
+            self.assertEqual(
+                [v6[0], v4[0], v6[1], v4[1], v4[2]], infos)
+            lookup.assert_called_once_with('foo', 80, 0, socket.SOCK_STREAM)
+
+            self.assertIs(infos, await r.resolve('foo', 80))
+            self.assertEqual(1, lookup.call_count)
+            await r.resolve('foo', 443)
+            self.assertEqual(2, lookup.call_count)
+
+            with patch('time.monotonic', return_value=time.monotonic() + 61):
+                await r.resolve('foo', 80)
+            self.assertEqual(3, lookup.call_count)
+
+            r.forget('foo', 80)
+            await r.resolve('foo', 80)
+            self.assertEqual(4, lookup.call_count)
+
+        self.assertEqual(
+            {'hits': 1, 'misses': 4, 'cached': 2}, r.stats())
+
+
+class TestConnectSocket(unittest.TestCase):
+    @snipe.imbroglio.test
+    async def test(self):
+        listener = Listener()
+        refused = refused_info()
+        sock = await snipe.util.connect_socket(
+            [refused, listener.info()], delay=5)
+        self.assertEqual(('127.0.0.1', listener.port), sock.getpeername())
+        listener.accept().close()
+        sock.close()
+
+        with self.assertRaises(ConnectionRefusedError):
+            await snipe.util.connect_socket([refused])
+
+        with self.assertRaises(OSError):
+            await snipe.util.connect_socket([])
+
+        # an attempt that hasn't come back doesn't hold up the next one
+        t0 = time.monotonic()
+        listener = Listener()
+        hung = []
+        connect_ex = socket.socket.connect_ex
+        writewait = imbroglio.writewait
+
+        def black_hole(sock, address):
+            if not hung:
+                hung.append(sock.fileno())
+                return errno.EINPROGRESS
+            return connect_ex(sock, address)
+
+        def fake_writewait(fd, *args):
+            if fd in hung:
+                return imbroglio.sleep(None)
+            return writewait(fd, *args)
+
+        with patch('socket.socket.connect_ex', black_hole), \
+                patch('snipe.imbroglio.writewait', fake_writewait):
+            sock = await snipe.util.connect_socket(
+                [refused, listener.info()], delay=.01)
+        self.assertLess(time.monotonic() - t0, 1)
+        sock.close()
+        listener.socket.close()
+
+
 class MockStream:
     def __init__(self, pending_eof=True):
         self.readdata = [b'stuff']
@@ -576,10 +1133,10 @@ class MockContext:
     def push_exceptions(self, *args):
         self.read_exceptions.extend(args)
 
-    def read(self):
+    def read(self, size=-1):
         if self.read_exceptions:
             raise self.read_exceptions.pop(0)
-        return self.incoming.read()
+        return self.incoming.read(size)
 
     def pending(self):
         return bool(self.incoming.pending)
@@ -590,7 +1147,8 @@ class TestSSLStream(unittest.TestCase):
         imbroglio.run(self._test())
 
     async def _test(self):
-        with patch('ssl.create_default_context', MockContext):
+        with patch('ssl.create_default_context', MockContext), \
+                patch('snipe.util._tls_sessions', None):
             ss = snipe.util.SSLStream(MockStream(), 'foo')
             self.assertEqual('<SSLStream <MockStream>>', repr(ss))
             log = logging.getLogger('test')
@@ -677,10 +1235,63 @@ class TestSSLStream(unittest.TestCase):
             self.assertEqual(None, (await ss.readsome()))
 
 
+class MockSessionContext(MockContext):
+    def wrap_bio(self, incoming, outgoing, *, session=None, **kw):
+        obj = MockContext()
+        obj.session_reused = session is not None
+        obj.session = session if session is not None else object()
+        return MockContext.wrap_bio(obj, incoming, outgoing, **kw)
+
+
+class TestTLSSessionCache(unittest.TestCase):
+    @snipe.imbroglio.test
+    async def test(self):
+        with patch('ssl.create_default_context', MockSessionContext), \
+                patch('snipe.util._tls_sessions', None):
+            cache = snipe.util.tls_sessions()
+            self.assertIs(cache, snipe.util.tls_sessions())
+
+            ss = snipe.util.SSLStream(MockStream(), 'foo', port=443)
+            self.assertIs(cache, ss.sessions)
+            self.assertIs(cache.context, ss.ctx)
+            self.assertFalse(ss.obj.session_reused)
+            await ss.do_handshake()
+            session = ss.obj.session
+            self.assertEqual(
+                {'hits': 0, 'misses': 1, 'sessions': 1}, cache.stats())
+
+            ss = snipe.util.SSLStream(MockStream(), 'foo', port=443)
+            self.assertTrue(ss.obj.session_reused)
+            self.assertIs(session, ss.obj.session)
+            await ss.do_handshake()
+            await ss.close()
+            self.assertEqual(
+                {'hits': 1, 'misses': 1, 'sessions': 1}, cache.stats())
+
+            # different port, different session
+            ss = snipe.util.SSLStream(MockStream(), 'foo', port=8443)
+            self.assertFalse(ss.obj.session_reused)
+
+            # the session can turn up after the handshake (TLS 1.3)
+            ss.handshake_done = True
+            ss.obj.session = object()
+            await ss.close()
+            self.assertIs(ss.obj.session, cache.sessions[('foo', 8443)])
+            self.assertEqual(
+                {'hits': 1, 'misses': 1, 'sessions': 2}, cache.stats())
+
+            # a private cache
+            other = snipe.util.TLSSessionCache()
+            ss = snipe.util.SSLStream(MockStream(), 'foo', sessions=other)
+            self.assertIs(other, ss.sessions)
+            self.assertFalse(ss.obj.session_reused)
+
+
 class TestHTTP(unittest.TestCase):
     @snipe.imbroglio.test
     async def test0(self):
         with patch('ssl.create_default_context', MockContext), \
+                patch('snipe.util._tls_sessions', None), \
                 patch('snipe.util.NetworkStream', MockStream):
             HTTP = await snipe.util.HTTP.request('https://foo/foo')
             self.assertIsInstance(HTTP.stream.obj, MockContext)
@@ -719,6 +1330,35 @@ class TestHTTP(unittest.TestCase):
                 b'\r\nbar=foo',
                 b''.join(HTTP.stream.wrote))
 
+    @snipe.imbroglio.test
+    async def test_stats(self):
+        with patch('snipe.util.NetworkStream', MockStream), \
+                patch('snipe.util._network_stats', None):
+            HTTP = await snipe.util.HTTP.request(
+                'http://foo/foo?bar=baz', label='test')
+            HTTP.stream.readdata = [
+                b'HTTP/1.1 200 Ok\r\nContent-Length: 5\r\n\r\nfoo\r\n']
+            self.assertEqual(b'foo\r\n', (await HTTP.readsome()))
+            await HTTP.close()
+
+            stats = snipe.util.network_stats()
+            counts = stats.counts[('test', 'GET http://foo/foo')]
+            self.assertEqual(1, counts['requests'])
+            self.assertEqual(1, counts['connections'])
+            self.assertEqual(0, counts['reused'])
+            self.assertEqual(
+                len(b''.join(HTTP.stream.wrote)), counts['bytes_out'])
+            self.assertEqual(5, counts['bytes_in'])
+            self.assertEqual(5, counts['bytes_decoded'])
+            self.assertEqual(
+                1, sum(stats.latencies[('test', 'GET http://foo/foo')]))
+
+            report = stats.report()
+            self.assertIn('test: 5 bytes in', report)
+            self.assertIn('  GET http://foo/foo\n', report)
+            self.assertIn('1 requests', report)
+            self.assertIn('latency: <0.01s:1', report)
+
     @snipe.imbroglio.test
     async def test1(self):
         with patch('snipe.util.NetworkStream', MockStream):
@@ -779,6 +1419,93 @@ class TestHTTP(unittest.TestCase):
             self.assertIs(None, (await HTTP.readsome()))
 
 
+class TestConnectionPool(unittest.TestCase):
+    @snipe.imbroglio.test
+    async def test(self):
+        response = b'HTTP/1.1 200 Ok\r\nContent-Length: 3\r\n\r\nfoo'
+        with patch('snipe.util.NetworkStream', MockStream):
+            pool = snipe.util.ConnectionPool(max_idle=1)
+
+            HTTP = await snipe.util.HTTP.request('http://foo/foo', pool=pool)
+            self.assertFalse(HTTP.reused)
+            self.assertEqual(
+                b'GET /foo HTTP/1.1\r\nhost: foo\r\n'
+                b'accept-encoding: gzip\r\n\r\n',
+                b''.join(HTTP.stream.wrote))
+            first = HTTP.stream
+            first.readdata = [response]
+            self.assertEqual(b'foo', (await HTTP.readsome()))
+            self.assertIsNone(await HTTP.readsome())
+            await HTTP.close()
+            self.assertFalse(first.closed)
+            self.assertEqual(1, pool.stats()['idle'])
+
+            # the same connection gets used for the next request
+            HTTP = await snipe.util.HTTP.request('http://foo/bar', pool=pool)
+            self.assertTrue(HTTP.reused)
+            self.assertIs(first, HTTP.stream)
+            first.readdata = [response]
+            self.assertEqual(b'foo', (await HTTP.readsome()))
+
+            # a response we don't finish reading isn't reusable
+            await HTTP.close()
+            self.assertTrue(first.closed)
+            self.assertEqual(0, pool.stats()['idle'])
+
+            # if the server hangs up on a reused connection, try again
+            first = MockStream(pending_eof=True)
+            first.readdata = []
+            await pool.put('http', 'foo', 80, first)
+            HTTP = await snipe.util.HTTP.request('http://foo/baz', pool=pool)
+            self.assertIs(first, HTTP.stream)
+            first.reof = True
+
+            class Responder(MockStream):
+                @classmethod
+                async def connect(klass, host, port, log=None):
+                    self = klass()
+                    self.readdata = [response]
+                    return self
+
+            with patch('snipe.util.NetworkStream', Responder):
+                self.assertEqual(b'foo', (await HTTP.readsome()))
+            self.assertIsInstance(HTTP.stream, Responder)
+            self.assertIn(b'connection: close', HTTP.stream.wrote[0])
+            self.assertTrue(first.closed)
+
+            # but not if it might not be safe to ask twice
+            first = MockStream(pending_eof=True)
+            first.readdata = []
+            await pool.put('http', 'foo', 80, first)
+            HTTP = await snipe.util.HTTP.request(
+                'http://foo/baz', 'POST', data={'text': 'hello'}, pool=pool)
+            self.assertIs(first, HTTP.stream)
+            first.reof = True
+            with patch('snipe.util.NetworkStream', Responder), \
+                    self.assertRaises(snipe.util.h11.RemoteProtocolError):
+                await HTTP.readsome()
+            self.assertIs(first, HTTP.stream)
+            await HTTP.close()
+            self.assertTrue(first.closed)
+
+            # stale connections are thrown away
+            chatty = MockStream()  # has unread data
+            await pool.put('http', 'foo', 80, chatty)
+            stream, reused = await pool.get('http', 'foo', 80)
+            self.assertFalse(reused)
+            self.assertTrue(chatty.closed)
+            pool.idle_timeout = 0
+            await pool.put('http', 'foo', 80, stream)
+            await pool.put('http', 'foo', 80, MockStream(pending_eof=False))
+            pool.idle_timeout = 30
+            self.assertTrue(stream.closed)
+            self.assertEqual(
+                {'hits': 3, 'misses': 2, 'discarded': 2, 'idle': 1},
+                pool.stats())
+            await pool.clear()
+            self.assertEqual(0, pool.stats()['idle'])
+
+
 class WebSocketServerStream:
     def __init__(self):
         self.ws = wsproto.WSConnection(wsproto.ConnectionType.SERVER)
@@ -860,6 +1587,85 @@ class TestHTTP_WS(unittest.TestCase):
         self.assertIsNone(await ws.read())
         self.assertIsNone(await ws.write(''))
 
+    @snipe.imbroglio.test
+    async def test_coalesce(self):
+        stream = WebSocketServerStream()
+        ws = await snipe.util.HTTP_WS.request(
+            'http://foo/bar', stream=stream)
+        writes = []
+        write = stream.write
+
+        async def counting_write(data):
+            writes.append(data)
+            await write(data)
+
+        stream.write = counting_write
+        supervisor = await imbroglio.get_supervisor()
+
+        # three frames in the same tick
+        for t in [supervisor.start(ws.write(x)) for x in 'ABC']:
+            await t
+        self.assertEqual(1, len(writes))
+        self.assertEqual('A', await ws.read())
+        self.assertEqual('B', await ws.read())
+        self.assertEqual('C', await ws.read())
+
+        # a write queued behind one in progress still goes out on close
+        tasks = [supervisor.start(ws.write('D')), supervisor.start(ws.close())]
+        for t in tasks:
+            await t
+        self.assertEqual(2, len(writes))
+        self.assertTrue(stream.closed)
+
+    @snipe.imbroglio.test
+    async def test_flush_priority(self):
+        stream = WebSocketServerStream()
+        ws = await snipe.util.HTTP_WS.request(
+            'http://foo/bar', stream=stream)
+        gate = imbroglio.Event()
+        write = stream.write
+
+        async def slow_write(data):
+            await gate.wait()
+            await write(data)
+
+        stream.write = slow_write
+        supervisor = await imbroglio.get_supervisor()
+
+        # a more urgent flush doesn't keep the writer from finishing
+        writer = supervisor.start(ws.write('A'), imbroglio.BACKGROUND)
+        await imbroglio.sleep(.01)  # let it get as far as the stream
+        self.assertTrue(ws.flushing)
+        flusher = supervisor.start(ws.flush(), imbroglio.INTERACTIVE)
+        await imbroglio.sleep(.01)
+        self.assertFalse(flusher.is_done())
+        await gate.set()
+        await flusher
+        await writer
+        self.assertEqual('A', await ws.read())
+
+    @snipe.imbroglio.test
+    async def test_coalesce_failure(self):
+        stream = WebSocketServerStream()
+        ws = await snipe.util.HTTP_WS.request(
+            'http://foo/bar', stream=stream)
+
+        async def failing_write(data):
+            raise ConnectionResetError()
+
+        stream.write = failing_write
+        supervisor = await imbroglio.get_supervisor()
+
+        # everyone whose frame was in the write hears about it
+        tasks = [supervisor.start(ws.write(x)) for x in 'ABC']
+        for t in tasks:
+            await t
+            with self.assertRaises(ConnectionResetError):
+                t.result()
+        self.assertEqual([], ws.outbuf)
+        self.assertEqual([], ws.outwaiters)
+        self.assertFalse(ws.flushing)
+
     @snipe.imbroglio.test
     async def test_remoteclose(self):
         stream = WebSocketServerStream()
@@ -35,6 +35,8 @@ Unit tests for stuff in window.py
 import logging
 import unittest
 
+from unittest.mock import (patch)
+
 import mocks
 
 import snipe.imbroglio as imbroglio
@@ -235,6 +237,27 @@ class TestWindow(unittest.TestCase):
                     for (mark, chunk) in fe.windows[1].window.view(0)),
                 'foo')
 
+    @imbroglio.test
+    async def test_show_task_stats(self):
+        with mocks.mocked_up_actual_fe(window.Window) as fe:
+            await fe.windows[0].window.show_task_stats()
+            self.assertEqual(len(fe.windows), 2)
+            text = ''.join(
+                str(chunk) for (mark, chunk) in fe.windows[1].window.view(0))
+            self.assertIn('ticks', text)
+            self.assertIn('test_show_task_stats', text)
+
+    def test_show_network_stats(self):
+        with mocks.mocked_up_actual_fe(window.Window) as fe, \
+                patch('snipe.util._network_stats', None):
+            util.network_stats().count(
+                'backend', 'GET http://foo/', bytes_in=1, bytes_out=2)
+            fe.windows[0].window.show_network_stats()
+            self.assertEqual(len(fe.windows), 2)
+            text = ''.join(
+                str(chunk) for (mark, chunk) in fe.windows[1].window.view(0))
+            self.assertIn('backend: 1 bytes in, 2 bytes out', text)
+
     def test_quit(self):
         with mocks.mocked_up_actual_fe_window(window.Window) as w:
             self.assertFalse(w.fe.quit)
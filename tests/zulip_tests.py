@@ -33,12 +33,17 @@ Unit tests for zulip backend
 '''
 
 import os
+import tempfile
 import unittest
 
+from unittest.mock import patch
+
 import mocks
 
 import snipe.context as context
+import snipe.imbroglio as imbroglio
 import snipe.messages as messages
+import snipe.store as store
 import snipe.zulip as zulip
 
 
@@ -115,5 +120,82 @@ class TestZulipMessage(unittest.TestCase):
             '<ZulipMessage 0.0 <ZulipAddress zulip tim@alum.mit.edu> 3 chars>')
 
 
+class TestZulip(unittest.TestCase):
+    @imbroglio.test
+    async def test_catch_up(self):
+        def data(i):
+            return {
+                'id': i, 'timestamp': 1000.0 + i, 'content': str(i),
+                'sender_email': 'tim@alum.mit.edu', 'type': 'stream',
+                'display_recipient': 'black-magic', 'subject': 'television',
+                '_html': str(i),
+                }
+
+        z = zulip.Zulip(context.Context())
+        z.context.ui = mocks.FE()
+        z.messages = messages.MessageList(
+            zulip.ZulipMessage(z, data(i)) for i in range(3))
+
+        server = [data(i) for i in range(5)]
+        requests = []
+
+        async def _get(path, **kw):
+            requests.append(kw['anchor'])
+            after = [m for m in server if m['id'] >= kw['anchor']]
+            return {
+                'result': 'success',
+                'messages': after[:2],
+                'found_newest': len(after) <= 2,
+                }
+
+        z._get = _get
+        await z.catch_up()
+        self.assertEqual([0, 1, 2, 3, 4], [m.data['id'] for m in z.messages])
+        self.assertEqual([2, 3], requests)
+
+        msg, last = await z.process_event(
+            {'id': 7, 'type': 'message', 'message': data(4)}, 5)
+        self.assertIsNone(msg)  # already had it
+        self.assertEqual(7, last)
+
+    @imbroglio.test
+    async def test_persist_displayed(self):
+        with tempfile.TemporaryDirectory() as tmp, \
+                patch('snipe.store._message_store', None):
+            store.message_store().path = os.path.join(tmp, 'messages.sqlite')
+            z = zulip.Zulip(context.Context())
+            z.context.ui = mocks.FE()
+            m = zulip.ZulipMessage(z, {
+                'id': 1, 'timestamp': 1000.0, 'content': 'foo',
+                'sender_email': 'tim@alum.mit.edu', 'type': 'stream',
+                'display_recipient': 'black-magic', 'subject': 'television',
+                '_html': 'foo',
+                })
+            z.messages = messages.MessageList([m])
+            m.display({})
+            self.assertIn('_rendered', m.data)
+            await z.persist([m])
+            self.assertEqual(1, store.message_store().count(z.name))
+
+            m.update({'content': 'bar'})
+            m.display({})
+            await z.persist([m])
+            [(_, _, data)] = store.message_store().load(z.name)
+            self.assertNotIn('_rendered', data)
+            self.assertNotIn('_rendered', data['_old'])
+            self.assertEqual('bar', data['content'])
+            self.assertEqual('foo', data['_old']['content'])
+
+    def test_readjust_before(self):
+        class M:
+            def __init__(self, time):
+                self.time = time
+
+        msgs = [M(1.0), M(2.0), M(2.0)]
+        zulip.Zulip.readjust_before(msgs, [M(2.0)])
+        self.assertEqual(
+            [1.0, 1.9998, 1.9999], [round(m.time, 4) for m in msgs])
+
+
 if __name__ == '__main__':
     unittest.main()